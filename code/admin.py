@@ -1,4 +1,5 @@
 import utilities
+import metrics
 from discord.ext import commands
 
 ## Config
@@ -9,6 +10,9 @@ class Admin:
     ## Keys
     ADMINS_KEY = "admins"
 
+    ## Defaults
+    MAX_STATS_LENGTH = 1900
+
     def __init__(self, plane_pal, bot_io=None):
         self.plane_pal = plane_pal
         self.bot_io = bot_io if bot_io else self.plane_pal.get_bot_io_cog()
@@ -53,4 +57,27 @@ class Admin:
         loaded_cogs_string = "Loaded {} of {} cogs.".format(count, total)
         await self.bot_io.say(loaded_cogs_string)
 
-        return (count >= 0)
\ No newline at end of file
+        return (count >= 0)
+
+
+    ## Shows the latency and throughput stats for the plot commands (admin only)
+    @admin.command(pass_context=True, no_pm=True)
+    async def stats(self, ctx):
+        """Shows the bot's performance stats."""
+
+        if(not self.is_admin(ctx.message.author)):
+            await self.bot_io.say("<@{}> isn't allowed to do that.".format(ctx.message.author.id))
+            return False
+
+        lines = metrics.get_shared_metrics().get_summary_lines()
+        if(not lines):
+            await self.bot_io.say("No stats have been recorded yet.")
+            return True
+
+        ## Stay under Discord's message length limit
+        output = "\n".join(lines)
+        if(len(output) > self.MAX_STATS_LENGTH):
+            output = output[:self.MAX_STATS_LENGTH] + "\n..."
+        await self.bot_io.say("```\n{}\n```".format(output))
+
+        return True
\ No newline at end of file
@@ -0,0 +1,161 @@
+import asyncio
+from collections import OrderedDict, deque
+
+import utilities
+import metrics
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+
+class AdmissionRejectedError(RuntimeError):
+    def __init__(self, reason):
+        super().__init__("Plot rejected ({})".format(reason))
+        self.reason = reason
+
+
+class Admission:
+    ## Async context manager that holds onto a plot slot for the duration of its block
+    def __init__(self, controller, guild_id, user_id):
+        self.controller = controller
+        self.guild_id = guild_id
+        self.user_id = user_id
+
+    ## Methods
+
+    async def __aenter__(self):
+        await self.controller.acquire(self.guild_id, self.user_id)
+        return self
+
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.controller.release(self.guild_id, self.user_id)
+        return False
+
+
+class AdmissionController:
+    """
+    Limits how many plots can run at once, and how many can be waiting, both overall and for each server and user. Slots
+    are handed out round-robin across servers, so a single busy server can't starve everyone else. Anything over the
+    limits is rejected right away, rather than left waiting forever.
+    """
+
+    ## Keys
+    ADMISSION_MAX_RUNNING_KEY = "admission_max_running"
+    ADMISSION_MAX_QUEUED_KEY = "admission_max_queued"
+    ADMISSION_MAX_PER_GUILD_KEY = "admission_max_per_guild"
+    ADMISSION_MAX_PER_USER_KEY = "admission_max_per_user"
+    ADMISSION_QUEUE_TIMEOUT_SECONDS_KEY = "admission_queue_timeout_seconds"
+
+    ## Defaults
+    ADMISSION_MAX_RUNNING = CONFIG_OPTIONS.get(ADMISSION_MAX_RUNNING_KEY, 4)
+    ADMISSION_MAX_QUEUED = CONFIG_OPTIONS.get(ADMISSION_MAX_QUEUED_KEY, 64)
+    ADMISSION_MAX_PER_GUILD = CONFIG_OPTIONS.get(ADMISSION_MAX_PER_GUILD_KEY, 8)
+    ADMISSION_MAX_PER_USER = CONFIG_OPTIONS.get(ADMISSION_MAX_PER_USER_KEY, 2)
+    ADMISSION_QUEUE_TIMEOUT_SECONDS = CONFIG_OPTIONS.get(ADMISSION_QUEUE_TIMEOUT_SECONDS_KEY, 15)
+
+
+    def __init__(self, loop=None, **kwargs):
+        self.loop = loop
+
+        self.max_running = kwargs.get(self.ADMISSION_MAX_RUNNING_KEY, self.ADMISSION_MAX_RUNNING)
+        self.max_queued = kwargs.get(self.ADMISSION_MAX_QUEUED_KEY, self.ADMISSION_MAX_QUEUED)
+        self.max_per_guild = kwargs.get(self.ADMISSION_MAX_PER_GUILD_KEY, self.ADMISSION_MAX_PER_GUILD)
+        self.max_per_user = kwargs.get(self.ADMISSION_MAX_PER_USER_KEY, self.ADMISSION_MAX_PER_USER)
+        self.queue_timeout = kwargs.get(self.ADMISSION_QUEUE_TIMEOUT_SECONDS_KEY, self.ADMISSION_QUEUE_TIMEOUT_SECONDS)
+
+        self.running = 0
+        self.queued = 0
+        ## Outstanding (running and waiting) plots for each server and user
+        self.guild_counts = {}
+        self.user_counts = {}
+        ## Each server's waiting plots, in the order that the servers will next be served
+        self.waiters = OrderedDict()
+
+        self.rejected = 0
+        self.metrics = metrics.get_shared_metrics()
+
+    ## Methods
+
+    def _get_loop(self):
+        return self.loop if self.loop else asyncio.get_event_loop()
+
+
+    def admit(self, guild_id, user_id):
+        return Admission(self, guild_id, user_id)
+
+
+    def _adjust_counts(self, guild_id, user_id, amount):
+        for counts, key in [(self.guild_counts, guild_id), (self.user_counts, user_id)]:
+            count = counts.get(key, 0) + amount
+            if(count > 0):
+                counts[key] = count
+            else:
+                counts.pop(key, None)
+
+
+    def _reject(self, reason):
+        self.rejected += 1
+        self.metrics.increment("admission_rejected_total", {"reason": reason})
+        raise AdmissionRejectedError(reason)
+
+
+    async def acquire(self, guild_id, user_id):
+        if(self.user_counts.get(user_id, 0) >= self.max_per_user):
+            self._reject("user_limit")
+        if(self.guild_counts.get(guild_id, 0) >= self.max_per_guild):
+            self._reject("guild_limit")
+
+        ## Go straight through if there's a free slot and nobody else is waiting for one
+        if(self.running < self.max_running and not self.waiters):
+            self.running += 1
+            self._adjust_counts(guild_id, user_id, 1)
+            return
+
+        if(self.queued >= self.max_queued):
+            self._reject("queue_full")
+
+        future = self._get_loop().create_future()
+        self.waiters.setdefault(guild_id, deque()).append(future)
+        self.queued += 1
+        self._adjust_counts(guild_id, user_id, 1)
+
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if(future.done() and not future.cancelled()):
+                ## The slot was handed over just as the wait ended, so give it right back
+                self.release(guild_id, user_id)
+            else:
+                self.queued -= 1
+                self._adjust_counts(guild_id, user_id, -1)
+                self._dispatch()
+
+            if(isinstance(e, asyncio.TimeoutError)):
+                self._reject("queue_timeout")
+            raise
+
+
+    def release(self, guild_id, user_id):
+        self.running -= 1
+        self._adjust_counts(guild_id, user_id, -1)
+        self._dispatch()
+
+
+    def _dispatch(self):
+        ## Hand out free slots one server at a time, moving each server to the back of the line once it's been served
+        while(self.running < self.max_running and self.waiters):
+            guild_id, guild_waiters = next(iter(self.waiters.items()))
+            future = guild_waiters.popleft()
+            if(guild_waiters):
+                self.waiters.move_to_end(guild_id)
+            else:
+                del self.waiters[guild_id]
+
+            ## Waiters that gave up have already cleaned up after themselves
+            if(future.done()):
+                continue
+
+            self.queued -= 1
+            self.running += 1
+            future.set_result(True)
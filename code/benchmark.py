@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import tempfile
+
+import utilities
+import plotter
+import render_cache
+import dynamo_helper
+import bot_io
+
+## Not available on Windows, in which case the peak RSS just won't be reported
+try:
+    import resource
+except ImportError:
+    resource = None
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+BENCHMARK_MAPS = ["erangel", "miramar"]
+BENCHMARK_X_MARKERS = "abcdefgh"
+BENCHMARK_Y_MARKERS = "ijklmnop"
+
+
+class FakeObject:
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+class FakeBot:
+    """
+    Stand-in for the discord.py bot, which just records whatever it would've sent to Discord.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.messages = []
+        self.uploads = 0
+        self.uploaded_bytes = 0
+
+    ## Methods
+
+    async def say(self, *args, **kwargs):
+        self.messages.append(args)
+
+
+    async def send_file(self, destination, fp, filename=None, content=None):
+        self.uploads += 1
+        self.uploaded_bytes += len(fp.read())
+
+
+def build_fake_context(user_id, server_id):
+    server = FakeObject(id=str(server_id), name="Server {}".format(server_id))
+    message = FakeObject(
+        author=FakeObject(id=str(user_id)),
+        timestamp=datetime.datetime.now(),
+        channel=FakeObject(name="plane-pal"),
+        server=server
+    )
+
+    return FakeObject(message=message)
+
+
+def build_query_mix(count, seed):
+    ## A realistic spread of maps, headings, and grid markers, with subsections about half of the time
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        section = str(rng.randint(1, 9)) if rng.random() < 0.5 else ""
+        message = "{} {}{}{}".format(rng.randint(0, 359), rng.choice(BENCHMARK_X_MARKERS), rng.choice(BENCHMARK_Y_MARKERS), section)
+        queries.append((rng.choice(BENCHMARK_MAPS), message))
+
+    return queries
+
+
+def summarize(samples):
+    ## Timings are in seconds, summaries are in milliseconds
+    ordered = sorted(samples)
+    count = len(ordered)
+    if(not count):
+        return {}
+
+    def percentile(fraction):
+        return ordered[min(count - 1, int(fraction * count))] * 1000
+
+    return {
+        "count": count,
+        "mean_ms": sum(ordered) / count * 1000,
+        "p50_ms": percentile(0.5),
+        "p90_ms": percentile(0.9),
+        "p99_ms": percentile(0.99),
+        "max_ms": ordered[-1] * 1000
+    }
+
+
+def get_peak_rss_bytes():
+    if(resource is None):
+        return None
+
+    ## Linux reports kilobytes, macOS reports bytes
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+class PlotBenchmark:
+    """
+    Drives the plot pipeline (parsing, drawing, encoding, writing, uploading, and BotIO._plot end to end) against a fake
+    Discord bot and a local analytics table, and reports the timings of each stage.
+    """
+
+    def __init__(self, iterations, seed=0, use_cache=False):
+        self.iterations = iterations
+        self.queries = build_query_mix(iterations, seed)
+
+        self.loop = asyncio.get_event_loop()
+        self.bot = FakeBot(self.loop)
+        self.bot_io = bot_io.BotIO(None, self.bot)
+        self.bot_io.dynamo_db = dynamo_helper.DynamoHelper(boto_enable=True, table=dynamo_helper.LocalTable())
+        self.path_parser = self.bot_io.path_parser
+        self.plotter = self.bot_io.plotter
+
+        ## Measure the actual rendering work, unless the cache is explicitly wanted
+        render_cache.get_shared_render_cache().enabled = use_cache
+
+        self.output_folder_path = tempfile.mkdtemp(prefix="plane_pal_benchmark_")
+        self.file_controller = plotter.PlotterFileController(output_folder_path=self.output_folder_path, save_maps_to_disk=True)
+
+    ## Methods
+
+    def run_stages(self):
+        timings = {"parse": [], "draw": [], "encode": [], "write": [], "upload": []}
+
+        for map_name, message in self.queries:
+            start = time.perf_counter()
+            path_obj = self.path_parser.parse_message(message, map_name)
+            parsed = time.perf_counter()
+            plotted_map = self.plotter.plot_plane_path(map_name, path_obj)
+            drawn = time.perf_counter()
+            map_bytes = self.file_controller.encode_map(plotted_map)
+            encoded = time.perf_counter()
+            map_path = self.file_controller.save_map_bytes(map_bytes)
+            self.file_controller.create_delete_map_callback(map_path)()
+            written = time.perf_counter()
+            self.loop.run_until_complete(self.bot_io.upload_bytes(map_bytes, "map.jpeg", None))
+            uploaded = time.perf_counter()
+
+            timings["parse"].append(parsed - start)
+            timings["draw"].append(drawn - parsed)
+            timings["encode"].append(encoded - drawn)
+            timings["write"].append(written - encoded)
+            timings["upload"].append(uploaded - written)
+
+        return timings
+
+
+    async def _timed_plot(self, index, map_name, message, samples):
+        ctx = build_fake_context(index % 50, index % 10)
+        start = time.perf_counter()
+        await self.bot_io._plot(ctx, message, map_name)
+        samples.append(time.perf_counter() - start)
+
+
+    def run_end_to_end(self, concurrency):
+        samples = []
+
+        async def run_all():
+            for index in range(0, len(self.queries), concurrency):
+                batch = self.queries[index:index + concurrency]
+                await asyncio.gather(*[self._timed_plot(index + offset, map_name, message, samples) for offset, (map_name, message) in enumerate(batch)])
+
+        start = time.perf_counter()
+        self.loop.run_until_complete(run_all())
+        elapsed = time.perf_counter() - start
+
+        return samples, elapsed
+
+
+    def run(self, concurrency=1):
+        stage_timings = self.run_stages()
+        end_to_end_samples, elapsed = self.run_end_to_end(concurrency)
+
+        self.bot_io.render_pool.shutdown(wait=True)
+        self.bot_io.dynamo_db.shutdown()
+        os.rmdir(self.output_folder_path)
+
+        results = {
+            "timestamp": time.time(),
+            "iterations": self.iterations,
+            "concurrency": concurrency,
+            "render_pool_type": self.bot_io.render_pool.pool_type,
+            "band_renderer": self.plotter.band_renderer,
+            "overlay_enable": self.plotter.overlay_enable,
+            "render_cache_enable": render_cache.get_shared_render_cache().enabled,
+            "stages": {stage: summarize(samples) for stage, samples in stage_timings.items()},
+            "end_to_end": summarize(end_to_end_samples),
+            "throughput_per_second": len(end_to_end_samples) / elapsed if elapsed else None,
+            "uploaded_bytes": self.bot.uploaded_bytes,
+            "peak_rss_bytes": get_peak_rss_bytes()
+        }
+
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Plane Pal's plot pipeline.")
+    parser.add_argument("--iterations", type=int, default=100, help="Number of plots to run through each benchmark")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of concurrent end to end plots")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated mix of queries")
+    parser.add_argument("--cache", action="store_true", help="Leave the render cache enabled")
+    parser.add_argument("--output", help="Write the JSON results to this file, rather than stdout")
+    args = parser.parse_args()
+
+    results = PlotBenchmark(args.iterations, args.seed, args.cache).run(args.concurrency)
+
+    serialized = json.dumps(results, indent=4, sort_keys=True)
+    if(args.output):
+        with open(args.output, "w") as fd:
+            fd.write(serialized)
+    else:
+        print(serialized)
+
+
+if(__name__ == '__main__'):
+    main()
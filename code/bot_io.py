@@ -1,11 +1,20 @@
 import re
-from math import sqrt
+import io
+import time
+import asyncio
 
 from discord import errors
 from discord.ext import commands
 
 import utilities
 import plotter
+import metrics
+import map_metadata
+import admission
+import cache_warmer
+import render_pool
+import sharding
+import render_server
 import dynamo_helper
 
 ## Config
@@ -13,14 +22,10 @@ CONFIG_OPTIONS = utilities.load_config()
 
 
 class GridObject:
-    ## Keys
-    MAX_SECTIONS_KEY = "max_sections"
-
-    ## Defaults
-    MAX_SECTIONS = CONFIG_OPTIONS.get(MAX_SECTIONS_KEY, 9)    # 3x3 subgrid in each grid on the map
+    def __init__(self, x, y, section=None, metadata=None):
+        ## The letters and sections that are valid depend on the map, which defaults to the original 8x8km layout
+        self.metadata = metadata if metadata else map_metadata.get_shared_map_metadata().get()
 
-
-    def __init__(self, x, y, section=None):
         ## Prepopulate the members
         self.valid = True
         self._x = None
@@ -31,6 +36,18 @@ class GridObject:
         self.y = y
         self.section = section
 
+
+    def __getstate__(self):
+        ## Grids get sent off to render processes, which have their own registry to look the map back up in
+        state = self.__dict__.copy()
+        state["metadata"] = self.metadata.name
+        return state
+
+
+    def __setstate__(self, state):
+        state["metadata"] = map_metadata.get_shared_map_metadata().get(state["metadata"])
+        self.__dict__.update(state)
+
     ## Properties
 
     @property
@@ -41,21 +58,24 @@ class GridObject:
     @x.setter
     def x(self, value):
         x = value.lower()
+        x_letters = self.metadata.grid_x_letters
+        y_letters = self.metadata.grid_y_letters
 
         ## This lets the user enter in the X and Y grid markers in the wrong order, and still tolerate it.
         ## Obviously, it's still a good idea to enter them in correctly. See y property as well.
 
-        ## Make sure x's ascii value is between 'a' and 'h's ascii values
-        if(ord('a') <= ord(x) <= ord('h')):
+        ## Make sure x is one of the map's X grid letters
+        if(x in x_letters):
             self._x = x
-        ## If it's less than 'a', then theres no hope, just clamp it to 'a'
-        elif(ord('a') > ord(x)):
-            self._x = 'a'
+        ## If it's before the first letter, then theres no hope, just clamp it to the first letter
+        elif(x < x_letters[0]):
+            self._x = x_letters[0]
         ## Otherwise see if y's setter can handle it without giving up.
         else:
             self._x = None
             self.valid = False
-            self.y = x
+            if(x in y_letters or x > y_letters[-1]):
+                self.y = x
 
 
     @property
@@ -66,15 +86,18 @@ class GridObject:
     @y.setter
     def y(self, value):
         y = value.lower()
+        x_letters = self.metadata.grid_x_letters
+        y_letters = self.metadata.grid_y_letters
 
-        if(ord('i') <= ord(y) <= ord('p')):
+        if(y in y_letters):
             self._y = y
-        elif(ord('p') < ord(y)):
-            self._y = 'p'
+        elif(y > y_letters[-1]):
+            self._y = y_letters[-1]
         else:
             self._y = None
             self.valid = False
-            self.x = y
+            if(y in x_letters or y < x_letters[0]):
+                self.x = y
 
 
     @property
@@ -85,55 +108,11 @@ class GridObject:
     @section.setter
     def section(self, value):
         section = int(value) if value else 0
-        if(1 <= section <= self.MAX_SECTIONS):
+        if(1 <= section <= self.metadata.grid_sections):
             self._section = section
         else:        
             self._section = None
 
-    ## Methods
-
-    def get_true_x(self, pixels_per_km):
-        ## True X calculated from the left side of the image
-
-        ## Sanity check to prevent garbage data from being used
-        if(not self.valid):
-            raise RuntimeError("Can't get true X distance without valid X: ({}).".format(self.x))
-
-        letter_index = ord(self.x) - ord('a')   ## Grid index = difference between grid marker's ascii value and a's ascii value
-
-        ## Calculate the pixel distance from the left of the screen, for a given letter's grid marker
-        grid_offset = letter_index * pixels_per_km
-        if(self.section is not None):
-            ## Determine the extra offset from the left if the user specified a sub section of the grid
-            max_section_sqrt = sqrt(self.MAX_SECTIONS)
-            section_index = self.section - 1    # 0 index the section index, it's [1-9] for users
-            section_offset = ((((section_index % max_section_sqrt) / max_section_sqrt) + (1 / (max_section_sqrt * 2))) * pixels_per_km)
-        else:
-            ## Otherwise, just assume that the plane travelled through the center of the grid
-            section_offset = pixels_per_km / 2
-
-        ## Return an integer value to avoid any rounding issues (plus, we're dealing with whole pixels anyway)
-        return int(grid_offset + section_offset)
-
-
-    def get_true_y(self, pixels_per_km):
-        ## True Y calculated from the top of the image. See get_true_x() above for comments
-
-        if(not self.valid):
-            raise RuntimeError("Can't get true Y distance without valid Y: ({}).".format(self.y))
-
-        letter_index = ord(self.y) - ord('i')
-
-        grid_offset = letter_index * pixels_per_km
-        if(self.section is not None):
-            max_section_sqrt = sqrt(self.MAX_SECTIONS)
-            section_index = self.section - 1    # 0 index the section index, it's [1-9] for users
-            section_offset = pixels_per_km - ((((section_index // max_section_sqrt) / max_section_sqrt) + (1 / (max_section_sqrt * 2))) * pixels_per_km)
-        else:
-            section_offset = pixels_per_km / 2
-
-        return int(grid_offset + section_offset)
-
 
 class HeadingObject:
     def __init__(self, heading):
@@ -159,35 +138,109 @@ class PathObject:
                             self.grid_obj.section,
                             self.heading_obj.heading )
 
+    ## Properties
+
+    @property
+    def paths(self):
+        return [self]
+
+
+class MultiPathObject:
+    ## Several paths that get plotted together onto the same map
+    def __init__(self, paths):
+        self.paths = paths
+
+
+    def __str__(self):
+        return ", ".join(str(path_obj) for path_obj in self.paths)
+
 
 class PathParser:
     ## Keys
     GRID_REGEX_PATTERN_KEY = "grid_regex_pattern"
     HEADING_REGEX_PATTERN_KEY = "heading_regex_pattern"
+    MAX_PATHS_KEY = "max_paths"
 
     ## Defaults
-    GRID_REGEX_PATTERN = CONFIG_OPTIONS.get(GRID_REGEX_PATTERN_KEY, r"([a-pA-P])([a-pA-P])([1-9]?)")
+    GRID_REGEX_PATTERN = CONFIG_OPTIONS.get(GRID_REGEX_PATTERN_KEY, None)
     HEADING_REGEX_PATTERN = CONFIG_OPTIONS.get(HEADING_REGEX_PATTERN_KEY, r"(\d{1,3})")
+    MAX_PATHS = CONFIG_OPTIONS.get(MAX_PATHS_KEY, 3)
 
 
     def __init__(self, **kwargs):
-        self.grid_regex = re.compile(kwargs.get(self.GRID_REGEX_PATTERN_KEY, self.GRID_REGEX_PATTERN))
+        self.max_paths = kwargs.get(self.MAX_PATHS_KEY, self.MAX_PATHS)
+        self.map_metadata = map_metadata.get_shared_map_metadata()
+
+        ## Unless it's been overridden, accept any of the letters that mark out a grid on any of the maps
+        grid_regex_pattern = kwargs.get(self.GRID_REGEX_PATTERN_KEY, self.GRID_REGEX_PATTERN)
+        if(not grid_regex_pattern):
+            letters = self.map_metadata.get_all_letters()
+            grid_regex_pattern = r"([{0}{1}])([{0}{1}])([1-9]?)".format(letters, letters.upper())
+
+        self.grid_regex = re.compile(grid_regex_pattern)
         self.heading_regex = re.compile(kwargs.get(self.HEADING_REGEX_PATTERN_KEY, self.HEADING_REGEX_PATTERN))
 
 
-    def parse_message(self, message):
+    def parse_message(self, message, map_name=None):
+        path_obj, message = self.parse_path(message, map_name)
+
+        ## Any more heading and grid marker pairs get plotted alongside the first one. Anything else that's trailing
+        ## along after the paths is ignored, just like it always has been.
+        path_objs = [path_obj]
+        while(True):
+            path_obj, message = self.parse_extra_path(message, map_name)
+            if(path_obj is None):
+                break
+
+            path_objs.append(path_obj)
+            if(len(path_objs) > self.max_paths):
+                raise RuntimeError("Can't plot more than {} paths at once".format(self.max_paths))
+
+        if(len(path_objs) == 1):
+            return path_objs[0]
+
+        return MultiPathObject(path_objs)
+
+
+    def parse_extra_path(self, message, map_name=None):
+        """
+        Parse the heading and grid marker pair that the message starts with, or return None for the path if it doesn't
+        start with one (ie. it's just trailing text, like '5 min ago' or '2nd plane'). Both the heading and the grid
+        marker have to be words of their own, and the grid marker has to come right after the heading.
+        """
+
+        message = message.lstrip()
+        heading_match = self.heading_regex.match(message)
+        if(not heading_match or not message[heading_match.end():heading_match.end() + 1].isspace()):
+            return None, message
+
+        grid_message = message[heading_match.end():].lstrip()
+        grid_match = self.grid_regex.match(grid_message)
+        if(not grid_match or grid_message[grid_match.end():grid_match.end() + 1].isalnum()):
+            return None, message
+
+        try:
+            start_grid, _ = self.parse_grid(grid_message[:grid_match.end()], map_name)
+        except RuntimeError:
+            return None, message
+
+        heading, _ = self.parse_heading(message[:heading_match.end()])
+        return PathObject(start_grid, heading), grid_message[grid_match.end():]
+
+
+    def parse_path(self, message, map_name=None):
         heading, message = self.parse_heading(message)
         if(not heading):
             raise RuntimeError("Invalid heading designation for '{}'".format(message))
 
-        start_grid, message = self.parse_grid(message)
+        start_grid, message = self.parse_grid(message, map_name)
         if(not start_grid):
             raise RuntimeError("Invalid grid marker for '{}'".format(message))
 
-        return PathObject(start_grid, heading)
+        return PathObject(start_grid, heading), message
 
 
-    def parse_grid(self, message):
+    def parse_grid(self, message, map_name=None):
         ## Basic regex string parsing, with errors popped on getting an unknown command
         ## Todo: implement re.IGNORECASE (not working for whatever reason?)
         match = self.grid_regex.search(message)
@@ -200,7 +253,7 @@ class PathParser:
 
             ## Todo: improve error output and handling
             if(x and y):
-                grid_obj = GridObject(x, y, section)
+                grid_obj = GridObject(x, y, section, self.map_metadata.get(map_name))
                 if(grid_obj.valid):
                     return grid_obj, message[match.end():]
             elif(y and not x):
@@ -231,9 +284,14 @@ class PathParser:
 class BotIO:
     ## Keys
     PLOT_COMMAND_HELP_KEY = "plot_command_help"
+    GUILD_RESOLUTION_TIERS_KEY = "guild_resolution_tiers"
+    ZOOM_RADIUS_KM_KEY = "zoom_radius_km"
 
     ## Defaults
     PLOT_COMMAND_HELP = CONFIG_OPTIONS.get(PLOT_COMMAND_HELP_KEY, "")
+    GUILD_RESOLUTION_TIERS = CONFIG_OPTIONS.get(GUILD_RESOLUTION_TIERS_KEY, {})
+    ZOOM_RADIUS_KM = CONFIG_OPTIONS.get(ZOOM_RADIUS_KM_KEY, 1.5)
+    ZOOM_REGEX_PATTERN = r"^zoom(\d?)$"
 
 
     def __init__(self, plane_pal, bot, **kwargs):
@@ -241,13 +299,41 @@ class BotIO:
         self.bot = bot
 
         self.plot_command_help = kwargs.get(self.PLOT_COMMAND_HELP_KEY, self.PLOT_COMMAND_HELP)
+        ## Maps a server's id onto the resolution tier that it'd like its maps in
+        self.guild_resolution_tiers = kwargs.get(self.GUILD_RESOLUTION_TIERS_KEY, self.GUILD_RESOLUTION_TIERS)
+        self.zoom_radius_km = kwargs.get(self.ZOOM_RADIUS_KM_KEY, self.ZOOM_RADIUS_KM)
+        self.zoom_regex = re.compile(self.ZOOM_REGEX_PATTERN)
 
         self.path_parser = PathParser()
         self.plotter = plotter.Plotter()
+        self.render_pool = render_pool.RenderPool(self.plotter, loop=self.bot.loop)
+        self.admission = admission.AdmissionController(loop=self.bot.loop)
         self.dynamo_db = dynamo_helper.DynamoHelper()
 
+        ## Fill the render cache with popular maps in the background, without holding up startup
+        self.cache_warmer = cache_warmer.CacheWarmer(self, loop=self.bot.loop)
+        self.cache_warm_task = None
+        if(self.cache_warmer.enabled):
+            self.cache_warm_task = self.bot.loop.create_task(self.cache_warmer.warm())
+
+        self.metrics = metrics.get_shared_metrics()
+        self.metrics.register_gauge_callback("render_pool_pending", lambda: self.render_pool.pending)
+        self.metrics.register_gauge_callback("admission_running", lambda: self.admission.running)
+        self.metrics.register_gauge_callback("admission_queued", lambda: self.admission.queued)
+        self.metrics.register_gauge_callback("render_cache_bytes", lambda: self.plotter.render_cache.size)
+        self.metrics.register_gauge_callback("base_map_bytes", lambda: self.plotter.file_controller.map_assets.get_size())
+        self.metrics.register_gauge_callback("dynamo_queue_depth", lambda: self.dynamo_db.queue.qsize())
+
     ## Methods
 
+    ## Invoked by discord.py when the cog gets removed (ex. during a cog reload)
+    def __unload(self):
+        if(self.cache_warm_task):
+            self.cache_warm_task.cancel()
+        self.render_pool.shutdown()
+        self.dynamo_db.shutdown(wait=False)
+
+
     async def say(self, *args, **kwargs):
         await self.bot.say(*args, **kwargs)
 
@@ -291,49 +377,165 @@ class BotIO:
             return True
 
 
+    async def upload_bytes(self, file_bytes, file_name, channel, content=None, callback=None):
+        ## Upload the in-memory image to the given channel, without ever touching the disk
+        try:
+            await self.bot.send_file(channel, io.BytesIO(file_bytes), filename=file_name, content=content)
+        except errors.HTTPException as e:
+            utilities.debug_print("Error uploading file: '{}'".format(file_name), e, debug_level=0)
+            await self.failed_upload_feedback(e)
+            return False
+
+        ## Call the callback function, provided it exists
+        if(callback):
+            return callback()
+        else:
+            return True
+
+
+    def _extract_render_options(self, ctx, message):
+        return self.parse_render_options(message, ctx.message.server.id)
+
+
+    def parse_render_options(self, message, server_id=None):
+        ## Pull the render options out of the message, so their letters can't be mistaken for a grid marker
+        render_options = plotter.RenderOptions()
+        words = []
+        for word in message.split():
+            zoom_match = self.zoom_regex.match(word.lower())
+            if(word.lower() in self.plotter.tier_base_maps):
+                render_options.tier = word.lower()
+            elif(zoom_match):
+                ## 'zoom' uses the default radius, and 'zoom3' zooms out to a 3km radius around the plane
+                radius = zoom_match.group(1)
+                render_options.zoom_radius_km = int(radius) if radius and int(radius) > 0 else self.zoom_radius_km
+            else:
+                words.append(word)
+
+        ## Fall back to the server's preferred tier (if any), otherwise the plotter will use its default
+        if(render_options.tier is None):
+            render_options.tier = self.guild_resolution_tiers.get(server_id)
+
+        return " ".join(words), render_options
+
+
     async def _plot(self, ctx, message, map_name):
         """Plots your given plane's path on the game map."""
 
+        ## Turn plots away up front when there's too much going on, rather than letting them pile up in memory
+        try:
+            async with self.admission.admit(ctx.message.server.id, ctx.message.author.id):
+                self.metrics.adjust_gauge("plots_in_flight", 1)
+                try:
+                    with self.metrics.timer("plot_seconds", {"map": map_name}):
+                        outcome = await self._plot_map(ctx, message, map_name)
+                finally:
+                    self.metrics.adjust_gauge("plots_in_flight", -1)
+        except admission.AdmissionRejectedError as e:
+            await self.failed_upload_feedback(self._build_rejection_message(e.reason))
+            self._record_outcome(map_name, "shed")
+            return False
+
+        return outcome
+
+
+    def _build_rejection_message(self, reason):
+        if(reason == "user_limit"):
+            return "you've already got maps on the way. Try again once they're done"
+        elif(reason == "guild_limit"):
+            return "this server already has a lot of maps on the way. Try again in a moment"
+        else:
+            return "I'm busy drawing other maps right now. Try again in a moment"
+
+
+    def _record_outcome(self, map_name, outcome):
+        self.metrics.increment("plots_total", {"map": map_name, "outcome": outcome})
+
+
+    async def _plot_map(self, ctx, message, map_name):
+        start = time.perf_counter()
+        path_message, render_options = self._extract_render_options(ctx, message)
+
         ## Parse the user's command
         try:
-            path_obj = self.path_parser.parse_message(message)
+            with self.metrics.timer("plot_stage_seconds", {"stage": "parse"}):
+                path_obj = self.path_parser.parse_message(path_message, map_name)
         except RuntimeError as e:
             ## Give them some feedback if the command isn't understandable
             await self.failed_command_feedback(e)
+            self._record_outcome(map_name, "invalid_query")
 
             ## Put some information about the failed query into the database
-            self.dynamo_db.put(dynamo_helper.DynamoItem(
-                ctx.message.author.id,
-                ctx.message.timestamp.timestamp(),
-                ctx.message.channel.name,
-                ctx.message.server.name,
-                map_name,
-                message,
-                None
-            ))
+            with self.metrics.timer("plot_stage_seconds", {"stage": "analytics"}):
+                self.dynamo_db.put(dynamo_helper.DynamoItem(
+                    ctx.message.author.id,
+                    ctx.message.timestamp.timestamp(),
+                    ctx.message.channel.name,
+                    ctx.message.server.name,
+                    map_name,
+                    message,
+                    None
+                ))
             return None
-        else:
-            ## Put some information about the successful query into the database
-            self.dynamo_db.put(dynamo_helper.DynamoItem(
-                ctx.message.author.id,
-                ctx.message.timestamp.timestamp(),
-                ctx.message.channel.name,
-                ctx.message.server.name,
-                map_name,
-                message,
-                str(path_obj)
-            ))
-
-        ## Get the file path for the final map image, and generate a callback to delete the image
-        plotted_map = self.plotter.plot_plane_path(map_name, path_obj)
-        map_path = self.plotter.file_controller.save_map(plotted_map)
-        delete_map_callback = self.plotter.file_controller.create_delete_map_callback(map_path)
-
-        ## Upload the file to the user's channel in Discord.
-        return await self.upload_file(  map_path,
-                                        ctx.message.channel,
-                                        content="Here you go, <@{}>. Good luck!".format(ctx.message.author.id),
-                                        callback=delete_map_callback )
+
+        try:
+            return await self._draw_map(ctx, map_name, path_obj, render_options)
+        finally:
+            ## Put some information about the successful query (and how long it took to handle) into the database
+            with self.metrics.timer("plot_stage_seconds", {"stage": "analytics"}):
+                self.dynamo_db.put(dynamo_helper.DynamoItem(
+                    ctx.message.author.id,
+                    ctx.message.timestamp.timestamp(),
+                    ctx.message.channel.name,
+                    ctx.message.server.name,
+                    map_name,
+                    message,
+                    str(path_obj),
+                    time.perf_counter() - start
+                ))
+
+
+    async def _draw_map(self, ctx, map_name, path_obj, render_options):
+        ## Draw the map outside of the event loop, so other commands don't have to wait on it
+        try:
+            with self.metrics.timer("plot_stage_seconds", {"stage": "render"}):
+                map_bytes, map_path = await self.render_pool.render(map_name, path_obj, render_options)
+        except render_pool.RenderPoolFullError:
+            await self.failed_upload_feedback("I'm busy drawing other maps right now. Try again in a moment")
+            self._record_outcome(map_name, "busy")
+            return False
+        except asyncio.TimeoutError:
+            await self.failed_upload_feedback("your map took too long to draw")
+            self._record_outcome(map_name, "timeout")
+            return False
+        except (sharding.RenderWorkerError, render_server.RenderServerError) as e:
+            utilities.debug_print("Error drawing map for: '{}'.".format(path_obj), e, debug_level=1)
+            await self.failed_upload_feedback("something went wrong while drawing it")
+            self._record_outcome(map_name, "error")
+            return False
+
+        content = "Here you go, <@{}>. Good luck!".format(ctx.message.author.id)
+
+        ## The render pool optionally keeps the map in the output store on disk, which is handy for debugging the output,
+        ## in which case it's uploaded from there. The stored file is shared with any identical renders, so it's left for
+        ## the store to clean up.
+        file_controller = self.plotter.file_controller
+
+        with self.metrics.timer("plot_stage_seconds", {"stage": "upload"}):
+            if(map_path):
+                ## Upload the file to the user's channel in Discord.
+                uploaded = await self.upload_file(  map_path,
+                                                    ctx.message.channel,
+                                                    content=content )
+            else:
+                ## Otherwise, upload the encoded map straight from memory
+                uploaded = await self.upload_bytes( map_bytes,
+                                                    file_controller.build_upload_file_name(map_name),
+                                                    ctx.message.channel,
+                                                    content=content )
+
+        self._record_outcome(map_name, "success" if uploaded else "upload_failed")
+        return uploaded
 
     ## Commands
 
@@ -0,0 +1,187 @@
+import os
+import csv
+import json
+import time
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import utilities
+import metrics
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+
+class CacheWarmer:
+    """
+    Pre-renders the most popular queries from a history export (JSONL or CSV of DynamoItem records), so they're already
+    cached when the bot comes back up. It runs in the background on a single thread, backs off whenever there are live
+    plots being drawn, and only uses a slice of the CPU.
+    """
+
+    ## Keys
+    CACHE_WARM_ENABLE_KEY = "cache_warm_enable"
+    CACHE_WARM_HISTORY_FILE_PATH_KEY = "cache_warm_history_file_path"
+    CACHE_WARM_TOP_N_KEY = "cache_warm_top_n"
+    CACHE_WARM_CPU_BUDGET_KEY = "cache_warm_cpu_budget"
+    CACHE_WARM_MAX_SECONDS_KEY = "cache_warm_max_seconds"
+
+    ## Defaults
+    CACHE_WARM_ENABLE = CONFIG_OPTIONS.get(CACHE_WARM_ENABLE_KEY, False)
+    CACHE_WARM_HISTORY_FILE_PATH = CONFIG_OPTIONS.get(CACHE_WARM_HISTORY_FILE_PATH_KEY, None)
+    CACHE_WARM_TOP_N = CONFIG_OPTIONS.get(CACHE_WARM_TOP_N_KEY, 100)
+    CACHE_WARM_CPU_BUDGET = CONFIG_OPTIONS.get(CACHE_WARM_CPU_BUDGET_KEY, 0.25)
+    CACHE_WARM_MAX_SECONDS = CONFIG_OPTIONS.get(CACHE_WARM_MAX_SECONDS_KEY, 300)
+    ## How long to wait before checking again, when live plots are being drawn
+    BUSY_POLL_SECONDS = 0.5
+
+
+    def __init__(self, bot_io, loop=None, **kwargs):
+        self.bot_io = bot_io
+        self.plotter = bot_io.plotter
+        self.loop = loop
+
+        self.enabled = kwargs.get(self.CACHE_WARM_ENABLE_KEY, self.CACHE_WARM_ENABLE)
+        self.history_file_path = kwargs.get(self.CACHE_WARM_HISTORY_FILE_PATH_KEY, self.CACHE_WARM_HISTORY_FILE_PATH)
+        self.top_n = kwargs.get(self.CACHE_WARM_TOP_N_KEY, self.CACHE_WARM_TOP_N)
+        ## Fraction of a single core that the warm up is allowed to keep busy
+        self.cpu_budget = kwargs.get(self.CACHE_WARM_CPU_BUDGET_KEY, self.CACHE_WARM_CPU_BUDGET)
+        if(self.enabled and not 0 < self.cpu_budget <= 1):
+            raise RuntimeError("The cache warm up's CPU budget must be greater than 0, and at most 1 (got {})".format(self.cpu_budget))
+        self.max_seconds = kwargs.get(self.CACHE_WARM_MAX_SECONDS_KEY, self.CACHE_WARM_MAX_SECONDS)
+
+        self.target = 0
+        self.filled = 0
+        self.rendered = 0
+        self.metrics = metrics.get_shared_metrics()
+
+        self._executor = None
+
+    ## Methods
+
+    def _get_loop(self):
+        return self.loop if self.loop else asyncio.get_event_loop()
+
+
+    def _read_records(self):
+        if(self.history_file_path.lower().endswith(".csv")):
+            with open(self.history_file_path, newline="") as fd:
+                for record in csv.DictReader(fd):
+                    yield record
+        else:
+            with open(self.history_file_path) as fd:
+                for line in fd:
+                    if(line.strip()):
+                        yield json.loads(line)
+
+
+    def load_popular_renders(self):
+        """
+        Rank the renders in the query history by how often they were asked for, and return the top N as a list of
+        (map name, path object, render options) tuples.
+        """
+
+        counts = Counter()
+        renders = {}
+        ## Lots of people send the exact same query, so there's no need to parse it again every time
+        parsed_queries = {}
+
+        for record in self._read_records():
+            map_name = record.get("map_name")
+            raw_query = record.get("raw_query")
+            ## Queries that couldn't be parsed the first time around don't have a parsed_query
+            if(not record.get("parsed_query") or map_name not in self.plotter.base_maps or not raw_query):
+                continue
+
+            query = (map_name, raw_query)
+            if(query not in parsed_queries):
+                try:
+                    path_message, render_options = self.bot_io.parse_render_options(raw_query)
+                    path_obj = self.bot_io.path_parser.parse_message(path_message, map_name)
+                except RuntimeError:
+                    parsed_queries[query] = None
+                else:
+                    render_key = self.plotter.build_render_key(map_name, path_obj, render_options)
+                    renders.setdefault(render_key, (map_name, path_obj, render_options))
+                    parsed_queries[query] = render_key
+
+            render_key = parsed_queries[query]
+            if(render_key is not None):
+                counts[render_key] += 1
+
+        return [renders[render_key] for render_key, count in counts.most_common(self.top_n)]
+
+
+    def _is_busy(self):
+        return self.bot_io.admission.running > 0 or self.bot_io.render_pool.pending > 0
+
+
+    async def warm(self):
+        if(not self.enabled or not self.history_file_path):
+            return 0
+
+        if(not os.path.isfile(self.history_file_path)):
+            utilities.debug_print("No query history found at: '{}', skipping cache warm up.".format(self.history_file_path), debug_level=1)
+            return 0
+
+        start = time.perf_counter()
+        loop = self._get_loop()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            try:
+                popular_renders = await loop.run_in_executor(self._executor, self.load_popular_renders)
+            except (OSError, ValueError) as e:
+                utilities.debug_print("Unable to read query history from: '{}'.".format(self.history_file_path), e, debug_level=1)
+                return 0
+
+            self.target = len(popular_renders)
+            self.metrics.set_gauge("cache_warm_target", self.target)
+
+            for map_name, path_obj, render_options in popular_renders:
+                ## Live plots always come first
+                while(self._is_busy()):
+                    await asyncio.sleep(self.BUSY_POLL_SECONDS)
+
+                if(time.perf_counter() - start > self.max_seconds):
+                    break
+
+                ## Looking the render up might mean reading it back out of the output store, so that's kept off of the
+                ## event loop too
+                render_key = self.plotter.build_render_key(map_name, path_obj, render_options)
+                cached_render = await loop.run_in_executor(self._executor, self.plotter.get_cached_render, render_key)
+                if(cached_render is None):
+                    render_start = time.perf_counter()
+                    try:
+                        await loop.run_in_executor(self._executor, self.plotter.render_map, map_name, path_obj, render_options)
+                    except Exception as e:
+                        utilities.debug_print("Error warming render: {}".format(render_key), e, debug_level=2)
+                        continue
+                    render_seconds = time.perf_counter() - render_start
+                    self.rendered += 1
+
+                    ## Sit idle long enough to keep the warm up's share of the CPU within its budget
+                    await asyncio.sleep(render_seconds * (1 / self.cpu_budget - 1))
+
+                self.filled += 1
+                self.metrics.set_gauge("cache_warm_filled", self.filled)
+        finally:
+            self._executor.shutdown(wait=False)
+
+        utilities.debug_print("Cache warm up filled {}/{} renders ({} drawn) in {:.1f}s.".format(
+            self.filled,
+            self.target,
+            self.rendered,
+            time.perf_counter() - start
+        ), debug_level=2)
+
+        return self.filled
+
+
+    def get_stats(self):
+        return {
+            "target": self.target,
+            "filled": self.filled,
+            "rendered": self.rendered,
+            "fill_ratio": (self.filled / self.target) if self.target else None
+        }
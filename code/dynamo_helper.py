@@ -1,14 +1,19 @@
-import boto3
-import base64
+import os
+import json
 import time
+import queue
+import base64
+import sqlite3
+import threading
 
 import utilities
+import metrics
 
 ## Config
 CONFIG_OPTIONS = utilities.load_config()
 
 class DynamoItem:
-    def __init__(self, user, timestamp, channel, server, map_name, raw_query, parsed_query):
+    def __init__(self, user, timestamp, channel, server, map_name, raw_query, parsed_query, latency=None):
         self.user = int(user)
         self.timestamp = int(timestamp * 1000)
         self.channel = channel
@@ -16,6 +21,8 @@ class DynamoItem:
         self.map_name = map_name
         self.raw_query = raw_query
         self.parsed_query = parsed_query
+        ## Seconds from receiving the command to finishing with it, if it was timed
+        self.latency = latency
 
         self.primary_key_name = CONFIG_OPTIONS.get("boto_primary_key", "QueryId")
         self.primary_key = self.build_primary_key()
@@ -32,6 +39,9 @@ class DynamoItem:
             "raw_query": self.raw_query,
             "parsed_query": self.parsed_query
         }
+        ## DynamoDB doesn't take floats, so stick to whole milliseconds
+        if(self.latency is not None):
+            output["latency_ms"] = int(self.latency * 1000)
         output[self.primary_key_name] = self.primary_key
 
         return output
@@ -41,7 +51,204 @@ class DynamoItem:
         concatenated = "{}{}".format(self.user, self.timestamp)
 
         return base64.b64encode(bytes(concatenated, "utf-8")).decode("utf-8")
-    
+
+
+class LocalBatchWriter:
+    def __init__(self, table):
+        self.table = table
+        self.items = []
+
+    ## Methods
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        ## Mimic boto3, which sends off whatever is left in the batch when the context closes
+        if(exc_type is None):
+            self.table.write_batch(self.items)
+
+        return False
+
+
+    def put_item(self, Item):
+        self.items.append(Item)
+
+
+class LocalTable:
+    """
+    In-process stand-in for a boto3 DynamoDB Table, for running the analytics without AWS.
+    """
+
+    def __init__(self, fail_writes=False):
+        self.items = []
+        self.batches = 0
+        self.fail_writes = fail_writes
+        self._lock = threading.Lock()
+
+    ## Methods
+
+    def write_batch(self, items):
+        if(self.fail_writes):
+            raise RuntimeError("Local table is rejecting writes")
+
+        with self._lock:
+            self.items.extend(items)
+            self.batches += 1
+
+
+    def put_item(self, Item):
+        self.write_batch([Item])
+
+
+    def batch_writer(self):
+        return LocalBatchWriter(self)
+
+
+class SqliteTable:
+    """
+    Local, file backed stand-in for the DynamoDB Table, which also answers the aggregate questions that we usually ask
+    of the analytics. Every aggregate is backed by an index, so none of them need to scan the whole table.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS queries (
+            query_id TEXT PRIMARY KEY,
+            user INTEGER,
+            timestamp INTEGER,
+            hour INTEGER,
+            channel TEXT,
+            server TEXT,
+            map_name TEXT,
+            raw_query TEXT,
+            parsed_query TEXT,
+            success INTEGER,
+            grid TEXT,
+            heading INTEGER,
+            latency_ms INTEGER
+        )""",
+        ## The per hour counts filter on a range of hours first, which an index that starts with the map name can't help
+        "DROP INDEX IF EXISTS queries_map_hour",
+        "CREATE INDEX IF NOT EXISTS queries_hour_map ON queries (hour, map_name)",
+        "CREATE INDEX IF NOT EXISTS queries_success ON queries (success)",
+        "CREATE INDEX IF NOT EXISTS queries_grid ON queries (success, grid)",
+        "CREATE INDEX IF NOT EXISTS queries_heading ON queries (success, heading)",
+        "CREATE INDEX IF NOT EXISTS queries_latency ON queries (latency_ms)"
+    ]
+
+
+    def __init__(self, file_path, primary_key_name="QueryId"):
+        self.file_path = file_path
+        self.primary_key_name = primary_key_name
+
+        ## Writes come from the DynamoHelper's writer thread, and reads from wherever the aggregates are wanted
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.file_path, check_same_thread=False)
+        with self._lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            for statement in self.SCHEMA:
+                self.connection.execute(statement)
+
+    ## Methods
+
+    def _build_row(self, item):
+        ## Break the parsed query (see PathObject.__str__) back out into columns that can be indexed. Queries with
+        ## several paths (see MultiPathObject.__str__) are indexed by their first one
+        parsed_query = item.get("parsed_query")
+        grid = None
+        heading = None
+        if(parsed_query):
+            x, y, section, heading = parsed_query.split(",")[0].split()
+            grid = "{}{}{}".format(x, y, section if section != "None" else "")
+            heading = int(heading)
+
+        return (
+            item.get(self.primary_key_name),
+            item.get("user"),
+            item.get("timestamp"),
+            item.get("timestamp", 0) // (60 * 60 * 1000),
+            item.get("channel"),
+            item.get("server"),
+            item.get("map_name"),
+            item.get("raw_query"),
+            parsed_query,
+            1 if parsed_query else 0,
+            grid,
+            heading,
+            item.get("latency_ms")
+        )
+
+
+    def write_batch(self, items):
+        rows = [self._build_row(item) for item in items]
+        with self._lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO queries VALUES ({})".format(",".join(["?"] * 13)), rows)
+
+
+    def put_item(self, Item):
+        self.write_batch([Item])
+
+
+    def batch_writer(self):
+        return LocalBatchWriter(self)
+
+
+    def _query(self, statement, parameters=()):
+        with self._lock:
+            return self.connection.execute(statement, parameters).fetchall()
+
+
+    def get_commands_per_map_per_hour(self, since=None):
+        ## Returns a list of (map name, hour, count) tuples, where the hour is given as a unix timestamp
+        since_hour = int(since // (60 * 60)) if since else 0
+        rows = self._query(
+            "SELECT map_name, hour, COUNT(*) FROM queries WHERE hour >= ? GROUP BY map_name, hour ORDER BY map_name, hour",
+            (since_hour,)
+        )
+
+        return [(map_name, hour * 60 * 60, count) for map_name, hour, count in rows]
+
+
+    def get_parse_failure_rate(self):
+        counts = dict(self._query("SELECT success, COUNT(*) FROM queries GROUP BY success"))
+        total = sum(counts.values())
+
+        return (counts.get(0, 0) / total) if total else None
+
+
+    def get_top_grids(self, limit=10):
+        return self._query(
+            "SELECT grid, COUNT(*) AS count FROM queries WHERE success = 1 GROUP BY grid ORDER BY count DESC LIMIT ?",
+            (limit,)
+        )
+
+
+    def get_top_headings(self, limit=10):
+        return self._query(
+            "SELECT heading, COUNT(*) AS count FROM queries WHERE success = 1 GROUP BY heading ORDER BY count DESC LIMIT ?",
+            (limit,)
+        )
+
+
+    def get_latency_percentile(self, percentile=0.95):
+        ## Walks the latency index straight to the right row, rather than sorting every timing
+        count = self._query("SELECT COUNT(latency_ms) FROM queries WHERE latency_ms IS NOT NULL")[0][0]
+        if(not count):
+            return None
+
+        rows = self._query(
+            "SELECT latency_ms FROM queries WHERE latency_ms IS NOT NULL ORDER BY latency_ms LIMIT 1 OFFSET ?",
+            (min(count - 1, int(percentile * count)),)
+        )
+
+        return rows[0][0]
+
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
 
 class DynamoHelper:
     ## Keys
@@ -49,12 +256,41 @@ class DynamoHelper:
     BOTO_RESOURCE_KEY = "boto_resource"
     BOTO_REGION_NAME_KEY = "boto_region_name"
     BOTO_TABLE_NAME_KEY = "boto_table_name"
+    BOTO_PRIMARY_KEY_KEY = "boto_primary_key"
+    BOTO_BATCH_SIZE_KEY = "boto_batch_size"
+    BOTO_FLUSH_INTERVAL_SECONDS_KEY = "boto_flush_interval_seconds"
+    BOTO_MAX_QUEUED_KEY = "boto_max_queued"
+    BOTO_FLUSH_RETRIES_KEY = "boto_flush_retries"
+    BOTO_RETRY_BACKOFF_SECONDS_KEY = "boto_retry_backoff_seconds"
+    BOTO_SPOOL_FILE_KEY = "boto_spool_file"
+    BOTO_SPOOL_FILE_PATH_KEY = "boto_spool_file_path"
+    ANALYTICS_SINK_KEY = "analytics_sink"
+    ANALYTICS_SQLITE_ENABLE_KEY = "analytics_sqlite_enable"
+    ANALYTICS_SQLITE_FILE_KEY = "analytics_sqlite_file"
+    ANALYTICS_SQLITE_FILE_PATH_KEY = "analytics_sqlite_file_path"
+    TABLE_KEY = "table"
 
     ## Defaults
     BOTO_ENABLE = CONFIG_OPTIONS.get(BOTO_ENABLE_KEY, False)
     BOTO_RESOURCE = CONFIG_OPTIONS.get(BOTO_RESOURCE_KEY, "dynamodb")
     BOTO_REGION_NAME = CONFIG_OPTIONS.get(BOTO_REGION_NAME_KEY, "us-east-2")
     BOTO_TABLE_NAME = CONFIG_OPTIONS.get(BOTO_TABLE_NAME_KEY, "PlanePal")
+    BOTO_PRIMARY_KEY = CONFIG_OPTIONS.get(BOTO_PRIMARY_KEY_KEY, "QueryId")
+    BOTO_BATCH_SIZE = CONFIG_OPTIONS.get(BOTO_BATCH_SIZE_KEY, 25)   # DynamoDB's limit for a single batch write
+    BOTO_FLUSH_INTERVAL_SECONDS = CONFIG_OPTIONS.get(BOTO_FLUSH_INTERVAL_SECONDS_KEY, 5)
+    BOTO_MAX_QUEUED = CONFIG_OPTIONS.get(BOTO_MAX_QUEUED_KEY, 1000)
+    BOTO_FLUSH_RETRIES = CONFIG_OPTIONS.get(BOTO_FLUSH_RETRIES_KEY, 3)
+    BOTO_RETRY_BACKOFF_SECONDS = CONFIG_OPTIONS.get(BOTO_RETRY_BACKOFF_SECONDS_KEY, 0.5)
+    BOTO_SPOOL_FILE = CONFIG_OPTIONS.get(BOTO_SPOOL_FILE_KEY, "analytics_spool.jsonl")
+    BOTO_SPOOL_FILE_PATH = CONFIG_OPTIONS.get(BOTO_SPOOL_FILE_PATH_KEY, os.sep.join([utilities.get_root_path(), BOTO_SPOOL_FILE]))
+    ANALYTICS_SINK = CONFIG_OPTIONS.get(ANALYTICS_SINK_KEY, "dynamo")
+    ANALYTICS_SQLITE_ENABLE = CONFIG_OPTIONS.get(ANALYTICS_SQLITE_ENABLE_KEY, False)
+    ANALYTICS_SQLITE_FILE = CONFIG_OPTIONS.get(ANALYTICS_SQLITE_FILE_KEY, "analytics.sqlite3")
+    ANALYTICS_SQLITE_FILE_PATH = CONFIG_OPTIONS.get(ANALYTICS_SQLITE_FILE_PATH_KEY, os.sep.join([utilities.get_root_path(), ANALYTICS_SQLITE_FILE]))
+
+    ## Sinks
+    DYNAMO_SINK = "dynamo"
+    SQLITE_SINK = "sqlite"
 
 
     def __init__(self, **kwargs):
@@ -62,19 +298,216 @@ class DynamoHelper:
         self.resource = kwargs.get(self.BOTO_RESOURCE_KEY, self.BOTO_RESOURCE)
         self.region_name = kwargs.get(self.BOTO_REGION_NAME_KEY, self.BOTO_REGION_NAME)
         self.table_name = kwargs.get(self.BOTO_TABLE_NAME_KEY, self.BOTO_TABLE_NAME)
+        self.primary_key_name = kwargs.get(self.BOTO_PRIMARY_KEY_KEY, self.BOTO_PRIMARY_KEY)
+        self.batch_size = kwargs.get(self.BOTO_BATCH_SIZE_KEY, self.BOTO_BATCH_SIZE)
+        self.flush_interval = kwargs.get(self.BOTO_FLUSH_INTERVAL_SECONDS_KEY, self.BOTO_FLUSH_INTERVAL_SECONDS)
+        self.max_queued = kwargs.get(self.BOTO_MAX_QUEUED_KEY, self.BOTO_MAX_QUEUED)
+        self.flush_retries = kwargs.get(self.BOTO_FLUSH_RETRIES_KEY, self.BOTO_FLUSH_RETRIES)
+        self.retry_backoff = kwargs.get(self.BOTO_RETRY_BACKOFF_SECONDS_KEY, self.BOTO_RETRY_BACKOFF_SECONDS)
+        self.spool_file_path = kwargs.get(self.BOTO_SPOOL_FILE_PATH_KEY, self.BOTO_SPOOL_FILE_PATH)
+        self.sink = kwargs.get(self.ANALYTICS_SINK_KEY, self.ANALYTICS_SINK)
+        self.sqlite_enabled = kwargs.get(self.ANALYTICS_SQLITE_ENABLE_KEY, self.ANALYTICS_SQLITE_ENABLE)
+        self.sqlite_file_path = kwargs.get(self.ANALYTICS_SQLITE_FILE_PATH_KEY, self.ANALYTICS_SQLITE_FILE_PATH)
 
-        self.dynamo_db = boto3.resource(self.resource, region_name=self.region_name)
-        self.table = self.dynamo_db.Table(self.table_name)
+        ## A table can be passed in directly (ex. a LocalTable), otherwise build the configured sink. Each sink has its
+        ## own switch, so the local SQLite sink can be used without turning on boto.
+        self.table = kwargs.get(self.TABLE_KEY)
+        if(self.table is None):
+            if(self.sink == self.SQLITE_SINK):
+                if(self.sqlite_enabled):
+                    self.table = SqliteTable(self.sqlite_file_path, self.primary_key_name)
+            elif(self.sink == self.DYNAMO_SINK):
+                if(self.enabled):
+                    self.table = self._build_boto_table()
+            else:
+                raise RuntimeError("Unknown analytics sink '{}'".format(self.sink))
+            self.enabled = self.table is not None
+
+        ## Metrics
+        self.flushed = 0
+        self.failed_flushes = 0
+        self.spooled = 0
+        self.dropped = 0
+        self.last_flush_latency = None
+        self.total_flush_latency = 0.0
+        self.flush_count = 0
+
+        ## Items are written out in batches by a background thread, so put() never waits on the network
+        self.queue = queue.Queue(maxsize=self.max_queued)
+        self._stop_event = threading.Event()
+        self._spool_lock = threading.Lock()
+        self.metrics = metrics.get_shared_metrics()
+        self._worker = None
+        if(self.enabled):
+            self._worker = threading.Thread(target=self._run_worker, name="DynamoHelperWriter", daemon=True)
+            self._worker.start()
 
     ## Methods
 
+    def _build_boto_table(self):
+        ## boto3 is slow to import, so it's only pulled in when the analytics are actually enabled
+        try:
+            import boto3
+        except ImportError as e:
+            utilities.debug_print("boto3 isn't installed, disabling analytics.", e, debug_level=0)
+            return None
+
+        self.dynamo_db = boto3.resource(self.resource, region_name=self.region_name)
+        return self.dynamo_db.Table(self.table_name)
+
+
     def put(self, dynamo_item):
-        if(self.enabled):
+        if(not self.enabled):
+            return None
+
+        with self.metrics.timer("dynamo_put_seconds"):
+            try:
+                self.queue.put_nowait(dynamo_item.getDict())
+            except queue.Full:
+                ## Don't hold up the caller if the writer has fallen behind, just drop the item
+                self.dropped += 1
+                self.metrics.increment("dynamo_items_total", {"outcome": "dropped"})
+                utilities.debug_print("Dynamo write queue is full, dropping item.", debug_level=2)
+                return False
+
+        return True
+
+
+    def _get_batch(self):
+        ## Block until either the batch is full, or the flush interval has passed since the first item arrived
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+
+        deadline = time.time() + self.flush_interval
+        while(len(batch) < self.batch_size):
+            remaining = deadline - time.time()
+            if(remaining <= 0 or self._stop_event.is_set()):
+                break
+
             try:
-                return self.table.put_item(Item=dynamo_item.getDict())
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+
+    def _run_worker(self):
+        while(not self._stop_event.is_set()):
+            batch = self._get_batch()
+            if(batch):
+                self.flush(batch)
+
+        ## Write out anything that was still waiting when the helper was shut down
+        self.flush_queue()
+
+
+    def _write_batch(self, items):
+        with self.table.batch_writer() as batch_writer:
+            for item in items:
+                batch_writer.put_item(Item=item)
+
+
+    def flush(self, items):
+        """
+        Write the given items to the table, retrying with backoff and spooling them to disk if the table is down.
+        """
+
+        start = time.time()
+        for attempt in range(self.flush_retries + 1):
+            try:
+                self._write_batch(items)
             except Exception as e:
                 ## Don't let issues with dynamo tank the bot's functionality
-                utilities.debug_print("Exception while performing dynamo put", e, debug_level=1)
-                return None
-        else:
-            return None
+                utilities.debug_print("Exception while performing dynamo batch write (attempt {})".format(attempt + 1), e, debug_level=1)
+                if(attempt < self.flush_retries):
+                    time.sleep(self.retry_backoff * pow(2, attempt))
+            else:
+                self.last_flush_latency = time.time() - start
+                self.total_flush_latency += self.last_flush_latency
+                self.flush_count += 1
+                self.flushed += len(items)
+                self.metrics.observe("dynamo_flush_seconds", self.last_flush_latency)
+                self.metrics.increment("dynamo_items_total", {"outcome": "flushed"}, len(items))
+
+                ## The table is reachable again, so try to catch up on anything that was spooled earlier
+                self._drain_spool()
+                return True
+
+        self.failed_flushes += 1
+        self.metrics.increment("dynamo_items_total", {"outcome": "spooled"}, len(items))
+        self._spool(items)
+        return False
+
+
+    def flush_queue(self):
+        items = []
+        while(True):
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        for index in range(0, len(items), self.batch_size):
+            self.flush(items[index:index + self.batch_size])
+
+
+    def _spool(self, items):
+        with self._spool_lock:
+            try:
+                with open(self.spool_file_path, "a") as fd:
+                    for item in items:
+                        fd.write(json.dumps(item) + "\n")
+            except IOError as e:
+                utilities.debug_print("Unable to spool dynamo items to: '{}'.".format(self.spool_file_path), e, debug_level=0)
+                self.dropped += len(items)
+            else:
+                self.spooled += len(items)
+
+
+    def _drain_spool(self):
+        with self._spool_lock:
+            if(not os.path.isfile(self.spool_file_path)):
+                return
+
+            try:
+                with open(self.spool_file_path) as fd:
+                    items = [json.loads(line) for line in fd if line.strip()]
+                os.remove(self.spool_file_path)
+            except (IOError, ValueError) as e:
+                utilities.debug_print("Unable to read spooled dynamo items from: '{}'.".format(self.spool_file_path), e, debug_level=1)
+                return
+
+        ## Anything that fails to write again will just be spooled again
+        for index in range(0, len(items), self.batch_size):
+            batch = items[index:index + self.batch_size]
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                utilities.debug_print("Exception while writing spooled dynamo items", e, debug_level=1)
+                self._spool(batch)
+            else:
+                self.flushed += len(batch)
+
+
+    def get_stats(self):
+        return {
+            "enabled": self.enabled,
+            "queue_depth": self.queue.qsize(),
+            "flushed": self.flushed,
+            "failed_flushes": self.failed_flushes,
+            "spooled": self.spooled,
+            "dropped": self.dropped,
+            "last_flush_latency": self.last_flush_latency,
+            "mean_flush_latency": (self.total_flush_latency / self.flush_count) if self.flush_count else None
+        }
+
+
+    def shutdown(self, wait=True):
+        ## Stop the writer thread, after it's written out everything that's queued up
+        self._stop_event.set()
+        if(wait and self._worker is not None):
+            self._worker.join()
@@ -29,7 +29,7 @@ class ExampleGenerator:
         self.plotter.file_controller._init_dir()    # Clean up the examples dir
 
         for map_name, message in EXAMPLES:
-            path_obj = self.path_parser.parse_message(message)
+            path_obj = self.path_parser.parse_message(message, map_name)
             plotted_map = self.plotter.plot_plane_path(map_name, path_obj)
             plotted_map = plotted_map.resize(EXAMPLE_SIZE, EXAMPLE_RESIZE_FILTER)
             self.plotter.file_controller.save_map(plotted_map, "{} {}.{}".format(map_name, message, self.plotter.file_controller.map_file_extension))
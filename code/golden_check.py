@@ -0,0 +1,413 @@
+import os
+import sys
+import json
+import time
+import ctypes
+import argparse
+import tracemalloc
+from PIL import Image, ImageChops, ImageDraw
+
+import utilities
+import plotter
+import bot_io
+import example_generator
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+## The matrix of paths that gets plotted on every map, covering the corners, edges, center, and sections of the grid
+GOLDEN_HEADINGS = [0, 45, 90, 137, 200, 315]
+GOLDEN_GRIDS = ["ai", "hp", "ap", "hi", "dl5", "ak1", "gp7", "em9"]
+## The canonical examples also get plotted on every resolution tier, and zoomed in
+GOLDEN_ZOOM_RADIUS_KM = 2
+## Several paths plotted together, both full size and zoomed in around all of them
+GOLDEN_MULTI_PATHS = ["90 ak1 180 dl5", "45 cl5 300 el5 135 dn5"]
+## Trailing chatter that only looks like another path, which should plot just the first one
+GOLDEN_TRAILING_CHATTER = ["90 ak1 5 min ago", "90 ak1 2nd plane"]
+## Plotting onto a flat canvas keeps the golden images small and makes every band's color and edge exact
+CANVAS_COLOR = (128, 128, 128)
+
+
+class GoldenCase:
+    def __init__(self, map_name, message, tier=None, zoom_radius_km=None):
+        self.map_name = map_name
+        self.message = message
+        self.tier = tier
+        self.zoom_radius_km = zoom_radius_km
+
+    ## Properties
+
+    @property
+    def name(self):
+        variant = "zoom {}".format(self.zoom_radius_km) if self.zoom_radius_km else self.tier
+        return "{} {} {}".format(self.map_name, self.message, variant)
+
+    ## Methods
+
+    def build_render_options(self):
+        return plotter.RenderOptions(tier=self.tier, zoom_radius_km=self.zoom_radius_km)
+
+
+class GoldenCheck:
+    """
+    Guards the plotter against regressions. Every case in the matrix is plotted onto a flat canvas and compared against
+    its stored golden image (so any shift in the path or the band widths shows up), checked to leave the rest of the
+    real base map untouched, and timed and measured against the render time and memory budgets.
+
+    Golden render times are stored alongside the time that a fixed reference workload took on the same machine, so the
+    slowdown check compares against what the golden timings would've been on the machine that's running the check. A
+    single render only takes a few milliseconds, so the slowdown is checked over the total of every case's render time,
+    rather than case by case.
+    """
+
+    ## Keys
+    GOLDEN_FOLDER_PATH_KEY = "golden_folder_path"
+    GOLDEN_PIXEL_TOLERANCE_KEY = "golden_pixel_tolerance"
+    GOLDEN_MAX_MISMATCH_FRACTION_KEY = "golden_max_mismatch_fraction"
+    GOLDEN_TIME_BUDGET_MS_KEY = "golden_time_budget_ms"
+    GOLDEN_MEMORY_BUDGET_MB_KEY = "golden_memory_budget_mb"
+    GOLDEN_MAX_SLOWDOWN_KEY = "golden_max_slowdown"
+
+    ## Defaults
+    GOLDEN_FOLDER_PATH = CONFIG_OPTIONS.get(GOLDEN_FOLDER_PATH_KEY, os.sep.join([utilities.get_root_path(), "resources", "golden"]))
+    GOLDEN_PIXEL_TOLERANCE = CONFIG_OPTIONS.get(GOLDEN_PIXEL_TOLERANCE_KEY, 8)
+    GOLDEN_MAX_MISMATCH_FRACTION = CONFIG_OPTIONS.get(GOLDEN_MAX_MISMATCH_FRACTION_KEY, 0.0001)
+    GOLDEN_TIME_BUDGET_MS = CONFIG_OPTIONS.get(GOLDEN_TIME_BUDGET_MS_KEY, 250)
+    GOLDEN_MEMORY_BUDGET_MB = CONFIG_OPTIONS.get(GOLDEN_MEMORY_BUDGET_MB_KEY, 64)
+    GOLDEN_MAX_SLOWDOWN = CONFIG_OPTIONS.get(GOLDEN_MAX_SLOWDOWN_KEY, 2.0)
+    MANIFEST_FILE_NAME = "manifest.json"
+    TIMING_ITERATIONS = 5
+    CALIBRATION_ITERATIONS = 10
+    CALIBRATION_SIZE = (1080, 1080)
+    ## glibc's mallopt parameter for the size above which allocations get their own mmap
+    M_MMAP_THRESHOLD = -3
+
+
+    def __init__(self, band_renderer=None, overlay_enable=None, **kwargs):
+        golden_folder_path = kwargs.get(self.GOLDEN_FOLDER_PATH_KEY, self.GOLDEN_FOLDER_PATH)
+        self.pixel_tolerance = kwargs.get(self.GOLDEN_PIXEL_TOLERANCE_KEY, self.GOLDEN_PIXEL_TOLERANCE)
+        self.max_mismatch_fraction = kwargs.get(self.GOLDEN_MAX_MISMATCH_FRACTION_KEY, self.GOLDEN_MAX_MISMATCH_FRACTION)
+        self.time_budget_ms = kwargs.get(self.GOLDEN_TIME_BUDGET_MS_KEY, self.GOLDEN_TIME_BUDGET_MS)
+        self.memory_budget_mb = kwargs.get(self.GOLDEN_MEMORY_BUDGET_MB_KEY, self.GOLDEN_MEMORY_BUDGET_MB)
+        self.max_slowdown = kwargs.get(self.GOLDEN_MAX_SLOWDOWN_KEY, self.GOLDEN_MAX_SLOWDOWN)
+
+        self.path_parser = bot_io.PathParser()
+        self.plotter = plotter.Plotter(output_folder_path=None)
+        ## A second plotter, whose base maps are swapped out for flat canvases of the same sizes
+        self.canvas_plotter = plotter.Plotter(output_folder_path=None)
+        self.canvas_plotter.tier_base_maps = {
+            tier: {map_name: Image.new("RGB", base_map.size, CANVAS_COLOR) for map_name, base_map in base_maps.items()}
+            for tier, base_maps in self.plotter.tier_base_maps.items()
+        }
+
+        for plotter_obj in [self.plotter, self.canvas_plotter]:
+            if(band_renderer is not None):
+                plotter_obj.band_renderer = band_renderer
+            if(overlay_enable is not None):
+                plotter_obj.overlay_enable = overlay_enable
+
+        ## Each renderer draws its band edges a little differently, so each one gets its own set of golden images
+        if(self.plotter.band_renderer == self.plotter.PILLOW_RENDERER and self.plotter.overlay_enable):
+            self.renderer_name = "overlay"
+        else:
+            self.renderer_name = self.plotter.band_renderer
+        self.folder_path = os.sep.join([golden_folder_path, self.renderer_name])
+
+        ## Diffs are vectorized with NumPy when it's around, otherwise Pillow's ImageChops does the work
+        self.use_numpy = plotter.load_numpy()
+        self.manifest = self._load_manifest()
+        self.libc = self._load_libc()
+        self.calibration_ms = None
+        ## (render time, expected render time) pairs for every case with a golden timing, in milliseconds
+        self.timings = []
+
+    ## Methods
+
+    def _load_libc(self):
+        ## Pin glibc's mmap threshold, so that big pixel buffers are always handed back to the OS when they're freed,
+        ## and show up in the peak memory of whichever render allocates them next, rather than being quietly reused
+        try:
+            libc = ctypes.CDLL("libc.so.6")
+            libc.mallopt(self.M_MMAP_THRESHOLD, 128 * 1024)
+        except (OSError, AttributeError):
+            return None
+
+        return libc
+
+
+    def build_cases(self):
+        cases = []
+        for map_name in sorted(self.plotter.base_maps.keys()):
+            for heading in GOLDEN_HEADINGS:
+                for grid in GOLDEN_GRIDS:
+                    cases.append(GoldenCase(map_name, "{} {}".format(heading, grid), self.plotter.default_resolution_tier))
+
+        for map_name, message in example_generator.EXAMPLES:
+            for tier in sorted(self.plotter.tier_base_maps.keys()):
+                if(tier != self.plotter.default_resolution_tier):
+                    cases.append(GoldenCase(map_name, message, tier))
+            cases.append(GoldenCase(map_name, message, self.plotter.default_resolution_tier, GOLDEN_ZOOM_RADIUS_KM))
+
+        for map_name in sorted(self.plotter.base_maps.keys()):
+            for message in GOLDEN_MULTI_PATHS:
+                cases.append(GoldenCase(map_name, message, self.plotter.default_resolution_tier))
+                cases.append(GoldenCase(map_name, message, self.plotter.default_resolution_tier, GOLDEN_ZOOM_RADIUS_KM))
+            for message in GOLDEN_TRAILING_CHATTER:
+                cases.append(GoldenCase(map_name, message, self.plotter.default_resolution_tier))
+
+        return cases
+
+
+    def _get_golden_path(self, case):
+        return os.sep.join([self.folder_path, "{}.png".format(case.name)])
+
+
+    def _load_manifest(self):
+        try:
+            with open(os.sep.join([self.folder_path, self.MANIFEST_FILE_NAME])) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+
+    def _save_manifest(self):
+        with open(os.sep.join([self.folder_path, self.MANIFEST_FILE_NAME]), "w") as fd:
+            json.dump(self.manifest, fd, indent=4, sort_keys=True)
+
+
+    def _reset_peak_rss(self):
+        ## Linux lets the peak resident memory be reset, otherwise fall back to tracing Python's own allocations
+        if(self.libc is None):
+            return False
+
+        self.libc.malloc_trim(0)
+        try:
+            with open("/proc/self/clear_refs", "w") as fd:
+                fd.write("5")
+            return True
+        except OSError:
+            return False
+
+
+    def _get_peak_rss_bytes(self):
+        with open("/proc/self/status") as fd:
+            for line in fd:
+                if(line.startswith("VmHWM:")):
+                    return int(line.split()[1]) * 1024
+
+        return 0
+
+
+    def _get_rss_bytes(self):
+        with open("/proc/self/status") as fd:
+            for line in fd:
+                if(line.startswith("VmRSS:")):
+                    return int(line.split()[1]) * 1024
+
+        return 0
+
+
+    def measure(self, map_name, path_obj, render_options):
+        """
+        Plot the path onto the real base map, and return the result along with the best render time in milliseconds
+        and the peak memory used while rendering in bytes.
+        """
+
+        ## Warm up first, so that one-off work (ex. drawing the overlay sprites) isn't counted against the budget
+        plotted_map = self.plotter.plot_plane_path(map_name, path_obj, render_options)
+        del plotted_map
+
+        if(self._reset_peak_rss()):
+            rss_bytes = self._get_rss_bytes()
+            plotted_map = self.plotter.plot_plane_path(map_name, path_obj, render_options)
+            peak_bytes = self._get_peak_rss_bytes() - rss_bytes
+        else:
+            tracemalloc.start()
+            plotted_map = self.plotter.plot_plane_path(map_name, path_obj, render_options)
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        timings = []
+        for _ in range(self.TIMING_ITERATIONS):
+            start = time.perf_counter()
+            self.plotter.plot_plane_path(map_name, path_obj, render_options)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        ## The fastest run is the one that's least affected by whatever else the machine happens to be doing
+        return plotted_map, min(timings), peak_bytes
+
+
+    def calibrate(self):
+        """
+        Time a fixed reference workload, which blends a few wide lines onto a canvas with plain Pillow (and so doesn't
+        change along with the plotter), and return the best time in milliseconds. It's a stand in for how fast the
+        machine itself is.
+        """
+
+        width, height = self.CALIBRATION_SIZE
+        timings = []
+        for _ in range(self.CALIBRATION_ITERATIONS):
+            start = time.perf_counter()
+            image = Image.new("RGB", self.CALIBRATION_SIZE, CANVAS_COLOR)
+            layer = Image.new("RGBA", self.CALIBRATION_SIZE, (0, 0, 0, 0))
+            draw = ImageDraw.Draw(layer)
+            for line_width in [int(width * 0.3), int(width * 0.18), int(width * 0.01)]:
+                draw.line([(0, height * 0.2), (width, height * 0.8)], fill=(255, 255, 255, 64), width=line_width)
+            image.paste(layer, (0, 0), layer)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        return min(timings)
+
+
+    def get_expected_render_ms(self, baseline):
+        ## Scale the golden render time by how much slower (or faster) this machine is than the one that recorded it.
+        ## Golden timings without a calibration can't be compared across machines, so they aren't checked.
+        if(not baseline or not baseline.get("calibration_ms")):
+            return None
+
+        return baseline["render_ms"] * (self.calibration_ms / baseline["calibration_ms"])
+
+
+    def count_mismatches(self, image, golden_image, tolerance):
+        ## Pixels where any channel differs by more than the tolerance
+        if(self.use_numpy):
+            numpy = plotter.numpy
+            difference = numpy.abs(numpy.asarray(image, dtype=numpy.int16) - numpy.asarray(golden_image, dtype=numpy.int16))
+            return int(numpy.count_nonzero(difference.max(axis=2) > tolerance))
+
+        red, green, blue = ImageChops.difference(image, golden_image).split()
+        difference = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+        return sum(difference.histogram()[tolerance + 1:])
+
+
+    def count_untouched_changes(self, plotted_map, base_map, canvas_map):
+        ## Pixels that the canvas render left alone, but that don't match the base map in the real render
+        if(self.use_numpy):
+            numpy = plotter.numpy
+            untouched = numpy.all(numpy.asarray(canvas_map) == numpy.array(CANVAS_COLOR, dtype=numpy.uint8), axis=2)
+            changed = numpy.any(numpy.asarray(plotted_map) != numpy.asarray(base_map.convert("RGB")), axis=2)
+            return int(numpy.count_nonzero(untouched & changed))
+
+        canvas = Image.new("RGB", canvas_map.size, CANVAS_COLOR)
+        red, green, blue = ImageChops.difference(canvas_map, canvas).split()
+        untouched = ImageChops.lighter(ImageChops.lighter(red, green), blue).point(lambda value: 255 if value == 0 else 0)
+        red, green, blue = ImageChops.difference(plotted_map, base_map.convert("RGB")).split()
+        changed = ImageChops.lighter(ImageChops.lighter(red, green), blue).point(lambda value: 255 if value else 0)
+        return ImageChops.darker(untouched, changed).histogram()[255]
+
+
+    def check_case(self, case, update=False):
+        """
+        Run a single case, and return a list of the reasons that it failed (empty if it passed).
+        """
+
+        failures = []
+        path_obj = self.path_parser.parse_message(case.message, case.map_name)
+        render_options = case.build_render_options()
+
+        canvas_map = self.canvas_plotter.plot_plane_path(case.map_name, path_obj, render_options).convert("RGB")
+        plotted_map, render_ms, peak_bytes = self.measure(case.map_name, path_obj, render_options)
+        golden_path = self._get_golden_path(case)
+
+        if(update):
+            canvas_map.save(golden_path, optimize=True)
+            self.manifest[case.name] = {
+                "render_ms": round(render_ms, 3),
+                "calibration_ms": round(self.calibration_ms, 3),
+                "peak_bytes": peak_bytes
+            }
+        elif(not os.path.isfile(golden_path)):
+            failures.append("missing golden image")
+        else:
+            golden_image = Image.open(golden_path).convert("RGB")
+            if(golden_image.size != canvas_map.size):
+                failures.append("size {} doesn't match the golden {}".format(canvas_map.size, golden_image.size))
+            else:
+                mismatches = self.count_mismatches(canvas_map, golden_image, self.pixel_tolerance)
+                mismatch_fraction = mismatches / (canvas_map.size[0] * canvas_map.size[1])
+                if(mismatch_fraction > self.max_mismatch_fraction):
+                    failures.append("{} pixels ({:.3%}) differ from the golden image".format(mismatches, mismatch_fraction))
+
+        ## Zoomed in renders are cropped, so there's no base map of the same size to compare against
+        if(not case.zoom_radius_km):
+            base_map = self.plotter.get_base_map(case.map_name, case.tier)
+            changes = self.count_untouched_changes(plotted_map, base_map, canvas_map)
+            if(changes):
+                failures.append("{} pixels outside of the path changed on the base map".format(changes))
+
+        if(render_ms > self.time_budget_ms):
+            failures.append("render took {:.1f} ms, over the {} ms budget".format(render_ms, self.time_budget_ms))
+        expected_render_ms = self.get_expected_render_ms(self.manifest.get(case.name))
+        if(not update and expected_render_ms):
+            self.timings.append((render_ms, expected_render_ms))
+        if(peak_bytes > self.memory_budget_mb * 1024 * 1024):
+            failures.append("render used {:.1f} MB, over the {} MB budget".format(peak_bytes / (1024 * 1024), self.memory_budget_mb))
+
+        return failures
+
+
+    def run(self, update=False, name_filter=None):
+        if(update):
+            os.makedirs(self.folder_path, exist_ok=True)
+
+        self.calibration_ms = self.calibrate()
+        self.timings = []
+
+        failed_cases = 0
+        cases = [case for case in self.build_cases() if not name_filter or name_filter in case.name]
+        for case in cases:
+            failures = self.check_case(case, update)
+            if(failures):
+                failed_cases += 1
+                print("FAIL {}: {}".format(case.name, "; ".join(failures)))
+
+        slowed_down = False
+        if(self.timings):
+            total_ms = sum(render_ms for render_ms, expected_render_ms in self.timings)
+            expected_total_ms = sum(expected_render_ms for render_ms, expected_render_ms in self.timings)
+            slowdown = total_ms / expected_total_ms
+            print("Renders took {:.1f} ms in total, {:.2f}x the golden timings on this machine".format(total_ms, slowdown))
+            if(slowdown > self.max_slowdown):
+                slowed_down = True
+                print("FAIL renders slowed down by over {}x".format(self.max_slowdown))
+
+        if(update):
+            self._save_manifest()
+            print("Updated {} golden images in: '{}'".format(len(cases), self.folder_path))
+
+        print("{}/{} cases passed with the {} renderer".format(len(cases) - failed_cases, len(cases), self.renderer_name))
+        return failed_cases == 0 and not slowed_down
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check Plane Pal's plotter against its golden images and performance budgets.")
+    parser.add_argument("--update", action="store_true", help="Store the current renders and timings as the new golden set")
+    parser.add_argument("--renderer", choices=[plotter.Plotter.PILLOW_RENDERER, plotter.Plotter.NUMPY_RENDERER, "overlay"], help="Band renderer to check, rather than the configured one")
+    parser.add_argument("--filter", help="Only run the cases whose names contain this")
+    parser.add_argument("--time-budget-ms", type=float, default=GoldenCheck.GOLDEN_TIME_BUDGET_MS, help="Longest a single render may take")
+    parser.add_argument("--memory-budget-mb", type=float, default=GoldenCheck.GOLDEN_MEMORY_BUDGET_MB, help="Most memory a single render may use")
+    parser.add_argument("--max-slowdown", type=float, default=GoldenCheck.GOLDEN_MAX_SLOWDOWN, help="Largest allowed slowdown relative to the golden timings, once they're scaled to this machine's speed")
+    args = parser.parse_args()
+
+    band_renderer = None
+    overlay_enable = None
+    if(args.renderer == "overlay"):
+        band_renderer = plotter.Plotter.PILLOW_RENDERER
+        overlay_enable = True
+    elif(args.renderer):
+        band_renderer = args.renderer
+        overlay_enable = False
+
+    golden_check = GoldenCheck(
+        band_renderer,
+        overlay_enable,
+        golden_time_budget_ms=args.time_budget_ms,
+        golden_memory_budget_mb=args.memory_budget_mb,
+        golden_max_slowdown=args.max_slowdown
+    )
+
+    sys.exit(0 if golden_check.run(args.update, args.filter) else 1)
+
+
+if(__name__ == '__main__'):
+    main()
@@ -0,0 +1,225 @@
+import os
+import csv
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import utilities
+import benchmark
+import bot_io
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+## Every command that plots a map, along with the map that it plots on
+PLOT_COMMANDS = {"erangel": "erangel", "miramar": "miramar", "e": "erangel", "m": "miramar"}
+
+
+def get_rss_bytes():
+    ## Current resident memory on Linux, otherwise fall back to the peak
+    try:
+        with open("/proc/self/statm") as fd:
+            return int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return benchmark.get_peak_rss_bytes()
+
+
+def read_query_log(file_path):
+    ## Accepts the same JSONL or CSV exports of DynamoItem records as the cache warmer
+    with open(file_path, newline="") as fd:
+        if(file_path.lower().endswith(".csv")):
+            records = list(csv.DictReader(fd))
+        else:
+            records = [json.loads(line) for line in fd if line.strip()]
+
+    records = [record for record in records if record.get("raw_query") and record.get("map_name") in PLOT_COMMANDS.values()]
+    records.sort(key=lambda record: int(record.get("timestamp", 0)))
+
+    return records
+
+
+class LoadTest:
+    """
+    Drives BotIO's plot commands through a fake Discord bot, either with generated traffic (spread over a number of
+    simulated servers and users, arriving in bursts at a given average rate) or by replaying a log of real queries.
+    Reports the throughput, command latency, event loop lag, and memory use over time.
+    """
+
+    ## How often the event loop lag and memory use are sampled
+    LAG_INTERVAL_SECONDS = 0.05
+    SAMPLE_INTERVAL_SECONDS = 1
+
+
+    def __init__(self, guilds=10, users=200, seed=0):
+        self.guilds = guilds
+        self.users = users
+        self.rng = random.Random(seed)
+
+        self.loop = asyncio.get_event_loop()
+        self.bot = benchmark.FakeBot(self.loop)
+        self.bot_io = bot_io.BotIO(None, self.bot)
+        self.command_names = sorted(PLOT_COMMANDS)
+
+        self.latencies = []
+        self.outcomes = {}
+        self.loop_lags = []
+        self.timeline = []
+        self.in_flight = 0
+        self.completed = 0
+        self._running = False
+
+    ## Methods
+
+    def _get_command(self, name):
+        ## discord.py wraps the commands up, but the original coroutine is still there to call
+        command = getattr(type(self.bot_io), name)
+        return getattr(command, "callback", command)
+
+
+    async def _run_command(self, name, message, user_id, server_id):
+        ctx = benchmark.build_fake_context(user_id, server_id)
+        self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            result = await self._get_command(name)(self.bot_io, ctx, message=message)
+        except Exception as e:
+            utilities.debug_print("Error running command: '{} {}'.".format(name, message), e, debug_level=1)
+            result = "error"
+        finally:
+            self.in_flight -= 1
+
+        self.latencies.append(time.perf_counter() - start)
+        outcome = {True: "success", False: "failed", None: "invalid"}.get(result, result)
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        self.completed += 1
+
+
+    async def _monitor_loop_lag(self):
+        ## Anything past the requested sleep is time the loop spent busy with something else
+        while(self._running):
+            start = time.perf_counter()
+            await asyncio.sleep(self.LAG_INTERVAL_SECONDS)
+            self.loop_lags.append(time.perf_counter() - start - self.LAG_INTERVAL_SECONDS)
+
+
+    async def _sample_timeline(self, start):
+        while(self._running):
+            self.timeline.append({
+                "seconds": time.perf_counter() - start,
+                "rss_bytes": get_rss_bytes(),
+                "in_flight": self.in_flight,
+                "completed": self.completed
+            })
+            await asyncio.sleep(self.SAMPLE_INTERVAL_SECONDS)
+
+
+    def build_generated_schedule(self, duration, rate, burst_size=1):
+        ## Bursts arrive as a Poisson process, with each one bringing a geometrically distributed number of commands,
+        ## so the average rate stays the same however bursty the traffic is
+        schedule = []
+        queries = iter(benchmark.build_query_mix(int(duration * rate * 2) + burst_size * 10, self.rng.random()))
+        offset = self.rng.expovariate(rate / burst_size)
+        while(offset < duration):
+            burst = 1
+            while(burst_size > 1 and self.rng.random() < 1 - 1 / burst_size):
+                burst += 1
+
+            for _ in range(burst):
+                map_name, message = next(queries)
+                name = self.rng.choice([command for command, command_map in PLOT_COMMANDS.items() if command_map == map_name])
+                schedule.append((offset, name, message, self.rng.randrange(self.users), self.rng.randrange(self.guilds)))
+
+            offset += self.rng.expovariate(rate / burst_size)
+
+        return schedule
+
+
+    def build_replay_schedule(self, records, speed=1.0):
+        ## Keep the gaps between the recorded queries, sped up (or slowed down) by the given factor
+        if(not records):
+            return []
+
+        first_timestamp = int(records[0].get("timestamp", 0))
+        schedule = []
+        for record in records:
+            offset = (int(record.get("timestamp", 0)) - first_timestamp) / 1000 / speed
+            name = self.rng.choice([command for command, command_map in PLOT_COMMANDS.items() if command_map == record["map_name"]])
+            schedule.append((offset, name, record["raw_query"], record.get("user") or self.rng.randrange(self.users), record.get("server") or self.rng.randrange(self.guilds)))
+
+        return schedule
+
+
+    async def _run_schedule(self, schedule):
+        start = time.perf_counter()
+        self._running = True
+        monitors = [self.loop.create_task(self._monitor_loop_lag()), self.loop.create_task(self._sample_timeline(start))]
+
+        tasks = []
+        for offset, name, message, user_id, server_id in schedule:
+            delay = offset - (time.perf_counter() - start)
+            if(delay > 0):
+                await asyncio.sleep(delay)
+            tasks.append(self.loop.create_task(self._run_command(name, message, user_id, server_id)))
+
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+        self._running = False
+        await asyncio.gather(*monitors)
+
+        return elapsed
+
+
+    def run(self, schedule):
+        elapsed = self.loop.run_until_complete(self._run_schedule(schedule))
+
+        self.bot_io.render_pool.shutdown(wait=True)
+        self.bot_io.dynamo_db.shutdown(wait=False)
+
+        return {
+            "timestamp": time.time(),
+            "commands": len(schedule),
+            "guilds": self.guilds,
+            "users": self.users,
+            "elapsed_seconds": elapsed,
+            "offered_per_second": len(schedule) / schedule[-1][0] if schedule and schedule[-1][0] else None,
+            "throughput_per_second": self.completed / elapsed if elapsed else None,
+            "outcomes": self.outcomes,
+            "latency": benchmark.summarize(self.latencies),
+            "event_loop_lag": benchmark.summarize(self.loop_lags),
+            "peak_rss_bytes": benchmark.get_peak_rss_bytes(),
+            "timeline": self.timeline
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test Plane Pal's plot commands against a fake Discord bot.")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of generated traffic")
+    parser.add_argument("--rate", type=float, default=20, help="Average commands per second of generated traffic")
+    parser.add_argument("--burst-size", type=int, default=1, help="Average number of commands that arrive together")
+    parser.add_argument("--guilds", type=int, default=10, help="Number of simulated servers")
+    parser.add_argument("--users", type=int, default=200, help="Number of simulated users")
+    parser.add_argument("--replay", help="Replay the raw queries from this JSONL or CSV query log, instead of generating them")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed multiplier")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated traffic")
+    parser.add_argument("--output", help="Write the JSON results to this file, rather than stdout")
+    args = parser.parse_args()
+
+    load_test = LoadTest(args.guilds, args.users, args.seed)
+    if(args.replay):
+        schedule = load_test.build_replay_schedule(read_query_log(args.replay), args.speed)
+    else:
+        schedule = load_test.build_generated_schedule(args.duration, args.rate, args.burst_size)
+
+    serialized = json.dumps(load_test.run(schedule), indent=4, sort_keys=True)
+    if(args.output):
+        with open(args.output, "w") as fd:
+            fd.write(serialized)
+    else:
+        print(serialized)
+
+
+if(__name__ == '__main__'):
+    main()
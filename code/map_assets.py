@@ -0,0 +1,158 @@
+import os
+import time
+import hashlib
+import threading
+from PIL import Image
+
+import utilities
+import metrics
+import tile_store
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+
+class MapAsset:
+    def __init__(self, image, signature, digest):
+        self.image = image
+        self.signature = signature
+        self.digest = digest
+
+    ## Methods
+
+    def get_size(self):
+        ## Decoded size in memory, rather than the size of the file on disk. Memory mapped maps live in the page cache,
+        ## rather than in the process' own memory.
+        if(isinstance(self.image, tile_store.TiledMap)):
+            return 0
+
+        width, height = self.image.size
+        return width * height * len(self.image.getbands())
+
+
+class MapAssetRegistry:
+    """
+    Loads and fully decodes each base map (at each width) exactly once per process, and hands out shared references to
+    them. The images are shared between every plotter, so callers must copy or crop them before drawing on them.
+
+    When the tile store is enabled, the maps are handed out as memory mapped TiledMaps instead of decoded images.
+    """
+
+    def __init__(self):
+        ## Maps (map path, width) onto its MapAsset
+        self.assets = {}
+        self.loads = 0
+        self.reuses = 0
+        self.metrics = metrics.get_shared_metrics()
+        self.tile_store = tile_store.get_shared_tile_store()
+
+        self._lock = threading.Lock()
+
+    ## Methods
+
+    def _get_signature(self, map_path):
+        stat = os.stat(map_path)
+        return (stat.st_mtime, stat.st_size)
+
+
+    def _get_digest(self, map_path):
+        sha1 = hashlib.sha1()
+        with open(map_path, "rb") as fd:
+            for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+                sha1.update(chunk)
+
+        return sha1.hexdigest()
+
+
+    def _load(self, map_path, width):
+        base_map = Image.open(map_path)
+        if(width and width != base_map.size[0]):
+            size = (width, int(base_map.size[1] * width / base_map.size[0]))
+            ## Let the JPEG decoder do most of the downscaling (no-op for other formats), then finish it off
+            base_map.draft(base_map.mode, size)
+            base_map = base_map.resize(size, Image.LANCZOS)
+
+        ## Decode the map up front, since lazily decoding it on first copy isn't safe across render threads
+        base_map.load()
+        return base_map
+
+
+    def _is_current(self, asset, map_path, signature):
+        if(asset.signature == signature):
+            return True
+
+        ## The file was touched, but it's only worth reloading if its contents actually changed
+        if(asset.digest == self._get_digest(map_path)):
+            asset.signature = signature
+            return True
+
+        return False
+
+
+    def get_base_map(self, map_path, width=None):
+        signature = self._get_signature(map_path)
+
+        with self._lock:
+            key = (map_path, width)
+            asset = self.assets.get(key)
+            if(asset is not None and self._is_current(asset, map_path, signature)):
+                self.reuses += 1
+                return asset.image
+
+            ## Don't keep a second copy of the native resolution map around for widths that match it
+            native = self.assets.get((map_path, None))
+            if(width and native is not None and self._is_current(native, map_path, signature) and native.image.size[0] == width):
+                self.assets[key] = native
+                self.reuses += 1
+                return native.image
+
+            start = time.perf_counter()
+            digest = self._get_digest(map_path)
+            if(self.tile_store.enabled):
+                image = self.tile_store.get_tiled_map(map_path, width, digest, lambda: self._load(map_path, width))
+            else:
+                image = self._load(map_path, width)
+            self.metrics.observe("base_map_load_seconds", time.perf_counter() - start)
+            ## A replaced memory mapped map isn't closed here, since older plotters and renders that are still running
+            ## may be using it. Its mapping gets closed once the last of them lets go of it.
+            self.assets[key] = MapAsset(image, signature, digest)
+            self.loads += 1
+
+            return image
+
+
+    def add_base_map(self, map_path, width, image):
+        ## Hand the registry an already decoded map (ex. one that lives in memory shared with other processes)
+        with self._lock:
+            self.assets[(map_path, width)] = MapAsset(image, self._get_signature(map_path), self._get_digest(map_path))
+
+
+    def get_size(self):
+        ## Total decoded size of every distinct image being held onto
+        with self._lock:
+            unique_assets = {id(asset): asset for asset in self.assets.values()}
+            return sum(asset.get_size() for asset in unique_assets.values())
+
+
+    def get_stats(self):
+        size = self.get_size()
+        with self._lock:
+            return {
+                "entries": len(self.assets),
+                "size": size,
+                "loads": self.loads,
+                "reuses": self.reuses
+            }
+
+
+## The shared registry lives outside of the cog modules, so the base maps aren't reloaded when the cogs get reloaded
+_shared_map_assets = None
+
+
+def get_shared_map_assets():
+    global _shared_map_assets
+
+    if(_shared_map_assets is None):
+        _shared_map_assets = MapAssetRegistry()
+
+    return _shared_map_assets
@@ -0,0 +1,130 @@
+import io
+import time
+import threading
+
+import utilities
+import metrics
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+
+class MapEncoder:
+    """
+    Encodes plotted maps into bytes, optionally trading quality for size to fit each resolution tier's byte budget.
+    """
+
+    ## Keys
+    MAP_FILE_EXTENSION_KEY = "map_file_extension"
+    ENCODER_QUALITY_KEY = "encoder_quality"
+    ENCODER_MIN_QUALITY_KEY = "encoder_min_quality"
+    ENCODER_QUALITY_STEP_KEY = "encoder_quality_step"
+    ENCODER_JPEG_PROGRESSIVE_KEY = "encoder_jpeg_progressive"
+    ENCODER_JPEG_SUBSAMPLING_KEY = "encoder_jpeg_subsampling"
+    ENCODER_WEBP_METHOD_KEY = "encoder_webp_method"
+    ENCODER_PNG_COLORS_KEY = "encoder_png_colors"
+    ENCODER_TARGET_BYTES_KEY = "encoder_target_bytes"
+    ENCODER_MAX_ENCODE_SECONDS_KEY = "encoder_max_encode_seconds"
+
+    ## Defaults
+    MAP_FILE_EXTENSION = CONFIG_OPTIONS.get(MAP_FILE_EXTENSION_KEY, "jpeg")
+    ENCODER_QUALITY = CONFIG_OPTIONS.get(ENCODER_QUALITY_KEY, 75)
+    ENCODER_MIN_QUALITY = CONFIG_OPTIONS.get(ENCODER_MIN_QUALITY_KEY, 40)
+    ENCODER_QUALITY_STEP = CONFIG_OPTIONS.get(ENCODER_QUALITY_STEP_KEY, 5)
+    ENCODER_JPEG_PROGRESSIVE = CONFIG_OPTIONS.get(ENCODER_JPEG_PROGRESSIVE_KEY, False)
+    ENCODER_JPEG_SUBSAMPLING = CONFIG_OPTIONS.get(ENCODER_JPEG_SUBSAMPLING_KEY, "4:2:0")
+    ENCODER_WEBP_METHOD = CONFIG_OPTIONS.get(ENCODER_WEBP_METHOD_KEY, 4)
+    ENCODER_PNG_COLORS = CONFIG_OPTIONS.get(ENCODER_PNG_COLORS_KEY, 256)
+    ENCODER_TARGET_BYTES = CONFIG_OPTIONS.get(ENCODER_TARGET_BYTES_KEY, {})
+    ENCODER_MAX_ENCODE_SECONDS = CONFIG_OPTIONS.get(ENCODER_MAX_ENCODE_SECONDS_KEY, {})
+    DEFAULT_MAX_ENCODE_SECONDS = 0.1
+
+    ## Formats whose size can be traded off against their quality
+    QUALITY_FORMATS = ["jpeg", "webp"]
+
+
+    def __init__(self, **kwargs):
+        map_file_extension = kwargs.get(self.MAP_FILE_EXTENSION_KEY, self.MAP_FILE_EXTENSION).lower()
+        self.format = "jpeg" if map_file_extension == "jpg" else map_file_extension
+
+        self.quality = kwargs.get(self.ENCODER_QUALITY_KEY, self.ENCODER_QUALITY)
+        self.min_quality = kwargs.get(self.ENCODER_MIN_QUALITY_KEY, self.ENCODER_MIN_QUALITY)
+        self.quality_step = kwargs.get(self.ENCODER_QUALITY_STEP_KEY, self.ENCODER_QUALITY_STEP)
+        self.jpeg_progressive = kwargs.get(self.ENCODER_JPEG_PROGRESSIVE_KEY, self.ENCODER_JPEG_PROGRESSIVE)
+        self.jpeg_subsampling = kwargs.get(self.ENCODER_JPEG_SUBSAMPLING_KEY, self.ENCODER_JPEG_SUBSAMPLING)
+        self.webp_method = kwargs.get(self.ENCODER_WEBP_METHOD_KEY, self.ENCODER_WEBP_METHOD)
+        self.png_colors = kwargs.get(self.ENCODER_PNG_COLORS_KEY, self.ENCODER_PNG_COLORS)
+        ## Maps the name of each resolution tier onto the largest encoded size that it should have, and how long it
+        ## can spend getting there
+        self.target_bytes = kwargs.get(self.ENCODER_TARGET_BYTES_KEY, self.ENCODER_TARGET_BYTES)
+        self.max_encode_seconds = kwargs.get(self.ENCODER_MAX_ENCODE_SECONDS_KEY, self.ENCODER_MAX_ENCODE_SECONDS)
+
+        ## The last quality that fit each tier's budget, so most encodes get it right on the first try
+        self.tier_qualities = {}
+        self._lock = threading.Lock()
+        self.metrics = metrics.get_shared_metrics()
+
+    ## Methods
+
+    def _build_save_kwargs(self, quality):
+        if(self.format == "jpeg"):
+            return {
+                "format": "jpeg",
+                "quality": quality,
+                "progressive": self.jpeg_progressive,
+                "subsampling": self.jpeg_subsampling
+            }
+        elif(self.format == "webp"):
+            return {"format": "webp", "quality": quality, "method": self.webp_method}
+        elif(self.format == "png"):
+            return {"format": "png", "optimize": True}
+        else:
+            return {"format": self.format}
+
+
+    def _encode(self, pillow_image, quality):
+        ## Palette quantized PNGs are far smaller than true color ones, and the maps don't have many distinct colors
+        if(self.format == "png" and self.png_colors):
+            pillow_image = pillow_image.quantize(colors=self.png_colors)
+
+        buffer = io.BytesIO()
+        pillow_image.save(buffer, **self._build_save_kwargs(quality))
+
+        return buffer.getvalue()
+
+
+    def encode(self, pillow_image, tier=None):
+        start = time.perf_counter()
+        target_bytes = self.target_bytes.get(tier) if tier and self.format in self.QUALITY_FORMATS else None
+        max_encode_seconds = self.max_encode_seconds.get(tier, self.DEFAULT_MAX_ENCODE_SECONDS)
+
+        with self._lock:
+            quality = self.tier_qualities.get(tier, self.quality)
+        map_bytes = self._encode(pillow_image, quality)
+        attempts = 1
+
+        ## Step the quality down until the map fits into its budget, or there's no time left to keep trying
+        while(target_bytes and len(map_bytes) > target_bytes and quality > self.min_quality):
+            if(time.perf_counter() - start > max_encode_seconds):
+                break
+
+            quality = max(self.min_quality, quality - self.quality_step)
+            map_bytes = self._encode(pillow_image, quality)
+            attempts += 1
+
+        if(target_bytes):
+            ## Drift back up towards the configured quality when there's plenty of room left in the budget
+            next_quality = quality
+            if(len(map_bytes) < target_bytes * 0.75):
+                next_quality = min(self.quality, quality + self.quality_step)
+            with self._lock:
+                self.tier_qualities[tier] = next_quality
+
+        labels = {"format": self.format, "tier": tier}
+        self.metrics.observe("encode_seconds", time.perf_counter() - start, labels)
+        self.metrics.observe("encode_bytes", len(map_bytes), labels)
+        self.metrics.increment("encode_attempts_total", labels, attempts)
+        if(self.format in self.QUALITY_FORMATS):
+            self.metrics.set_gauge("encode_quality", quality, labels)
+
+        return map_bytes
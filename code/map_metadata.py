@@ -0,0 +1,192 @@
+import math
+import threading
+
+import utilities
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+
+def clip_line(x, y, angle, map_size, margin=0):
+    """
+    Clip the infinite line through (x,y) at the given angle (in radians) to the map's rectangle, grown by the margin on
+    every side. Returns the endpoints as (x1, y1, x2, y2), or None if the line misses the rectangle entirely.
+    """
+
+    ## Invert the y component; upside down coordinate system
+    direction = (math.cos(angle), -math.sin(angle))
+    point = (x, y)
+    minimum = -math.inf
+    maximum = math.inf
+
+    ## Narrow down the range of distances along the line that stay inside of the rectangle, one axis at a time
+    for axis, length in enumerate(map_size):
+        low = -margin
+        high = length + margin
+        if(abs(direction[axis]) < 1e-12):
+            ## Parallel to this axis' edges, so it's either entirely between them or entirely outside of them
+            if(not low <= point[axis] <= high):
+                return None
+            continue
+
+        first = (low - point[axis]) / direction[axis]
+        second = (high - point[axis]) / direction[axis]
+        minimum = max(minimum, min(first, second))
+        maximum = min(maximum, max(first, second))
+
+    if(minimum > maximum):
+        return None
+
+    return (
+        x + minimum * direction[0],
+        y + minimum * direction[1],
+        x + maximum * direction[0],
+        y + maximum * direction[1]
+    )
+
+
+class GridTable:
+    """
+    The pixel centers of every grid marker, and every section inside of them, for a map at a single resolution. Looking
+    up where a path starts is then just a couple of dict lookups.
+    """
+
+    def __init__(self, map_metadata, map_size):
+        map_width, map_height = map_size
+        self.map_size = map_size
+        self.pixels_per_km = map_width / map_metadata.size_km
+
+        ## Sections are laid out in a square inside of each grid, and are numbered starting from the bottom left
+        sections_per_side = math.sqrt(map_metadata.grid_sections)
+        section_center = 1 / (sections_per_side * 2)
+        grid_width = map_width / len(map_metadata.grid_x_letters)
+        grid_height = map_height / len(map_metadata.grid_y_letters)
+
+        ## Maps (letter, section) onto the pixel's distance from the left or top of the map, with a section of None
+        ## meaning the center of the grid
+        self.x_centers = {}
+        for index, letter in enumerate(map_metadata.grid_x_letters):
+            grid_offset = index * grid_width
+            self.x_centers[(letter, None)] = int(grid_offset + grid_width / 2)
+            for section in range(1, map_metadata.grid_sections + 1):
+                section_offset = (((section - 1) % sections_per_side) / sections_per_side + section_center) * grid_width
+                self.x_centers[(letter, section)] = int(grid_offset + section_offset)
+
+        self.y_centers = {}
+        for index, letter in enumerate(map_metadata.grid_y_letters):
+            grid_offset = index * grid_height
+            self.y_centers[(letter, None)] = int(grid_offset + grid_height / 2)
+            for section in range(1, map_metadata.grid_sections + 1):
+                section_offset = grid_height - (((section - 1) // sections_per_side) / sections_per_side + section_center) * grid_height
+                self.y_centers[(letter, section)] = int(grid_offset + section_offset)
+
+    ## Methods
+
+    def get_point(self, grid_obj):
+        try:
+            return self.x_centers[(grid_obj.x, grid_obj.section)], self.y_centers[(grid_obj.y, grid_obj.section)]
+        except KeyError:
+            raise RuntimeError("Grid marker '{}{}{}' isn't on this map".format(grid_obj.x, grid_obj.y, grid_obj.section or ""))
+
+
+class MapMetadata:
+    """
+    Describes a map's layout: how big it is, the letters that mark out its grids, and how many sections each grid is
+    split up into. Anything left unspecified falls back to the layout of the original 8x8km maps.
+    """
+
+    ## Keys
+    SIZE_KM_KEY = "size_km"
+    GRID_X_LETTERS_KEY = "grid_x_letters"
+    GRID_Y_LETTERS_KEY = "grid_y_letters"
+    GRID_SECTIONS_KEY = "grid_sections"
+
+    ## Defaults
+    SIZE_KM = 8
+    GRID_X_LETTERS = "abcdefgh"
+    GRID_Y_LETTERS = "ijklmnop"
+    GRID_SECTIONS = CONFIG_OPTIONS.get("max_sections", 9)
+
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.size_km = kwargs.get(self.SIZE_KM_KEY, self.SIZE_KM)
+        self.grid_x_letters = kwargs.get(self.GRID_X_LETTERS_KEY, self.GRID_X_LETTERS).lower()
+        self.grid_y_letters = kwargs.get(self.GRID_Y_LETTERS_KEY, self.GRID_Y_LETTERS).lower()
+        self.grid_sections = kwargs.get(self.GRID_SECTIONS_KEY, self.GRID_SECTIONS)
+
+        ## Maps each resolution (as a (width, height) tuple) that the map's been drawn at onto its GridTable
+        self.grid_tables = {}
+        self._lock = threading.Lock()
+
+    ## Properties
+
+    @property
+    def resolutions(self):
+        return sorted(self.grid_tables.keys())
+
+    ## Methods
+
+    def get_layout(self):
+        return {
+            self.SIZE_KM_KEY: self.size_km,
+            self.GRID_X_LETTERS_KEY: self.grid_x_letters,
+            self.GRID_Y_LETTERS_KEY: self.grid_y_letters,
+            self.GRID_SECTIONS_KEY: self.grid_sections
+        }
+
+
+    def get_grid_table(self, map_size):
+        grid_table = self.grid_tables.get(map_size)
+        if(grid_table is None):
+            with self._lock:
+                grid_table = self.grid_tables.get(map_size)
+                if(grid_table is None):
+                    grid_table = GridTable(self, map_size)
+                    self.grid_tables[map_size] = grid_table
+
+        return grid_table
+
+
+class MapMetadataRegistry:
+    ## Keys
+    MAP_METADATA_KEY = "map_metadata"
+
+    ## Defaults
+    MAP_METADATA = CONFIG_OPTIONS.get(MAP_METADATA_KEY, {})
+
+
+    def __init__(self, **kwargs):
+        self.metadata = {}
+        for map_name, map_config in kwargs.get(self.MAP_METADATA_KEY, self.MAP_METADATA).items():
+            self.metadata[map_name] = MapMetadata(map_name, **map_config)
+
+        ## Used for maps that aren't described in the config
+        self.default_metadata = MapMetadata(None)
+
+    ## Methods
+
+    def get(self, map_name=None):
+        return self.metadata.get(map_name, self.default_metadata)
+
+
+    def get_all_letters(self):
+        ## Every letter that marks out a grid on any of the maps, in alphabetical order
+        letters = set(self.default_metadata.grid_x_letters + self.default_metadata.grid_y_letters)
+        for map_metadata in self.metadata.values():
+            letters.update(map_metadata.grid_x_letters + map_metadata.grid_y_letters)
+
+        return "".join(sorted(letters))
+
+
+## The shared registry lives outside of the cog modules, so the grid tables don't need to be rebuilt on reload
+_shared_map_metadata = None
+
+
+def get_shared_map_metadata():
+    global _shared_map_metadata
+
+    if(_shared_map_metadata is None):
+        _shared_map_metadata = MapMetadataRegistry()
+
+    return _shared_map_metadata
@@ -0,0 +1,307 @@
+import os
+import time
+import threading
+from collections import deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import utilities
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+
+class Histogram:
+    """
+    Keeps a rolling window of the most recent samples for percentiles, along with running totals.
+    """
+
+    def __init__(self, sample_size):
+        self.samples = deque(maxlen=sample_size)
+        self.count = 0
+        self.sum = 0.0
+
+    ## Methods
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+
+    def get_percentiles(self, percentiles=(0.5, 0.9, 0.99)):
+        ordered = sorted(self.samples)
+        if(not ordered):
+            return {percentile: None for percentile in percentiles}
+
+        return {percentile: ordered[min(len(ordered) - 1, int(percentile * len(ordered)))] for percentile in percentiles}
+
+
+class NullTimer:
+    ## Handed out when metrics are disabled, so timing a stage costs next to nothing
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    ## Methods
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, self.labels)
+        return False
+
+
+class MetricsRegistry:
+    ## Keys
+    METRICS_ENABLE_KEY = "metrics_enable"
+    METRICS_SAMPLE_SIZE_KEY = "metrics_sample_size"
+    METRICS_EXPORT_FILE_PATH_KEY = "metrics_export_file_path"
+    METRICS_EXPORT_INTERVAL_SECONDS_KEY = "metrics_export_interval_seconds"
+    METRICS_EXPORT_PORT_KEY = "metrics_export_port"
+
+    ## Defaults
+    METRICS_ENABLE = CONFIG_OPTIONS.get(METRICS_ENABLE_KEY, True)
+    METRICS_SAMPLE_SIZE = CONFIG_OPTIONS.get(METRICS_SAMPLE_SIZE_KEY, 1024)
+    METRICS_EXPORT_FILE_PATH = CONFIG_OPTIONS.get(METRICS_EXPORT_FILE_PATH_KEY, None)
+    METRICS_EXPORT_INTERVAL_SECONDS = CONFIG_OPTIONS.get(METRICS_EXPORT_INTERVAL_SECONDS_KEY, 15)
+    METRICS_EXPORT_PORT = CONFIG_OPTIONS.get(METRICS_EXPORT_PORT_KEY, None)
+
+
+    def __init__(self, **kwargs):
+        self.enabled = kwargs.get(self.METRICS_ENABLE_KEY, self.METRICS_ENABLE)
+        self.sample_size = kwargs.get(self.METRICS_SAMPLE_SIZE_KEY, self.METRICS_SAMPLE_SIZE)
+        self.export_file_path = kwargs.get(self.METRICS_EXPORT_FILE_PATH_KEY, self.METRICS_EXPORT_FILE_PATH)
+        self.export_interval = kwargs.get(self.METRICS_EXPORT_INTERVAL_SECONDS_KEY, self.METRICS_EXPORT_INTERVAL_SECONDS)
+        self.export_port = kwargs.get(self.METRICS_EXPORT_PORT_KEY, self.METRICS_EXPORT_PORT)
+
+        ## Each metric is a dict of label tuples onto their value
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        ## Gauges that are read on demand, keyed by name so that reloaded cogs replace their old callbacks
+        self.gauge_callbacks = {}
+
+        self._lock = threading.Lock()
+        self._export_server = None
+
+    ## Methods
+
+    def _build_labels(self, labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+
+    def increment(self, name, labels=None, amount=1):
+        if(not self.enabled):
+            return
+
+        key = self._build_labels(labels)
+        with self._lock:
+            metric = self.counters.setdefault(name, {})
+            metric[key] = metric.get(key, 0) + amount
+
+
+    def adjust_gauge(self, name, amount, labels=None):
+        if(not self.enabled):
+            return
+
+        key = self._build_labels(labels)
+        with self._lock:
+            metric = self.gauges.setdefault(name, {})
+            metric[key] = metric.get(key, 0) + amount
+
+
+    def set_gauge(self, name, value, labels=None):
+        if(not self.enabled):
+            return
+
+        with self._lock:
+            self.gauges.setdefault(name, {})[self._build_labels(labels)] = value
+
+
+    def register_gauge_callback(self, name, callback):
+        self.gauge_callbacks[name] = callback
+
+
+    def observe(self, name, value, labels=None):
+        if(not self.enabled):
+            return
+
+        key = self._build_labels(labels)
+        with self._lock:
+            metric = self.histograms.setdefault(name, {})
+            histogram = metric.get(key)
+            if(histogram is None):
+                histogram = Histogram(self.sample_size)
+                metric[key] = histogram
+            histogram.observe(value)
+
+
+    def timer(self, name, labels=None):
+        ## Times the body of a 'with' block, and records it into the named histogram
+        if(not self.enabled):
+            return NULL_TIMER
+
+        return Timer(self, name, labels)
+
+
+    def _read_gauge_callbacks(self):
+        gauges = {}
+        for name, callback in list(self.gauge_callbacks.items()):
+            try:
+                gauges[name] = {(): callback()}
+            except Exception as e:
+                utilities.debug_print("Error reading gauge: '{}'.".format(name), e, debug_level=2)
+
+        return gauges
+
+
+    def get_snapshot(self):
+        with self._lock:
+            counters = {name: dict(metric) for name, metric in self.counters.items()}
+            gauges = {name: dict(metric) for name, metric in self.gauges.items()}
+            histograms = {}
+            for name, metric in self.histograms.items():
+                histograms[name] = {}
+                for labels, histogram in metric.items():
+                    histograms[name][labels] = (histogram.count, histogram.sum, histogram.get_percentiles())
+
+        gauges.update(self._read_gauge_callbacks())
+
+        return counters, gauges, histograms
+
+
+    def _format_labels(self, labels, extra=None):
+        labels = list(labels) + (extra if extra else [])
+        if(not labels):
+            return ""
+
+        return "{" + ",".join("{}=\"{}\"".format(key, value) for key, value in labels) + "}"
+
+
+    def get_summary_lines(self):
+        ## Human readable summary, for the admin stats command
+        counters, gauges, histograms = self.get_snapshot()
+
+        lines = []
+        for name in sorted(histograms):
+            ## Timings read better in milliseconds, everything else is shown as is
+            is_timing = name.endswith("_seconds")
+            template = "{}{}: n={} p50={:.1f}ms p90={:.1f}ms p99={:.1f}ms" if is_timing else "{}{}: n={} p50={:.0f} p90={:.0f} p99={:.0f}"
+            for labels, (count, total, percentiles) in sorted(histograms[name].items()):
+                lines.append(template.format(
+                    name,
+                    self._format_labels(labels),
+                    count,
+                    *[(percentiles[percentile] or 0) * (1000 if is_timing else 1) for percentile in sorted(percentiles)]
+                ))
+        for metrics in [counters, gauges]:
+            for name in sorted(metrics):
+                for labels, value in sorted(metrics[name].items()):
+                    lines.append("{}{}: {}".format(name, self._format_labels(labels), value))
+
+        return lines
+
+
+    def render_text(self):
+        ## Prometheus style text exposition format
+        counters, gauges, histograms = self.get_snapshot()
+
+        lines = []
+        for name in sorted(counters):
+            lines.append("# TYPE {} counter".format(name))
+            for labels, value in sorted(counters[name].items()):
+                lines.append("{}{} {}".format(name, self._format_labels(labels), value))
+        for name in sorted(gauges):
+            lines.append("# TYPE {} gauge".format(name))
+            for labels, value in sorted(gauges[name].items()):
+                lines.append("{}{} {}".format(name, self._format_labels(labels), value))
+        for name in sorted(histograms):
+            lines.append("# TYPE {} summary".format(name))
+            for labels, (count, total, percentiles) in sorted(histograms[name].items()):
+                for percentile, value in sorted(percentiles.items()):
+                    if(value is not None):
+                        lines.append("{}{} {}".format(name, self._format_labels(labels, [("quantile", percentile)]), value))
+                lines.append("{}_sum{} {}".format(name, self._format_labels(labels), total))
+                lines.append("{}_count{} {}".format(name, self._format_labels(labels), count))
+
+        return "\n".join(lines) + "\n"
+
+
+    def export_to_file(self):
+        ## Write to a temp file first, so scrapers never see a partially written file
+        temp_path = "{}.tmp".format(self.export_file_path)
+        try:
+            with open(temp_path, "w") as fd:
+                fd.write(self.render_text())
+            os.replace(temp_path, self.export_file_path)
+        except OSError as e:
+            utilities.debug_print("Unable to export metrics to: '{}'.".format(self.export_file_path), e, debug_level=2)
+
+
+    def _run_file_exporter(self):
+        while(True):
+            time.sleep(self.export_interval)
+            self.export_to_file()
+
+
+    def start_exporters(self):
+        if(not self.enabled):
+            return
+
+        if(self.export_file_path):
+            threading.Thread(target=self._run_file_exporter, name="MetricsFileExporter", daemon=True).start()
+
+        if(self.export_port):
+            registry = self
+
+            class MetricsRequestHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = registry.render_text().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+
+                def log_message(self, *args):
+                    pass
+
+            ## Only listen locally, this is meant to be scraped by something running on the same host
+            try:
+                self._export_server = HTTPServer(("127.0.0.1", self.export_port), MetricsRequestHandler)
+            except OSError as e:
+                utilities.debug_print("Unable to serve metrics on port: {}.".format(self.export_port), e, debug_level=1)
+            else:
+                threading.Thread(target=self._export_server.serve_forever, name="MetricsServer", daemon=True).start()
+
+
+## The shared registry lives outside of the cog modules, so the metrics aren't reset when the cogs get reloaded
+_shared_metrics = None
+
+
+def get_shared_metrics():
+    global _shared_metrics
+
+    if(_shared_metrics is None):
+        _shared_metrics = MetricsRegistry()
+        _shared_metrics.start_exporters()
+
+    return _shared_metrics
@@ -0,0 +1,202 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+
+import utilities
+import metrics
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+
+def write_atomically(file_path, data):
+    ## Write to a temp file in the same folder first, so readers never see a partially written file
+    folder_path = os.path.dirname(file_path)
+    fd, temp_path = tempfile.mkstemp(dir=folder_path, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, file_path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+class OutputStore:
+    """
+    Keeps encoded maps on disk, named by a hash of whatever produced them, so identical renders share a single file and
+    survive restarts. Files that haven't been used in a while, or that push the store over its size limit, get swept up
+    in the background.
+    """
+
+    ## Keys
+    OUTPUT_STORE_MAX_BYTES_KEY = "output_store_max_bytes"
+    OUTPUT_STORE_TTL_SECONDS_KEY = "output_store_ttl_seconds"
+    OUTPUT_STORE_SWEEP_INTERVAL_SECONDS_KEY = "output_store_sweep_interval_seconds"
+    OUTPUT_STORE_TMPFS_KEY = "output_store_tmpfs"
+    OUTPUT_STORE_TMPFS_PATH_KEY = "output_store_tmpfs_path"
+
+    ## Defaults
+    OUTPUT_STORE_MAX_BYTES = CONFIG_OPTIONS.get(OUTPUT_STORE_MAX_BYTES_KEY, 256 * 1024 * 1024)
+    OUTPUT_STORE_TTL_SECONDS = CONFIG_OPTIONS.get(OUTPUT_STORE_TTL_SECONDS_KEY, 24 * 60 * 60)
+    OUTPUT_STORE_SWEEP_INTERVAL_SECONDS = CONFIG_OPTIONS.get(OUTPUT_STORE_SWEEP_INTERVAL_SECONDS_KEY, 60)
+    OUTPUT_STORE_TMPFS = CONFIG_OPTIONS.get(OUTPUT_STORE_TMPFS_KEY, False)
+    OUTPUT_STORE_TMPFS_PATH = CONFIG_OPTIONS.get(OUTPUT_STORE_TMPFS_PATH_KEY, "/dev/shm")
+
+
+    def __init__(self, folder_path, **kwargs):
+        self.max_bytes = kwargs.get(self.OUTPUT_STORE_MAX_BYTES_KEY, self.OUTPUT_STORE_MAX_BYTES)
+        self.ttl = kwargs.get(self.OUTPUT_STORE_TTL_SECONDS_KEY, self.OUTPUT_STORE_TTL_SECONDS)
+        self.sweep_interval = kwargs.get(self.OUTPUT_STORE_SWEEP_INTERVAL_SECONDS_KEY, self.OUTPUT_STORE_SWEEP_INTERVAL_SECONDS)
+        self.tmpfs = kwargs.get(self.OUTPUT_STORE_TMPFS_KEY, self.OUTPUT_STORE_TMPFS)
+        self.tmpfs_path = kwargs.get(self.OUTPUT_STORE_TMPFS_PATH_KEY, self.OUTPUT_STORE_TMPFS_PATH)
+
+        self.folder_path = self._get_tmpfs_folder_path(folder_path) if self.tmpfs else folder_path
+        os.makedirs(self.folder_path, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.metrics = metrics.get_shared_metrics()
+
+        self._sweeper = None
+        self._stop_event = threading.Event()
+
+    ## Methods
+
+    def _get_tmpfs_folder_path(self, folder_path):
+        ## Keep the output's folder name, but move it into memory backed storage if there is any
+        if(not os.path.isdir(self.tmpfs_path)):
+            utilities.debug_print("No tmpfs at: '{}', keeping output at: '{}'.".format(self.tmpfs_path, folder_path), debug_level=1)
+            return folder_path
+
+        return os.sep.join([self.tmpfs_path, "plane_pal_{}".format(os.path.basename(os.path.normpath(folder_path)))])
+
+
+    def build_file_name(self, key, extension):
+        return "{}.{}".format(hashlib.sha1(repr(key).encode("utf-8")).hexdigest(), extension)
+
+
+    def get_path(self, file_name):
+        return os.sep.join([self.folder_path, file_name])
+
+
+    def get(self, file_name):
+        file_path = self.get_path(file_name)
+        try:
+            with open(file_path, "rb") as fd:
+                data = fd.read()
+            ## Bump the modification time, so that recently used files are the last to be swept up
+            os.utime(file_path)
+        except OSError:
+            self.misses += 1
+            self.metrics.increment("output_store_lookups_total", {"outcome": "miss"})
+            return None
+
+        self.hits += 1
+        self.metrics.increment("output_store_lookups_total", {"outcome": "hit"})
+        return data
+
+
+    def put(self, file_name, data):
+        file_path = self.get_path(file_name)
+
+        ## The file's name is derived from its contents, so an existing file is already correct
+        if(os.path.isfile(file_path)):
+            try:
+                os.utime(file_path)
+                return file_path
+            except OSError:
+                pass
+
+        try:
+            write_atomically(file_path, data)
+        except OSError as e:
+            utilities.debug_print("Unable to store map at: '{}'.".format(file_path), e, debug_level=1)
+            return None
+
+        return file_path
+
+
+    def sweep(self):
+        ## Drop anything that's expired, and then the least recently used files until the store fits into its budget
+        now = time.time()
+        entries = []
+        try:
+            with os.scandir(self.folder_path) as iterator:
+                for entry in iterator:
+                    try:
+                        if(entry.is_file()):
+                            stat = entry.stat()
+                            entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    except OSError:
+                        pass
+        except OSError as e:
+            utilities.debug_print("Unable to sweep output store at: '{}'.".format(self.folder_path), e, debug_level=1)
+            return 0
+
+        entries.sort()
+        total_size = sum(size for mtime, size, path in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if(now - mtime <= self.ttl and total_size <= self.max_bytes):
+                break
+
+            try:
+                os.remove(path)
+            except OSError as e:
+                utilities.debug_print("Unable to remove stored map at: '{}'.".format(path), e, debug_level=2)
+            else:
+                total_size -= size
+                removed += 1
+
+        self.evictions += removed
+        self.metrics.increment("output_store_evictions_total", amount=removed)
+        self.metrics.set_gauge("output_store_bytes", total_size)
+
+        return removed
+
+
+    def _run_sweeper(self):
+        while(not self._stop_event.wait(self.sweep_interval)):
+            self.sweep()
+
+
+    def start_sweeper(self):
+        if(self._sweeper is None):
+            self._sweeper = threading.Thread(target=self._run_sweeper, name="OutputStoreSweeper", daemon=True)
+            self._sweeper.start()
+
+
+    def shutdown(self):
+        self._stop_event.set()
+
+
+    def get_stats(self):
+        return {
+            "folder_path": self.folder_path,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+## Stores live outside of the cog modules (one per folder), so their sweepers aren't duplicated when the cogs get reloaded
+_shared_output_stores = {}
+_shared_output_stores_lock = threading.Lock()
+
+
+def get_shared_output_store(folder_path, **kwargs):
+    with _shared_output_stores_lock:
+        store = _shared_output_stores.get(folder_path)
+        if(store is None):
+            store = OutputStore(folder_path, **kwargs)
+            store.start_sweeper()
+            _shared_output_stores[folder_path] = store
+
+    return store
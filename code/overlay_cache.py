@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+
+import utilities
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+
+class OverlayCache:
+    """
+    The pre-drawn plane path sprites (see plotter.PlanePathOverlay) for each map and heading. Every Plotter in the
+    process shares the same cache, so the sprites only get drawn (and precomputed) once.
+    """
+
+    ## Keys
+    PLOT_OVERLAY_CACHE_SIZE_KEY = "plot_overlay_cache_size"
+
+    ## Defaults
+    PLOT_OVERLAY_CACHE_SIZE = CONFIG_OPTIONS.get(PLOT_OVERLAY_CACHE_SIZE_KEY, 48)
+
+
+    def __init__(self, **kwargs):
+        self.max_entries = kwargs.get(self.PLOT_OVERLAY_CACHE_SIZE_KEY, self.PLOT_OVERLAY_CACHE_SIZE)
+
+        ## Least recently used sprites live at the front, most recently used at the back
+        self.entries = OrderedDict()
+        self.fingerprint = None
+        self.precompute_thread = None
+
+        self._lock = threading.Lock()
+
+    ## Methods
+
+    def validate(self, fingerprint):
+        ## The sprites are drawn with the plotter's colors and widths, so drop them all if the render settings change
+        with self._lock:
+            if(self.fingerprint == fingerprint):
+                return True
+
+            self.entries.clear()
+            self.fingerprint = fingerprint
+            return False
+
+
+    def get(self, key):
+        with self._lock:
+            overlay = self.entries.get(key)
+            if(overlay is not None):
+                self.entries.move_to_end(key)
+
+            return overlay
+
+
+    def put(self, key, overlay):
+        with self._lock:
+            self.entries[key] = overlay
+            while(len(self.entries) > self.max_entries):
+                self.entries.popitem(last=False)
+
+
+    def start_precompute(self, precompute):
+        ## Only the first Plotter in the process gets to start precomputing, since they'd all be drawing the same sprites
+        with self._lock:
+            if(self.precompute_thread is not None):
+                return False
+
+            self.precompute_thread = threading.Thread(target=precompute, name="OverlayPrecompute", daemon=True)
+            self.precompute_thread.start()
+            return True
+
+
+## The shared cache lives outside of the cog modules, so the sprites don't need to be redrawn on reload
+_shared_overlay_cache = None
+
+
+def get_shared_overlay_cache():
+    global _shared_overlay_cache
+
+    if(_shared_overlay_cache is None):
+        _shared_overlay_cache = OverlayCache()
+
+    return _shared_overlay_cache
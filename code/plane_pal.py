@@ -5,13 +5,17 @@ import asyncio
 import time
 from collections import OrderedDict
 
-import discord
-from discord.ext import commands
-
 import utilities
-import bot_io
-import plotter
-import admin
+import startup_profile
+
+## Time the imports of the heavier modules, so slow startups can be tracked down
+STARTUP_PROFILE = startup_profile.get_shared_startup_profile()
+discord = STARTUP_PROFILE.timed_import("discord")
+commands = STARTUP_PROFILE.timed_import("discord.ext.commands")
+plotter = STARTUP_PROFILE.timed_import("plotter")
+bot_io = STARTUP_PROFILE.timed_import("bot_io")
+admin = STARTUP_PROFILE.timed_import("admin")
+sharding = STARTUP_PROFILE.timed_import("sharding")
 
 ## Config
 CONFIG_OPTIONS = utilities.load_config()
@@ -49,8 +53,10 @@ class ModuleManager:
 
         ## Add the module to the bot, provided it hasn't already been added.
         if(not self.bot.get_cog(module_entry.name)):
+            start = time.perf_counter()
             cog_cls = module_entry.get_class_callable()
             self.bot.add_cog(cog_cls(*module_entry.args, **module_entry.kwargs))
+            STARTUP_PROFILE.record("load {}".format(module_entry.name), time.perf_counter() - start)
 
 
     ## Reimport a single module
@@ -106,6 +112,8 @@ class PlanePal:
     TOKEN_KEY = "token"
     TOKEN_FILE_KEY = "token_file"
     TOKEN_FILE_PATH_KEY = "token_file_path"
+    SHARD_ID_KEY = "shard_id"
+    SHARD_COUNT_KEY = "shard_count"
 
     ## Defaults
     ACTIVATION_STR = CONFIG_OPTIONS.get(ACTIVATION_STR_KEY, "|")
@@ -119,12 +127,19 @@ class PlanePal:
         self.description = kwargs.get(self.DESCRIPTION_KEY, self.DESCRIPTION)
         self.token_file_path = kwargs.get(self.TOKEN_FILE_PATH_KEY, self.TOKEN_FILE_PATH)
 
+        ## Only set when this bot is one of several shards (see sharding.py)
+        shard_kwargs = {}
+        if(kwargs.get(self.SHARD_ID_KEY) is not None):
+            shard_kwargs = {"shard_id": kwargs[self.SHARD_ID_KEY], "shard_count": kwargs[self.SHARD_COUNT_KEY]}
+
         ## Init bot and module manager
         self.bot = commands.Bot(
             command_prefix=commands.when_mentioned_or(self.activation_str),
-            description=self.description
+            description=self.description,
+            **shard_kwargs
         )
         self.module_manager = ModuleManager(self, self.bot)
+        self.ready = False
 
         ## Register the modules (Order of registration is important, make sure dependancies are loaded first)
         self.module_manager.register(plotter.Plotter)
@@ -136,6 +151,12 @@ class PlanePal:
         async def on_ready():
             print("Logged in as '{}' (id:{})".format(self.bot.user.name, self.bot.user.id))
 
+            ## on_ready fires again after reconnects, but only the first time is part of starting up
+            if(not self.ready):
+                self.ready = True
+                STARTUP_PROFILE.mark("on_ready")
+                utilities.debug_print("Startup profile:\n{}".format("\n".join(STARTUP_PROFILE.get_summary_lines())), debug_level=2)
+
     ## Methods
 
     def get_cog(self, cls_name):
@@ -158,4 +179,8 @@ class PlanePal:
 
 ## Main
 if(__name__ == "__main__"):
-    PlanePal().run()
+    ## Split the bot up into multiple processes once it's configured for more than one shard
+    if(CONFIG_OPTIONS.get(sharding.ShardLauncher.SHARD_COUNT_KEY, 1) > 1):
+        sharding.ShardLauncher().run()
+    else:
+        PlanePal().run()
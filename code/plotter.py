@@ -1,14 +1,37 @@
 import os
-import time
 import math
-from PIL import Image, ImageDraw
+import json
+import hashlib
+from PIL import Image, ImageDraw, ImageColor
 
 import utilities
+import map_assets
+import map_metadata
+import map_encoder
+import render_cache
+import output_store
+import tile_store
+import overlay_cache
+
+## NumPy is only needed for the 'numpy' band renderer, and is slow to import, so it's loaded on demand (see load_numpy)
+numpy = None
 
 ## Config
 CONFIG_OPTIONS = utilities.load_config()
 
 
+def load_numpy():
+    global numpy
+
+    if(numpy is None):
+        try:
+            import numpy
+        except ImportError:
+            return False
+
+    return True
+
+
 ## Todo: genericize and move into bot_io.py?
 class PlotterFileController:
     ## Keys
@@ -19,6 +42,8 @@ class PlotterFileController:
     MAP_FILE_EXTENSION_KEY = "map_file_extension"
     OUTPUT_FOLDER_KEY = "output_folder"
     OUTPUT_FOLDER_PATH_KEY = "output_folder_path"
+    SAVE_MAPS_TO_DISK_KEY = "save_maps_to_disk"
+    RESOLUTION_TIERS_KEY = "resolution_tiers"
 
     ## Defaults
     RESOURCES_FOLDER = CONFIG_OPTIONS.get(RESOURCES_FOLDER_KEY, "resources")
@@ -28,6 +53,8 @@ class PlotterFileController:
     MAP_FILE_EXTENSION = CONFIG_OPTIONS.get(MAP_FILE_EXTENSION_KEY, "jpeg")
     OUTPUT_FOLDER = CONFIG_OPTIONS.get(OUTPUT_FOLDER_KEY, "temp")
     OUTPUT_FOLDER_PATH = CONFIG_OPTIONS.get(OUTPUT_FOLDER_PATH_KEY, os.sep.join([utilities.get_root_path(), OUTPUT_FOLDER]))
+    SAVE_MAPS_TO_DISK = CONFIG_OPTIONS.get(SAVE_MAPS_TO_DISK_KEY, False)
+    RESOLUTION_TIERS = CONFIG_OPTIONS.get(RESOLUTION_TIERS_KEY, {"full": None})
 
 
     def __init__(self, **kwargs):
@@ -39,12 +66,21 @@ class PlotterFileController:
 
         self.map_file_extension = kwargs.get(self.MAP_FILE_EXTENSION_KEY, self.MAP_FILE_EXTENSION)
         self.output_folder_path = kwargs.get(self.OUTPUT_FOLDER_PATH_KEY, self.OUTPUT_FOLDER_PATH)
+        ## Maps are uploaded straight from memory, unless they're explicitly wanted on disk (ex. for debugging, or to
+        ## keep renders around between restarts)
+        self.save_to_disk = kwargs.get(self.SAVE_MAPS_TO_DISK_KEY, self.SAVE_MAPS_TO_DISK)
+        ## Maps the name of each resolution tier to the width of its output, or None for the map's native resolution
+        self.resolution_tiers = kwargs.get(self.RESOLUTION_TIERS_KEY, self.RESOLUTION_TIERS)
+        self.encoder = map_encoder.MapEncoder(**kwargs)
+        self.map_assets = map_assets.get_shared_map_assets()
 
         self.maps = {}
 
-        ## Prep the temp dir for image saving/deletion
-        if(self.output_folder_path):
-            self._init_dir()
+        ## Rendered maps are kept in a shared, content addressed store, so the folder doesn't need to be cleaned out
+        ## here (which could pull files out from under uploads that are still in progress)
+        self.output_store = None
+        if(self.output_folder_path and self.save_to_disk):
+            self.output_store = output_store.get_shared_output_store(self.output_folder_path, **kwargs)
 
 
     def _init_dir(self):
@@ -59,40 +95,63 @@ class PlotterFileController:
                         utilities.debug_print("Error removing file: {}, during temp dir cleanup.".format(file), e, debug_level=2)
 
 
-    def _generate_unique_file_name(self, extension):
-        time_ms = int(time.time() * 1000)
-        file_name = "{}.{}".format(time_ms, extension)
-
-        while(os.path.isfile(file_name)):
-            time_ms -= 1
-            file_name = "{}.{}".format(time_ms, extension)
-
-        return file_name
-
-
-    def load_base_maps(self):
+    def load_base_maps(self, width=None):
         maps = {}
         try:
+            ## Every plotter in the process shares the same decoded maps, so they're only loaded once
             for map_name, map_path in self.map_file_paths.items():
-                maps[map_name] = Image.open(map_path)
+                maps[map_name] = self.map_assets.get_base_map(map_path, width)
         except Exception as e:
             utilities.debug_print("Error opening base_map.", e, debug_level=0)
         
         return maps
 
 
-    def save_map(self, pillow_image, file_name=None):
-        file_name = self._generate_unique_file_name(self.map_file_extension) if not file_name else file_name
+    def get_base_map_signatures(self):
+        ## Identifies the on-disk state of each base map, so renders made from stale maps can be thrown out
+        signatures = {}
+        for map_name, map_path in self.map_file_paths.items():
+            try:
+                stat = os.stat(map_path)
+            except OSError:
+                signatures[map_name] = None
+            else:
+                signatures[map_name] = [map_path, stat.st_mtime, stat.st_size]
+
+        return signatures
+
+
+    def build_upload_file_name(self, map_name):
+        return "{}.{}".format(map_name, self.map_file_extension)
+
+
+    def encode_map(self, pillow_image, tier=None):
+        return self.encoder.encode(pillow_image, tier)
+
+
+    def save_map_bytes(self, map_bytes, file_name=None):
+        ## Unnamed maps are named after their contents, so concurrent saves can't clobber each other
+        if(not file_name):
+            file_name = "{}.{}".format(hashlib.sha1(map_bytes).hexdigest(), self.map_file_extension)
+
+        if(self.output_store):
+            return self.output_store.put(file_name, map_bytes)
+
         file_path = os.sep.join([self.output_folder_path, file_name])
         try:
-            pillow_image.save(file_path, format=self.map_file_extension)
-        except IOError as e:
+            os.makedirs(self.output_folder_path, exist_ok=True)
+            output_store.write_atomically(file_path, map_bytes)
+        except OSError as e:
             utilities.debug_print("Unable to save image at: '{}'.".format(file_path), e, debug_level=0)
             return None
         else:
             return file_path
 
 
+    def save_map(self, pillow_image, file_name=None):
+        return self.save_map_bytes(self.encode_map(pillow_image), file_name)
+
+
     def create_delete_map_callback(self, path):
         def _delete_map_callback():
             try:
@@ -106,6 +165,40 @@ class PlotterFileController:
         return _delete_map_callback
 
 
+class RenderOptions:
+    """
+    Per-request settings that change what gets rendered, beyond the map and the plane's path.
+    """
+
+    def __init__(self, tier=None, zoom_radius_km=None):
+        self.tier = tier
+        self.zoom_radius_km = zoom_radius_km
+
+
+class PlanePathOverlay:
+    """
+    Pre-drawn RGBA sprites for a single map and heading. The band sprite contains the parachute bands and the plane's
+    path, drawn through (center_x, center_y), and the triangle sprite contains the heading triangle centered on
+    (triangle_center, triangle_center).
+    """
+
+    def __init__(self, image, center_x, center_y, triangle_image, triangle_center):
+        self.image = image
+        self.center_x = center_x
+        self.center_y = center_y
+        self.triangle_image = triangle_image
+        self.triangle_center = triangle_center
+
+    ## Methods
+
+    def get_size(self):
+        ## Approximate memory footprint in bytes (4 bytes per RGBA pixel)
+        width, height = self.image.size
+        triangle_width, triangle_height = self.triangle_image.size
+
+        return (width * height + triangle_width * triangle_height) * 4
+
+
 class Plotter:
     ## Keys
     PARACHUTE_CONFIG_KEY = "parachute_config"
@@ -117,20 +210,164 @@ class Plotter:
     LONG_PARACHUTE_PATH_COLOR_KEY = "long_parachute_path_color"
     TRIANGLE_SIZE_KM_KEY = "triangle_size_km"
     TRIANGLE_COLOR_KEY = "triangle_color"
+    DEFAULT_RESOLUTION_TIER_KEY = "default_resolution_tier"
+    PLOT_OVERLAY_ENABLE_KEY = "plot_overlay_enable"
+    PLOT_OVERLAY_PRECOMPUTE_KEY = "plot_overlay_precompute"
+    PLOT_BAND_RENDERER_KEY = "plot_band_renderer"
+    MULTI_PATH_COLORS_KEY = "multi_path_colors"
+
+    ## Band renderers
+    PILLOW_RENDERER = "pillow"
+    NUMPY_RENDERER = "numpy"
 
 
     def __init__(self, **file_controller_kwargs):
         self.file_controller = PlotterFileController(**file_controller_kwargs)
         self.base_maps = self.file_controller.load_base_maps()
 
+        ## Each resolution tier keeps its own decoded copy of the base maps, except for the native resolution ones
+        self.tier_base_maps = {}
+        for tier, width in self.file_controller.resolution_tiers.items():
+            self.tier_base_maps[tier] = self.file_controller.load_base_maps(width) if width else self.base_maps
+        self.default_resolution_tier = CONFIG_OPTIONS.get(self.DEFAULT_RESOLUTION_TIER_KEY, "full")
+        ## Describes each map's size and grid layout, along with where each grid lands at each resolution
+        self.map_metadata = map_metadata.get_shared_map_metadata()
+
         self.plane_path_width_km = CONFIG_OPTIONS.get(self.PLANE_PATH_WIDTH_KM_KEY, 0.1)
         self.plane_path_color = CONFIG_OPTIONS.get(self.PLANE_PATH_COLOR_KEY, "white")
         self.triangle_size_km = CONFIG_OPTIONS.get(self.TRIANGLE_SIZE_KM_KEY, 0.2)
         self.triangle_color = CONFIG_OPTIONS.get(self.TRIANGLE_COLOR_KEY, "white")
+        ## Colors for every path after the first one, when several get plotted together
+        self.multi_path_colors = CONFIG_OPTIONS.get(self.MULTI_PATH_COLORS_KEY, ["rgb(90, 200, 255)", "rgb(255, 120, 210)"])
 
         self.parachute_config = CONFIG_OPTIONS.get(self.PARACHUTE_CONFIG_KEY, None)
         assert(self.parachute_config != None)
 
+        self.band_renderer = CONFIG_OPTIONS.get(self.PLOT_BAND_RENDERER_KEY, self.PILLOW_RENDERER)
+        if(self.band_renderer == self.NUMPY_RENDERER and not load_numpy()):
+            utilities.debug_print("NumPy isn't installed, falling back to the Pillow band renderer.", debug_level=1)
+            self.band_renderer = self.PILLOW_RENDERER
+
+        ## Overlays are the pre-drawn plane path sprites for each map and heading, which get composited onto the map
+        self.overlay_enable = CONFIG_OPTIONS.get(self.PLOT_OVERLAY_ENABLE_KEY, False)
+        self.overlays = overlay_cache.get_shared_overlay_cache()
+
+        ## Drop any cached renders (and overlays) that were made with different settings or base maps
+        self.render_cache = render_cache.get_shared_render_cache()
+        self.render_fingerprint = self._build_render_fingerprint()
+        self.render_cache.validate(self.render_fingerprint)
+        self.overlays.validate(self.render_fingerprint)
+
+        if(self.overlay_enable and CONFIG_OPTIONS.get(self.PLOT_OVERLAY_PRECOMPUTE_KEY, False)):
+            self.overlays.start_precompute(self.precompute_overlays)
+
+
+    def _build_render_fingerprint(self):
+        settings = {
+            "plane_path_width_km": self.plane_path_width_km,
+            "plane_path_color": self.plane_path_color,
+            "triangle_size_km": self.triangle_size_km,
+            "triangle_color": self.triangle_color,
+            "multi_path_colors": self.multi_path_colors,
+            "parachute_config": self.parachute_config,
+            "plot_overlay_enable": self.overlay_enable,
+            "plot_band_renderer": self.band_renderer,
+            "base_maps": self.file_controller.get_base_map_signatures(),
+            "map_metadata": {map_name: metadata.get_layout() for map_name, metadata in self.map_metadata.metadata.items()},
+            "resolution_tiers": self.file_controller.resolution_tiers,
+            "encoder": self._get_encoder_settings()
+        }
+        serialized = json.dumps(settings, sort_keys=True)
+
+        return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+    def _get_encoder_settings(self):
+        encoder = self.file_controller.encoder
+
+        return [
+            encoder.quality,
+            encoder.min_quality,
+            encoder.jpeg_progressive,
+            encoder.jpeg_subsampling,
+            encoder.webp_method,
+            encoder.png_colors,
+            encoder.target_bytes
+        ]
+
+
+    def build_render_key(self, map_name, path_obj, render_options=None):
+        ## Mirrors the fields exposed by PathObject.__str__ (for each path), plus anything else that changes the encoded
+        ## output
+        render_options = render_options if render_options else RenderOptions()
+        path_fields = []
+        for path in path_obj.paths:
+            path_fields.extend([path.grid_obj.x, path.grid_obj.y, path.grid_obj.section, path.heading_obj.heading])
+
+        return tuple([map_name] + path_fields + [
+            render_options.tier if render_options.tier else self.default_resolution_tier,
+            render_options.zoom_radius_km,
+            self.file_controller.map_file_extension
+        ])
+
+
+    def _build_output_file_name(self, render_key):
+        ## Stored renders are only reused while the settings that drew them are still the same
+        return self.file_controller.output_store.build_file_name(
+            (self.render_fingerprint, render_key),
+            self.file_controller.map_file_extension
+        )
+
+
+    def get_cached_render(self, render_key):
+        ## Check the in-memory cache first, and then any renders that were kept on disk
+        map_bytes = self.render_cache.get(render_key)
+        if(map_bytes is None and self.file_controller.output_store):
+            map_bytes = self.file_controller.output_store.get(self._build_output_file_name(render_key))
+            if(map_bytes is not None):
+                self.render_cache.put(render_key, map_bytes)
+
+        return map_bytes
+
+
+    def cache_render(self, render_key, map_bytes):
+        self.render_cache.put(render_key, map_bytes)
+        return self.save_render(render_key, map_bytes)
+
+
+    def save_render(self, render_key, map_bytes):
+        ## Returns the path of the stored render, or None if renders aren't being kept on disk
+        if(self.file_controller.output_store is None):
+            return None
+
+        return self.file_controller.output_store.put(self._build_output_file_name(render_key), map_bytes)
+
+
+    def render_stored_map(self, map_name, path_obj, render_options=None, render_job=None):
+        """
+        Like render_map, but also makes sure that the render is kept in the output store, and returns its stored path
+        along with the encoded map. The map is drawn with render_job (encode_plane_path by default) if it isn't cached.
+        This reads and writes the disk, so it's meant to be run outside of the event loop.
+        """
+
+        render_key = self.build_render_key(map_name, path_obj, render_options)
+        map_bytes = self.get_cached_render(render_key)
+        if(map_bytes is None):
+            render_job = render_job if render_job else self.encode_plane_path
+            map_bytes = render_job(map_name, path_obj, render_options)
+            self.render_cache.put(render_key, map_bytes)
+
+        return map_bytes, self.save_render(render_key, map_bytes)
+
+
+    def get_base_map(self, map_name, tier=None):
+        tier = tier if tier else self.default_resolution_tier
+        base_maps = self.tier_base_maps.get(tier)
+        if(base_maps is None):
+            raise RuntimeError("Unknown resolution tier '{}'".format(tier))
+
+        return base_maps[map_name]
+
 
     def _rotate_coordinate(self, x, y, angle):
         """
@@ -198,42 +435,316 @@ class Plotter:
         return image
 
 
-    def plot_plane_path(self, map_name, path_obj):
-        ## Get a copy of the map, so it's never overridden
-        base_map = self.base_maps[map_name].copy()
-        pixels_per_km = base_map.size[0] // 8
-
-        ## Get the height and width of the map image, and calculate the diagonal's length
-        map_width, map_height = base_map.size
-        map_diagonal_length = int(math.sqrt(pow(map_width, 2) + pow(map_height, 2)))
-
-        ## Get the x, y, and angle supplied by the user
-        x = path_obj.grid_obj.get_true_x(pixels_per_km)
-        y = path_obj.grid_obj.get_true_y(pixels_per_km)
-        angle = math.radians(path_obj.heading_obj.angle)
-
-        ## Generate the x and y coord pairs for the plane's path line
-        x1 = x - map_diagonal_length * math.cos(angle)
-        y1 = y + map_diagonal_length * math.sin(angle)  ## Invert both the y components; upside down coordinate system
-        x2 = x + map_diagonal_length * math.cos(angle)
-        y2 = y - map_diagonal_length * math.sin(angle)
-
+    def _get_path_widths(self, map_name, pixels_per_km):
         ## Get the correct parachute config from the dict
         parachute_config = self.parachute_config[map_name]
 
-        ## Prep widths
         plane_path_width = int(self.plane_path_width_km * pixels_per_km)
         triangle_size = int(self.triangle_size_km * pixels_per_km)
         ## *2 because the width is only half of what it should be, since players can drop in any direction
         short_parachute_path_width = int(parachute_config[self.SHORT_PARACHUTE_PATH_WIDTH_KM_KEY] * pixels_per_km * 2)
         long_parachute_path_width = int(parachute_config[self.LONG_PARACHUTE_PATH_WIDTH_KM_KEY] * pixels_per_km * 2)
 
-        ## Plot the requisite lines
-        ## Todo: plot in place
-        plotted_map = self._plot_line(base_map, x1, y1, x2, y2, long_parachute_path_width, parachute_config[self.LONG_PARACHUTE_PATH_COLOR_KEY])
-        plotted_map = self._plot_line(base_map, x1, y1, x2, y2, short_parachute_path_width, parachute_config[self.SHORT_PARACHUTE_PATH_COLOR_KEY])
-        plotted_map = self._plot_line(base_map, x1, y1, x2, y2, plane_path_width, self.plane_path_color)
-        plotted_map = self._plot_triangle(base_map, x, y, angle, triangle_size, self.triangle_color)
+        return plane_path_width, triangle_size, short_parachute_path_width, long_parachute_path_width
+
+
+    def _build_overlay(self, map_name, heading_angle, map_size, pixels_per_km):
+        """
+        Draw the parachute bands, plane path, and triangle for the given heading onto transparent sprites, sized so
+        that the bands cover the whole map no matter where along them the sprite gets placed.
+        """
+
+        parachute_config = self.parachute_config[map_name]
+        plane_path_width, triangle_size, short_parachute_path_width, long_parachute_path_width = self._get_path_widths(map_name, pixels_per_km)
+        angle = math.radians(heading_angle)
+        cos = math.cos(angle)
+        sin = math.sin(angle)
+
+        ## Every map pixel is at most half a diagonal (along the path) from where the sprite gets anchored, and the
+        ## widest band reaches out half of its width (across the path). Pad for anchor rounding and line caps.
+        map_width, map_height = map_size
+        half_length = math.sqrt(pow(map_width, 2) + pow(map_height, 2)) / 2 + 2
+        half_width = long_parachute_path_width / 2 + 2
+        center_x = int(math.ceil(half_length * abs(cos) + half_width * abs(sin)))
+        center_y = int(math.ceil(half_length * abs(sin) + half_width * abs(cos)))
+        size = (center_x * 2 + 1, center_y * 2 + 1)
+
+        ## Invert both the y components; upside down coordinate system
+        x1 = center_x - half_length * cos
+        y1 = center_y + half_length * sin
+        x2 = center_x + half_length * cos
+        y2 = center_y - half_length * sin
+
+        ## Each band gets its own layer, so that they blend together just like they would when drawn onto the map
+        bands = [
+            (long_parachute_path_width, parachute_config[self.LONG_PARACHUTE_PATH_COLOR_KEY]),
+            (short_parachute_path_width, parachute_config[self.SHORT_PARACHUTE_PATH_COLOR_KEY]),
+            (plane_path_width, self.plane_path_color)
+        ]
+        overlay = Image.new("RGBA", size, (0, 0, 0, 0))
+        for width, color in bands:
+            layer = self._plot_line(Image.new("RGBA", size, (0, 0, 0, 0)), x1, y1, x2, y2, width, color)
+            overlay = Image.alpha_composite(overlay, layer)
+
+        ## The triangle moves along the path with the grid position, so it gets its own little sprite
+        triangle_center = triangle_size
+        triangle_image = Image.new("RGBA", (triangle_center * 2 + 1, triangle_center * 2 + 1), (0, 0, 0, 0))
+        triangle_image = self._plot_triangle(triangle_image, triangle_center, triangle_center, angle, triangle_size, self.triangle_color)
+
+        return PlanePathOverlay(overlay, center_x, center_y, triangle_image, triangle_center)
+
+
+    def get_overlay(self, map_name, heading_angle, map_size, pixels_per_km):
+        overlay_key = (map_name, heading_angle, map_size, pixels_per_km)
+        overlay = self.overlays.get(overlay_key)
+        if(overlay is not None):
+            return overlay
+
+        ## Build outside of the cache's lock, worst case two threads end up drawing the same sprite
+        overlay = self._build_overlay(map_name, heading_angle, map_size, pixels_per_km)
+        self.overlays.put(overlay_key, overlay)
+
+        return overlay
+
+
+    def precompute_overlays(self, map_names=None, headings=None, tier=None):
+        map_names = map_names if map_names else list(self.base_maps.keys())
+        headings = headings if headings else range(360)
+
+        ## Anything past the cache's size would just push out the overlays that were drawn before it
+        overlay_count = len(map_names) * len(headings)
+        if(overlay_count > self.overlays.max_entries):
+            utilities.debug_print("Not precomputing {} overlays, since the overlay cache only holds {}. Raise '{}' to precompute them.".format(
+                overlay_count, self.overlays.max_entries, self.overlays.PLOT_OVERLAY_CACHE_SIZE_KEY), debug_level=1)
+            return False
+
+        for map_name in map_names:
+            base_map = self.get_base_map(map_name, tier)
+            pixels_per_km = self.map_metadata.get(map_name).get_grid_table(base_map.size).pixels_per_km
+            for heading in headings:
+                angle = (450 - heading) % 360
+                self.get_overlay(map_name, angle, base_map.size, pixels_per_km)
+
+        return True
+
+
+    def _composite_plane_path(self, base_map, map_name, x, y, heading_angle, pixels_per_km):
+        """
+        Blit the pre-drawn sprites for the heading onto the map, so that the path runs through (x,y).
+        """
+
+        overlay = self.get_overlay(map_name, heading_angle, base_map.size, pixels_per_km)
+        angle = math.radians(heading_angle)
+
+        ## Slide the sprite's anchor along the path until it's as close to the map's center as possible, since that's
+        ## what the sprite was sized around.
+        map_width, map_height = base_map.size
+        distance = (x - map_width / 2) * math.cos(angle) - (y - map_height / 2) * math.sin(angle)
+        anchor_x = x - int(round(distance * math.cos(angle)))
+        anchor_y = y + int(round(distance * math.sin(angle)))
+
+        base_map.paste(overlay.image, (anchor_x - overlay.center_x, anchor_y - overlay.center_y), overlay.image)
+        base_map.paste(overlay.triangle_image, (x - overlay.triangle_center, y - overlay.triangle_center), overlay.triangle_image)
+
+        return base_map
+
+
+    def _get_zoom_viewport(self, map_size, points, radius):
+        ## Get the box around every (x,y) point with the given radius, clipped to the map
+        map_width, map_height = map_size
+        xs = [x for x, y in points]
+        ys = [y for x, y in points]
+
+        return (max(0, min(xs) - radius), max(0, min(ys) - radius), min(map_width, max(xs) + radius), min(map_height, max(ys) + radius))
+
+
+    def _get_path_colors(self, map_name, index):
+        """
+        Get the long parachute band, short parachute band, plane path, and triangle colors for the index'th path on the
+        map. The first path uses the configured colors, and any others swap in a color of their own, while keeping the
+        bands' transparency.
+        """
+
+        parachute_config = self.parachute_config[map_name]
+        long_color = parachute_config[self.LONG_PARACHUTE_PATH_COLOR_KEY]
+        short_color = parachute_config[self.SHORT_PARACHUTE_PATH_COLOR_KEY]
+        if(index == 0):
+            return long_color, short_color, self.plane_path_color, self.triangle_color
+
+        color = ImageColor.getrgb(self.multi_path_colors[(index - 1) % len(self.multi_path_colors)])
+        band_colors = []
+        for band_color in [long_color, short_color]:
+            rgba = ImageColor.getrgb(band_color)
+            opacity = rgba[3] if len(rgba) > 3 else 255
+            band_colors.append("rgba({}, {}, {}, {})".format(color[0], color[1], color[2], opacity))
+
+        path_color = "rgb({}, {}, {})".format(*color[:3])
+        return band_colors[0], band_colors[1], path_color, path_color
+
+
+    def _get_band_tile_boxes(self, map_size, x, y, angle, reach):
+        """
+        Get the boxes of the tiles (as laid out by the tile store) that come within reach of the line through (x,y).
+        """
+
+        tile_size = tile_store.get_shared_tile_store().tile_size
+        map_width, map_height = map_size
+        ## A tile can be skipped if even its furthest corner is out of reach, once measured from its center
+        reach += tile_size / math.sqrt(2)
+
+        boxes = []
+        for top in range(0, map_height, tile_size):
+            for left in range(0, map_width, tile_size):
+                right = min(map_width, left + tile_size)
+                bottom = min(map_height, top + tile_size)
+                distance = ((left + right) / 2 - x) * math.sin(angle) + ((top + bottom) / 2 - y) * math.cos(angle)
+                if(abs(distance) <= reach):
+                    boxes.append((left, top, right, bottom))
+
+        return boxes
+
+
+    def _plot_bands_pillow(self, base_map, map_name, x, y, heading_angle, pixels_per_km, colors):
+        ## Draw the parachute bands and the plane's path as wide lines through (x,y)
+        long_color, short_color, path_color, triangle_color = colors
+        plane_path_width, triangle_size, short_parachute_path_width, long_parachute_path_width = self._get_path_widths(map_name, pixels_per_km)
+        angle = math.radians(heading_angle)
+
+        ## Generate the x and y coord pairs for the plane's path line, clipped to just past the edges of the map so that
+        ## the ends of even the widest band stay out of sight
+        line = map_metadata.clip_line(x, y, angle, base_map.size, long_parachute_path_width / 2 + 2)
+        if(line is not None):
+            ## Pillow truncates the endpoints into whole pixels, which tilts shorter lines more, so round them instead
+            x1, y1, x2, y2 = [int(round(coordinate)) for coordinate in line]
+
+            ## Plot the requisite lines
+            self._plot_line(base_map, x1, y1, x2, y2, long_parachute_path_width, long_color)
+            self._plot_line(base_map, x1, y1, x2, y2, short_parachute_path_width, short_color)
+            self._plot_line(base_map, x1, y1, x2, y2, plane_path_width, path_color)
+
+        return base_map
+
+
+    def _plot_bands_numpy(self, base_map, map_name, x, y, heading_angle, pixels_per_km, colors):
+        """
+        Blend the parachute bands and the plane's path onto the map in a single vectorized pass, using each pixel's
+        distance from the plane's path. Band edges are anti-aliased across a single pixel.
+        """
+
+        long_color, short_color, path_color, triangle_color = colors
+        plane_path_width, triangle_size, short_parachute_path_width, long_parachute_path_width = self._get_path_widths(map_name, pixels_per_km)
+        angle = math.radians(heading_angle)
+        bands = [
+            (long_parachute_path_width, long_color),
+            (short_parachute_path_width, short_color),
+            (plane_path_width, path_color)
+        ]
+
+        ## The blended result only depends on a pixel's distance from the path, so precompute it for every distance
+        ## (in steps of a fraction of a pixel) as: output = pixel * keep + add
+        steps_per_pixel = 8
+        distance_steps = (numpy.arange(int(long_parachute_path_width / 2 + 2) * steps_per_pixel, dtype=numpy.float32) + 0.5) / steps_per_pixel
+        keep = numpy.ones(len(distance_steps), dtype=numpy.float32)
+        add = numpy.zeros((len(distance_steps), 3), dtype=numpy.float32)
+        for width, color in bands:
+            rgba = ImageColor.getrgb(color)
+            opacity = (rgba[3] if len(rgba) > 3 else 255) / 255
+
+            ## Fully covered inside the band, fading out over the pixel that straddles its edge
+            alpha = numpy.clip(width / 2 + 0.5 - distance_steps, 0, 1) * opacity
+            keep *= 1 - alpha
+            add = add * (1 - alpha)[:, numpy.newaxis] + numpy.outer(alpha, numpy.array(rgba[:3], dtype=numpy.float32))
+        ## The extra 0.5 rounds the result to the nearest integer when it gets truncated back into bytes
+        add += 0.5
+
+        ## The base map's already a copy, so it can be drawn on directly
+        plotted_map = base_map if base_map.mode == "RGB" else base_map.convert("RGB")
+
+        ## Only the tiles that the bands pass through get blended, so the working arrays scale with the path's footprint
+        ## rather than the map's size
+        for box in self._get_band_tile_boxes(plotted_map.size, x, y, angle, distance_steps[-1]):
+            left, top, right, bottom = box
+
+            ## Distance of each pixel from the line through (x,y), along the line's normal (sin, cos), since the path's
+            ## direction is (cos, -sin) in the upside down coordinate system
+            x_offsets = (numpy.arange(left, right, dtype=numpy.float32) - x) * (math.sin(angle) * steps_per_pixel)
+            y_offsets = (numpy.arange(top, bottom, dtype=numpy.float32) - y) * (math.cos(angle) * steps_per_pixel)
+            indexes = numpy.abs(y_offsets[:, numpy.newaxis] + x_offsets[numpy.newaxis, :]).astype(numpy.int32)
+            numpy.minimum(indexes, len(distance_steps) - 1, out=indexes)
+
+            ## The last step is past every band, so everything out there is left as is
+            pixels = numpy.asarray(plotted_map.crop(box), dtype=numpy.float32)
+            pixels *= numpy.take(keep, indexes)[:, :, numpy.newaxis]
+            pixels += numpy.take(add, indexes, axis=0)
+            plotted_map.paste(Image.fromarray(pixels.astype(numpy.uint8), "RGB"), (left, top))
+
+        return plotted_map
+
+
+    def plot_plane_path(self, map_name, path_obj, render_options=None):
+        """
+        Plot the plane's path onto a copy of the map. Multiple paths (see MultiPathObject) all get drawn onto the same
+        copy, each in their own color.
+        """
+
+        render_options = render_options if render_options else RenderOptions()
+        base_map = self.get_base_map(map_name, render_options.tier)
+        grid_table = self.map_metadata.get(map_name).get_grid_table(base_map.size)
+        pixels_per_km = grid_table.pixels_per_km
+
+        ## Get the x, y, and angle supplied by the user for each path
+        paths = path_obj.paths
+        points = [grid_table.get_point(path.grid_obj) for path in paths]
+
+        if(render_options.zoom_radius_km):
+            ## Only copy the region around the planes, and shift their positions into the viewport's coordinates
+            viewport = self._get_zoom_viewport(base_map.size, points, int(render_options.zoom_radius_km * pixels_per_km))
+            base_map = base_map.crop(viewport)
+            points = [(x - viewport[0], y - viewport[1]) for x, y in points]
+        else:
+            ## Get a copy of the map, so it's never overridden
+            base_map = base_map.copy()
+
+        ## The overlay sprites are drawn in the first path's colors, so they're only used for single paths
+        if(self.overlay_enable and self.band_renderer == self.PILLOW_RENDERER and len(paths) == 1):
+            x, y = points[0]
+            return self._composite_plane_path(base_map, map_name, x, y, paths[0].heading_obj.angle, pixels_per_km)
+
+        plot_bands = self._plot_bands_numpy if self.band_renderer == self.NUMPY_RENDERER else self._plot_bands_pillow
+        plotted_map = base_map
+        for index, (path, (x, y)) in enumerate(zip(paths, points)):
+            colors = self._get_path_colors(map_name, index)
+            plotted_map = plot_bands(plotted_map, map_name, x, y, path.heading_obj.angle, pixels_per_km, colors)
+
+        ## The triangles go on last, so that none of them end up underneath another path's bands
+        triangle_size = self._get_path_widths(map_name, pixels_per_km)[1]
+        for index, (path, (x, y)) in enumerate(zip(paths, points)):
+            triangle_color = self._get_path_colors(map_name, index)[3]
+            plotted_map = self._plot_triangle(plotted_map, x, y, math.radians(path.heading_obj.angle), triangle_size, triangle_color)
 
         ## return the final map
         return plotted_map
+
+
+    def encode_plane_path(self, map_name, path_obj, render_options=None):
+        ## Plot and encode the plane's path, without touching the render cache
+        plotted_map = self.plot_plane_path(map_name, path_obj, render_options)
+        tier = render_options.tier if render_options and render_options.tier else self.default_resolution_tier
+
+        return self.file_controller.encode_map(plotted_map, tier)
+
+
+    def render_map(self, map_name, path_obj, render_options=None):
+        """
+        Plot the plane's path and encode the result, reusing a previously encoded render of the same path if possible.
+        """
+
+        render_key = self.build_render_key(map_name, path_obj, render_options)
+        map_bytes = self.get_cached_render(render_key)
+        if(map_bytes is not None):
+            return map_bytes
+
+        map_bytes = self.encode_plane_path(map_name, path_obj, render_options)
+        self.cache_render(render_key, map_bytes)
+
+        return map_bytes
@@ -0,0 +1,132 @@
+import threading
+from collections import OrderedDict
+
+import utilities
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+
+class RenderCache:
+    ## Keys
+    RENDER_CACHE_ENABLE_KEY = "render_cache_enable"
+    RENDER_CACHE_MAX_BYTES_KEY = "render_cache_max_bytes"
+
+    ## Defaults
+    RENDER_CACHE_ENABLE = CONFIG_OPTIONS.get(RENDER_CACHE_ENABLE_KEY, True)
+    RENDER_CACHE_MAX_BYTES = CONFIG_OPTIONS.get(RENDER_CACHE_MAX_BYTES_KEY, 64 * 1024 * 1024)
+
+
+    def __init__(self, **kwargs):
+        self.enabled = kwargs.get(self.RENDER_CACHE_ENABLE_KEY, self.RENDER_CACHE_ENABLE)
+        self.max_bytes = kwargs.get(self.RENDER_CACHE_MAX_BYTES_KEY, self.RENDER_CACHE_MAX_BYTES)
+
+        ## Least recently used entries live at the front, most recently used at the back
+        self.entries = OrderedDict()
+        self.size = 0
+        self.fingerprint = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        ## Renders may be stored from outside of the event loop's thread
+        self._lock = threading.Lock()
+
+    ## Methods
+
+    def validate(self, fingerprint):
+        """
+        Compare the given render settings fingerprint against the one that the cached renders were made with, and
+        drop every cached render if they differ.
+        """
+
+        with self._lock:
+            if(self.fingerprint == fingerprint):
+                return True
+
+            if(self.fingerprint is not None):
+                utilities.debug_print("Render settings changed, invalidating {} cached renders.".format(len(self.entries)), debug_level=3)
+                self._clear()
+                self.invalidations += 1
+
+            self.fingerprint = fingerprint
+            return False
+
+
+    def _clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+            self.invalidations += 1
+
+
+    def get(self, key):
+        if(not self.enabled):
+            return None
+
+        with self._lock:
+            data = self.entries.get(key)
+            if(data is None):
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+
+    def put(self, key, data):
+        if(not self.enabled or data is None):
+            return False
+
+        ## Don't let a single oversized render flush out the entire cache
+        if(len(data) > self.max_bytes):
+            return False
+
+        with self._lock:
+            existing = self.entries.pop(key, None)
+            if(existing is not None):
+                self.size -= len(existing)
+
+            self.entries[key] = data
+            self.size += len(data)
+
+            while(self.size > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+        return True
+
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+## The shared cache lives outside of the cog modules, so it isn't thrown away when the cogs get reloaded
+_shared_render_cache = None
+
+
+def get_shared_render_cache():
+    global _shared_render_cache
+
+    if(_shared_render_cache is None):
+        _shared_render_cache = RenderCache()
+
+    return _shared_render_cache
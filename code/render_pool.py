@@ -0,0 +1,213 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import utilities
+import plotter
+import metrics
+import sharding
+import render_server
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+
+class RenderPoolFullError(RuntimeError):
+    pass
+
+
+## Each worker process keeps its own plotter (and base maps) around between jobs
+_worker_plotter = None
+
+
+def _get_worker_plotter():
+    global _worker_plotter
+
+    if(_worker_plotter is None):
+        _worker_plotter = plotter.Plotter()
+
+    return _worker_plotter
+
+
+def _render_in_worker(map_name, path_obj, render_options):
+    return _get_worker_plotter().encode_plane_path(map_name, path_obj, render_options)
+
+
+def _render_stored_in_worker(map_name, path_obj, render_options):
+    return _get_worker_plotter().render_stored_map(map_name, path_obj, render_options)
+
+
+class RenderPool:
+    ## Keys
+    RENDER_POOL_TYPE_KEY = "render_pool_type"
+    RENDER_POOL_WORKERS_KEY = "render_pool_workers"
+    RENDER_POOL_MAX_QUEUED_KEY = "render_pool_max_queued"
+    RENDER_POOL_TIMEOUT_SECONDS_KEY = "render_pool_timeout_seconds"
+
+    ## Defaults
+    RENDER_POOL_TYPE = CONFIG_OPTIONS.get(RENDER_POOL_TYPE_KEY, "thread")
+    RENDER_POOL_WORKERS = CONFIG_OPTIONS.get(RENDER_POOL_WORKERS_KEY, 2)
+    RENDER_POOL_MAX_QUEUED = CONFIG_OPTIONS.get(RENDER_POOL_MAX_QUEUED_KEY, 32)
+    RENDER_POOL_TIMEOUT_SECONDS = CONFIG_OPTIONS.get(RENDER_POOL_TIMEOUT_SECONDS_KEY, 10)
+    ## How many timeouts' worth of time a shared render keeps counting against the queue, after its command gave up
+    LOST_SHARED_RENDER_TIMEOUT_FACTOR = 10
+
+    ## Pool types
+    THREAD = "thread"
+    PROCESS = "process"
+    INLINE = "inline"
+    SHARED = "shared"
+    REMOTE = "remote"
+
+
+    def __init__(self, plotter, loop=None, **kwargs):
+        self.plotter = plotter
+        self.loop = loop
+
+        self.pool_type = kwargs.get(self.RENDER_POOL_TYPE_KEY, self.RENDER_POOL_TYPE)
+        self.workers = kwargs.get(self.RENDER_POOL_WORKERS_KEY, self.RENDER_POOL_WORKERS)
+        self.max_queued = kwargs.get(self.RENDER_POOL_MAX_QUEUED_KEY, self.RENDER_POOL_MAX_QUEUED)
+        self.timeout = kwargs.get(self.RENDER_POOL_TIMEOUT_SECONDS_KEY, self.RENDER_POOL_TIMEOUT_SECONDS)
+
+        ## Number of jobs that have been submitted, but haven't finished yet (running and waiting)
+        self.pending = 0
+        self.closed = False
+
+        ## Futures for the renders that are currently underway, so identical requests can share them
+        self.in_flight = {}
+        self.coalesced = 0
+        self.metrics = metrics.get_shared_metrics()
+
+        ## Shards started by the ShardLauncher always hand their renders off to the shared render workers
+        self.shared_render_client = sharding.get_shared_render_client()
+        if(self.shared_render_client is not None):
+            self.pool_type = self.SHARED
+
+        if(self.pool_type == self.SHARED):
+            if(self.shared_render_client is None):
+                raise RuntimeError("The shared render pool is only available to shards started by the ShardLauncher")
+            ## The shared render workers keep their renders in the output store themselves
+            self.executor = None
+            self._job = None
+            self._stored_job = None
+        elif(self.pool_type == self.THREAD):
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            self._job = self.plotter.encode_plane_path
+            self._stored_job = self.plotter.render_stored_map
+        elif(self.pool_type == self.PROCESS):
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            self._job = _render_in_worker
+            self._stored_job = _render_stored_in_worker
+        elif(self.pool_type == self.REMOTE):
+            ## Renders are made by a standalone RenderServer, these threads just wait on its responses
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            self._job = render_server.RenderServerClient().render
+            self._stored_job = functools.partial(self.plotter.render_stored_map, render_job=self._job)
+        elif(self.pool_type == self.INLINE):
+            self.executor = None
+            self._job = self.plotter.encode_plane_path
+            self._stored_job = self.plotter.render_stored_map
+        else:
+            raise RuntimeError("Unknown render pool type '{}'".format(self.pool_type))
+
+    ## Properties
+
+    @property
+    def stores_renders(self):
+        ## Whether the render jobs also keep their renders in the output store on disk
+        return self._stored_job is not None and self.plotter.file_controller.output_store is not None
+
+    ## Methods
+
+    def _get_loop(self):
+        return self.loop if self.loop else asyncio.get_event_loop()
+
+
+    async def render(self, map_name, path_obj, render_options=None):
+        """
+        Render and encode the plane's path outside of the event loop, reusing a cached render if one exists. Returns the
+        encoded map, along with the path that it's been stored at in the output store (or None if it isn't on disk).
+        """
+
+        ## In-memory cache hits are cheap enough to serve directly from the event loop. Renders that are kept in the
+        ## output store need the disk, so the render job takes care of looking those up.
+        render_key = self.plotter.build_render_key(map_name, path_obj, render_options)
+        if(not self.stores_renders):
+            map_bytes = self.plotter.render_cache.get(render_key)
+            if(map_bytes is not None):
+                return map_bytes, None
+
+        ## If the same map is already being drawn, then just wait for that one to finish. The render runs as its own
+        ## task, and every command (including the one that started it) waits on it through a shield, so one of the
+        ## waiting commands getting cancelled doesn't cancel it for everybody else.
+        task = self.in_flight.get(render_key)
+        if(task is not None):
+            self.coalesced += 1
+            self.metrics.increment("render_coalesced_total", {"map": map_name})
+        else:
+            task = asyncio.ensure_future(self._render(render_key, map_name, path_obj, render_options), loop=self._get_loop())
+            self.in_flight[render_key] = task
+            task.add_done_callback(lambda task: self._finish_render(render_key, task))
+
+        return await asyncio.shield(task)
+
+
+    def _finish_render(self, render_key, task):
+        if(self.in_flight.get(render_key) is task):
+            del self.in_flight[render_key]
+
+        ## Keeps asyncio from complaining about an unretrieved exception when every waiting command was cancelled
+        if(not task.cancelled()):
+            task.exception()
+
+
+    async def _render(self, render_key, map_name, path_obj, render_options):
+        if(self.closed):
+            raise RenderPoolFullError("The render pool is shutting down")
+        if(self.pending >= self.max_queued):
+            raise RenderPoolFullError("Too many maps are being drawn right now")
+
+        stores_renders = self.stores_renders
+        job_function = self._stored_job if stores_renders else self._job
+
+        loop = self._get_loop()
+        self.pending += 1
+        if(self.executor is None and self.shared_render_client is None):
+            try:
+                result = job_function(map_name, path_obj, render_options)
+            finally:
+                self.pending -= 1
+        else:
+            ## Neither the executor nor the shared render workers can stop a job once it's started, so it keeps counting
+            ## against the queue until it's really finished, even if the command waiting on it has already timed out
+            try:
+                if(self.shared_render_client is not None):
+                    ## A render worker that dies takes its jobs with it, so don't wait forever on its answer
+                    render = self.shared_render_client.render(map_name, path_obj, render_options, loop)
+                    lost_timeout = self.timeout * self.LOST_SHARED_RENDER_TIMEOUT_FACTOR
+                    job = asyncio.ensure_future(asyncio.wait_for(render, lost_timeout), loop=loop)
+                else:
+                    job = loop.run_in_executor(self.executor, job_function, map_name, path_obj, render_options)
+            except Exception:
+                self.pending -= 1
+                raise
+            job.add_done_callback(self._finish_job)
+            result = await asyncio.wait_for(asyncio.shield(job), self.timeout)
+
+        map_bytes, map_path = result if stores_renders else (result, None)
+        self.plotter.render_cache.put(render_key, map_bytes)
+        return map_bytes, map_path
+
+
+    def _finish_job(self, job):
+        self.pending -= 1
+        if(not job.cancelled()):
+            ## Keeps asyncio from complaining about an unretrieved exception when the command had already timed out
+            job.exception()
+
+
+    def shutdown(self, wait=False):
+        ## Stop accepting new jobs, and let the already submitted ones run to completion
+        self.closed = True
+        if(self.executor is not None):
+            self.executor.shutdown(wait=wait)
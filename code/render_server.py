@@ -0,0 +1,282 @@
+import json
+import time
+import argparse
+import threading
+import http.client
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, urlencode, parse_qs
+
+import utilities
+import metrics
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+
+class RenderServerError(RuntimeError):
+    pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RenderServer:
+    """
+    Serves rendered maps over HTTP, so the rendering can be run (and scaled, restarted, and benchmarked) separately from
+    the Discord bot.
+
+    GET /render?map=erangel&heading=90&grid=ak1[&heading=180&grid=dl5...][&tier=preview][&zoom=2] returns the encoded map
+    GET /health returns a JSON summary of the server's state
+    GET /metrics returns the server's metrics in the Prometheus text format
+    """
+
+    ## Keys
+    RENDER_SERVER_HOST_KEY = "render_server_host"
+    RENDER_SERVER_PORT_KEY = "render_server_port"
+    RENDER_SERVER_CACHE_KEY = "render_server_cache"
+
+    ## Defaults
+    RENDER_SERVER_HOST = CONFIG_OPTIONS.get(RENDER_SERVER_HOST_KEY, "127.0.0.1")
+    RENDER_SERVER_PORT = CONFIG_OPTIONS.get(RENDER_SERVER_PORT_KEY, 8470)
+    RENDER_SERVER_CACHE = CONFIG_OPTIONS.get(RENDER_SERVER_CACHE_KEY, True)
+
+    CONTENT_TYPES = {"jpeg": "image/jpeg", "jpg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+
+
+    def __init__(self, **kwargs):
+        ## Imported here, so that the client side of this module doesn't need to load up the plotter
+        import bot_io
+        import plotter
+
+        self.host = kwargs.get(self.RENDER_SERVER_HOST_KEY, self.RENDER_SERVER_HOST)
+        self.port = kwargs.get(self.RENDER_SERVER_PORT_KEY, self.RENDER_SERVER_PORT)
+        self.cache = kwargs.get(self.RENDER_SERVER_CACHE_KEY, self.RENDER_SERVER_CACHE)
+
+        self.path_parser = bot_io.PathParser()
+        self.plotter = plotter.Plotter()
+        self.render_options_cls = plotter.RenderOptions
+        self.content_type = self.CONTENT_TYPES.get(self.plotter.file_controller.map_file_extension.lower(), "application/octet-stream")
+
+        self.start_time = time.time()
+        self.requests = 0
+        self.metrics = metrics.get_shared_metrics()
+        self.http_server = None
+
+    ## Methods
+
+    def _get_param(self, params, name, required=True):
+        values = params.get(name)
+        if(not values):
+            if(required):
+                raise RenderServerError("Missing the '{}' parameter".format(name))
+            return None
+
+        return values[0]
+
+
+    def parse_request(self, params):
+        map_name = self._get_param(params, "map").lower()
+        if(map_name not in self.plotter.base_maps):
+            raise RenderServerError("Unknown map '{}'".format(map_name))
+
+        ## Go through the same parser as the bot's commands, so both accept the same headings and grid markers. Repeating
+        ## the heading and grid parameters plots several paths at once
+        headings = params.get("heading") or [self._get_param(params, "heading")]
+        grids = params.get("grid") or [self._get_param(params, "grid")]
+        if(len(headings) != len(grids)):
+            raise RenderServerError("Every 'heading' parameter needs a matching 'grid' parameter")
+        message = " ".join("{} {}".format(heading, grid) for heading, grid in zip(headings, grids))
+        try:
+            path_obj = self.path_parser.parse_message(message, map_name)
+        except RuntimeError as e:
+            raise RenderServerError(str(e))
+
+        render_options = self.render_options_cls()
+        tier = self._get_param(params, "tier", False)
+        if(tier):
+            if(tier not in self.plotter.tier_base_maps):
+                raise RenderServerError("Unknown resolution tier '{}'".format(tier))
+            render_options.tier = tier
+
+        zoom = self._get_param(params, "zoom", False)
+        if(zoom):
+            try:
+                render_options.zoom_radius_km = float(zoom)
+            except ValueError:
+                raise RenderServerError("Invalid zoom radius '{}'".format(zoom))
+            if(render_options.zoom_radius_km <= 0):
+                raise RenderServerError("Invalid zoom radius '{}'".format(zoom))
+
+        return map_name, path_obj, render_options
+
+
+    def render(self, params):
+        map_name, path_obj, render_options = self.parse_request(params)
+
+        with self.metrics.timer("render_server_seconds", {"map": map_name}):
+            if(self.cache):
+                return self.plotter.render_map(map_name, path_obj, render_options)
+            else:
+                return self.plotter.encode_plane_path(map_name, path_obj, render_options)
+
+
+    def get_health(self):
+        return {
+            "status": "ok",
+            "uptime_seconds": time.time() - self.start_time,
+            "requests": self.requests,
+            "maps": sorted(self.plotter.base_maps.keys()),
+            "resolution_tiers": sorted(self.plotter.tier_base_maps.keys()),
+            "render_cache": self.plotter.render_cache.get_stats() if self.cache else None
+        }
+
+
+    def build_request_handler(self):
+        render_server = self
+
+        class RenderRequestHandler(BaseHTTPRequestHandler):
+            ## HTTP/1.1 keeps the connection open between requests, as long as every response has a Content-Length
+            protocol_version = "HTTP/1.1"
+
+
+            def _send(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+
+            def do_GET(self):
+                render_server.requests += 1
+                url = urlsplit(self.path)
+                if(url.path == "/render"):
+                    try:
+                        map_bytes = render_server.render(parse_qs(url.query))
+                    except RenderServerError as e:
+                        render_server.metrics.increment("render_server_requests_total", {"outcome": "invalid"})
+                        self._send(400, "text/plain", str(e).encode("utf-8"))
+                    except Exception as e:
+                        utilities.debug_print("Error rendering map for: '{}'.".format(self.path), e, debug_level=1)
+                        render_server.metrics.increment("render_server_requests_total", {"outcome": "error"})
+                        self._send(500, "text/plain", str(e).encode("utf-8"))
+                    else:
+                        render_server.metrics.increment("render_server_requests_total", {"outcome": "success"})
+                        self._send(200, render_server.content_type, map_bytes)
+                elif(url.path == "/health"):
+                    self._send(200, "application/json", json.dumps(render_server.get_health()).encode("utf-8"))
+                elif(url.path == "/metrics"):
+                    self._send(200, "text/plain; version=0.0.4", render_server.metrics.render_text().encode("utf-8"))
+                else:
+                    self._send(404, "text/plain", b"Not found")
+
+
+            def log_message(self, *args):
+                pass
+
+        return RenderRequestHandler
+
+
+    def serve_forever(self):
+        self.http_server = ThreadingHTTPServer((self.host, self.port), self.build_request_handler())
+        print("Serving maps on http://{}:{}".format(self.host, self.http_server.server_address[1]))
+        try:
+            self.http_server.serve_forever()
+        finally:
+            self.http_server.server_close()
+
+
+    def shutdown(self):
+        if(self.http_server):
+            self.http_server.shutdown()
+
+
+class RenderServerClient:
+    """
+    Blocking client for the RenderServer, which keeps one persistent connection open per calling thread.
+    """
+
+    ## Keys
+    RENDER_SERVER_URL_KEY = "render_server_url"
+    RENDER_SERVER_TIMEOUT_SECONDS_KEY = "render_server_timeout_seconds"
+
+    ## Defaults
+    RENDER_SERVER_URL = CONFIG_OPTIONS.get(RENDER_SERVER_URL_KEY, "http://127.0.0.1:8470")
+    RENDER_SERVER_TIMEOUT_SECONDS = CONFIG_OPTIONS.get(RENDER_SERVER_TIMEOUT_SECONDS_KEY, 10)
+
+
+    def __init__(self, **kwargs):
+        url = urlsplit(kwargs.get(self.RENDER_SERVER_URL_KEY, self.RENDER_SERVER_URL))
+        self.host = url.hostname
+        self.port = url.port
+        self.timeout = kwargs.get(self.RENDER_SERVER_TIMEOUT_SECONDS_KEY, self.RENDER_SERVER_TIMEOUT_SECONDS)
+
+        self._local = threading.local()
+
+    ## Methods
+
+    def _get_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if(connection is None):
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self._local.connection = connection
+
+        return connection
+
+
+    def _request(self, path):
+        ## Retry once on a fresh connection, in case the server closed the old one while it sat idle
+        for attempt in range(2):
+            connection = self._get_connection()
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                self._local.connection = None
+                if(attempt):
+                    ## Callers only need to handle the one kind of error, whether the server's down or just unhappy
+                    raise RenderServerError("Unable to reach the render server at {}:{}: {}".format(self.host, self.port, e)) from e
+
+
+    def render(self, map_name, path_obj, render_options=None):
+        params = {
+            "map": map_name,
+            "heading": [path.heading_obj.heading for path in path_obj.paths],
+            "grid": ["{}{}{}".format(path.grid_obj.x, path.grid_obj.y, path.grid_obj.section if path.grid_obj.section else "") for path in path_obj.paths]
+        }
+        if(render_options and render_options.tier):
+            params["tier"] = render_options.tier
+        if(render_options and render_options.zoom_radius_km):
+            params["zoom"] = render_options.zoom_radius_km
+
+        status, body = self._request("/render?{}".format(urlencode(params, doseq=True)))
+        if(status != 200):
+            raise RenderServerError("Render server responded with {}: {}".format(status, body.decode("utf-8", "replace")))
+
+        return body
+
+
+    def get_health(self):
+        status, body = self._request("/health")
+        if(status != 200):
+            raise RenderServerError("Render server responded with {}".format(status))
+
+        return json.loads(body.decode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve Plane Pal's rendered maps over HTTP.")
+    parser.add_argument("--host", default=RenderServer.RENDER_SERVER_HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=RenderServer.RENDER_SERVER_PORT, help="Port to listen on")
+    parser.add_argument("--no-cache", action="store_true", help="Render every request, rather than reusing cached renders")
+    args = parser.parse_args()
+
+    RenderServer(render_server_host=args.host, render_server_port=args.port, render_server_cache=not args.no_cache).serve_forever()
+
+
+if(__name__ == '__main__'):
+    main()
@@ -0,0 +1,61 @@
+import time
+
+import utilities
+import plotter
+import bot_io
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+BENCHMARK_ITERATIONS = 20
+BENCHMARK_QUERIES = [
+    ["erangel", "90 ak1"],
+    ["erangel", "45 dm5"],
+    ["erangel", "330 gp7"],
+    ["miramar", "115 al"],
+    ["miramar", "222 fn"]
+]
+
+
+class RendererBenchmark:
+    """
+    Times each of the plotter's band renderers at every resolution tier, so they can be compared against each other.
+    """
+
+    def __init__(self, iterations=BENCHMARK_ITERATIONS):
+        self.path_parser = bot_io.PathParser()
+        self.plotter = plotter.Plotter(output_folder_path=None)
+        self.iterations = iterations
+
+        renderers = [("pillow", self.plotter.PILLOW_RENDERER, False), ("overlay", self.plotter.PILLOW_RENDERER, True)]
+        if(plotter.load_numpy()):
+            renderers.append(("numpy", self.plotter.NUMPY_RENDERER, False))
+        else:
+            print("NumPy isn't installed, skipping the NumPy band renderer.")
+
+        queries = [(map_name, self.path_parser.parse_message(message, map_name)) for map_name, message in BENCHMARK_QUERIES]
+        for tier in self.plotter.tier_base_maps:
+            render_options = plotter.RenderOptions(tier=tier)
+            width = self.plotter.get_base_map(queries[0][0], tier).size[0]
+            for name, band_renderer, overlay_enable in renderers:
+                self.plotter.band_renderer = band_renderer
+                self.plotter.overlay_enable = overlay_enable
+                milliseconds = self.time_renderer(queries, render_options)
+                print("{} ({}px) {}: {:.2f} ms per plot".format(tier, width, name, milliseconds))
+
+
+    def time_renderer(self, queries, render_options):
+        ## Warm up first, so that the overlay renderer isn't penalized for drawing its sprites
+        for map_name, path_obj in queries:
+            self.plotter.plot_plane_path(map_name, path_obj, render_options)
+
+        start = time.perf_counter()
+        for _ in range(self.iterations):
+            for map_name, path_obj in queries:
+                self.plotter.plot_plane_path(map_name, path_obj, render_options)
+
+        return (time.perf_counter() - start) * 1000 / (self.iterations * len(queries))
+
+
+if(__name__ == '__main__'):
+    RendererBenchmark()
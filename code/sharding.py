@@ -0,0 +1,438 @@
+import time
+import queue
+import ctypes
+import asyncio
+import argparse
+import threading
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from PIL import Image
+
+import utilities
+import metrics
+import map_assets
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+
+class RenderWorkerError(RuntimeError):
+    pass
+
+
+class SharedBaseMap:
+    """
+    A decoded base map that lives in shared memory, so every shard and render worker can draw from the same copy of it.
+    """
+
+    ## Pillow modes that can be laid out in shared memory as is
+    RAW_MODES = ["L", "RGB", "RGBA"]
+
+
+    def __init__(self, map_path, width, image):
+        if(image.mode not in self.RAW_MODES):
+            image = image.convert("RGB")
+
+        self.map_path = map_path
+        self.width = width
+        self.mode = image.mode
+        self.size = image.size
+
+        pixels = image.tobytes()
+        self.buffer = RawArray("B", len(pixels))
+        ctypes.memmove(self.buffer, pixels, len(pixels))
+
+    ## Methods
+
+    def get_image(self):
+        ## The image reads straight out of the shared buffer, so it has to be copied (or cropped) before drawing on it
+        return Image.frombuffer(self.mode, self.size, self.buffer, "raw", self.mode, 0, 1)
+
+
+def build_shared_base_maps(**file_controller_kwargs):
+    ## Imported here, since the render workers and shards need to be able to import this module cheaply
+    import plotter
+
+    file_controller = plotter.PlotterFileController(**file_controller_kwargs)
+    ## Use a throwaway registry, so the launcher doesn't hang onto its own copy of every map
+    registry = map_assets.MapAssetRegistry()
+
+    shared_base_maps = []
+    widths = set([None] + list(file_controller.resolution_tiers.values()))
+    for map_path in file_controller.map_file_paths.values():
+        for width in widths:
+            base_map = registry.get_base_map(map_path, width)
+            ## Tiled maps are already shared between processes through the page cache, so it's enough to have made
+            ## sure they've been converted before the shards and workers start mapping them
+            if(not registry.tile_store.enabled):
+                shared_base_maps.append(SharedBaseMap(map_path, width, base_map))
+
+    return shared_base_maps
+
+
+def attach_shared_base_maps(shared_base_maps):
+    registry = map_assets.get_shared_map_assets()
+    for shared_base_map in shared_base_maps:
+        registry.add_base_map(shared_base_map.map_path, shared_base_map.width, shared_base_map.get_image())
+
+
+class ShardStats:
+    """
+    Heartbeats and counters for each shard and render worker, kept in shared memory so the launcher can report on them.
+    """
+
+    def __init__(self, shard_count, worker_count):
+        self.shard_count = shard_count
+        self.worker_count = worker_count
+
+        self.shard_heartbeats = multiprocessing.Array("d", shard_count)
+        self.shard_renders = multiprocessing.Array("L", shard_count)
+        self.shard_failures = multiprocessing.Array("L", shard_count)
+        self.worker_heartbeats = multiprocessing.Array("d", worker_count)
+        self.worker_renders = multiprocessing.Array("L", worker_count)
+        self.worker_busy_seconds = multiprocessing.Array("d", worker_count)
+
+    ## Methods
+
+    def shard_heartbeat(self, shard_id):
+        self.shard_heartbeats[shard_id] = time.time()
+
+
+    def record_shard_render(self, shard_id, succeeded):
+        counter = self.shard_renders if succeeded else self.shard_failures
+        with counter.get_lock():
+            counter[shard_id] += 1
+
+
+    def worker_heartbeat(self, worker_id):
+        self.worker_heartbeats[worker_id] = time.time()
+
+
+    def record_worker_render(self, worker_id, seconds):
+        with self.worker_renders.get_lock():
+            self.worker_renders[worker_id] += 1
+            self.worker_busy_seconds[worker_id] += seconds
+
+
+    def get_snapshot(self):
+        return {
+            "shards": [(self.shard_heartbeats[index], self.shard_renders[index], self.shard_failures[index]) for index in range(self.shard_count)],
+            "workers": [(self.worker_heartbeats[index], self.worker_renders[index], self.worker_busy_seconds[index]) for index in range(self.worker_count)]
+        }
+
+
+def _run_render_worker(worker_id, shared_base_maps, request_queue, response_queues, stats):
+    attach_shared_base_maps(shared_base_maps)
+
+    import plotter
+    worker_plotter = plotter.Plotter()
+
+    while(True):
+        stats.worker_heartbeat(worker_id)
+        try:
+            job = request_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+
+        ## None is the signal to shut down
+        if(job is None):
+            break
+
+        shard_id, request_id, map_name, path_obj, render_options = job
+        start = time.perf_counter()
+        try:
+            map_bytes = worker_plotter.render_map(map_name, path_obj, render_options)
+            error = None
+        except Exception as e:
+            map_bytes = None
+            error = "{}: {}".format(type(e).__name__, e)
+        seconds = time.perf_counter() - start
+
+        stats.record_worker_render(worker_id, seconds)
+        response_queues[shard_id].put((request_id, worker_id, map_bytes, error, seconds))
+
+
+class SharedRenderClient:
+    """
+    A shard's connection to the shared render workers. Jobs go out on the shared request queue, and their results come
+    back on the shard's own response queue.
+    """
+
+    ## How often the shard reports in to the launcher
+    HEARTBEAT_INTERVAL_SECONDS = 1
+
+
+    def __init__(self, shard_id, request_queue, response_queue, stats, loop=None):
+        self.shard_id = shard_id
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+        self.stats = stats
+
+        ## Maps each request's id onto the loop and future that are waiting for it
+        self.waiting = {}
+        self.next_request_id = 0
+        self.metrics = metrics.get_shared_metrics()
+
+        self._lock = threading.Lock()
+        threading.Thread(target=self._read_responses, name="SharedRenderResponses", daemon=True).start()
+
+        ## The heartbeat is sent from the shard's own event loop, so a shard whose loop is stuck stops reporting in
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.loop.call_soon(self._heartbeat)
+
+    ## Methods
+
+    def _heartbeat(self):
+        self.stats.shard_heartbeat(self.shard_id)
+        self.loop.call_later(self.HEARTBEAT_INTERVAL_SECONDS, self._heartbeat)
+
+
+    def _read_responses(self):
+        while(True):
+            request_id, worker_id, map_bytes, error, seconds = self.response_queue.get()
+            self.stats.record_shard_render(self.shard_id, error is None)
+            self.metrics.observe("shared_render_seconds", seconds, {"worker": worker_id})
+
+            with self._lock:
+                loop, future = self.waiting.pop(request_id, (None, None))
+            if(future is not None):
+                loop.call_soon_threadsafe(self._resolve, future, map_bytes, error)
+
+
+    def _resolve(self, future, map_bytes, error):
+        ## The command might've already given up on the render (ex. it timed out)
+        if(future.done()):
+            return
+
+        if(error is None):
+            future.set_result(map_bytes)
+        else:
+            future.set_exception(RenderWorkerError("Render worker failed: {}".format(error)))
+
+
+    async def render(self, map_name, path_obj, render_options, loop=None):
+        loop = loop if loop else asyncio.get_event_loop()
+        future = loop.create_future()
+        with self._lock:
+            request_id = self.next_request_id
+            self.next_request_id += 1
+            self.waiting[request_id] = (loop, future)
+
+        try:
+            self.request_queue.put((self.shard_id, request_id, map_name, path_obj, render_options))
+            return await future
+        finally:
+            with self._lock:
+                self.waiting.pop(request_id, None)
+
+
+## Set in each shard process by the launcher, and picked up by the RenderPool
+_shared_render_client = None
+
+
+def get_shared_render_client():
+    return _shared_render_client
+
+
+def _run_shard(shard_id, shard_count, shared_base_maps, request_queue, response_queue, stats, fake_gateway):
+    global _shared_render_client
+
+    attach_shared_base_maps(shared_base_maps)
+    _shared_render_client = SharedRenderClient(shard_id, request_queue, response_queue, stats)
+
+    if(fake_gateway):
+        _run_fake_shard(shard_id, fake_gateway)
+    else:
+        import plane_pal
+        plane_pal.PlanePal(shard_id=shard_id, shard_count=shard_count).run()
+
+
+def _run_fake_shard(shard_id, fake_gateway):
+    ## Drive BotIO's plot command with generated queries at a steady rate, in place of a Discord connection
+    import benchmark
+    import bot_io
+
+    rate, duration = fake_gateway
+    loop = asyncio.get_event_loop()
+    fake_bot = benchmark.FakeBot(loop)
+    fake_bot_io = bot_io.BotIO(None, fake_bot)
+    queries = benchmark.build_query_mix(max(1, int(rate * duration)), shard_id)
+
+    async def run_queries():
+        tasks = []
+        for index, (map_name, message) in enumerate(queries):
+            ctx = benchmark.build_fake_context(index % 50, "{}-{}".format(shard_id, index % 10))
+            tasks.append(loop.create_task(fake_bot_io._plot(ctx, message, map_name)))
+            await asyncio.sleep(1 / rate)
+        await asyncio.gather(*tasks)
+
+    loop.run_until_complete(run_queries())
+    fake_bot_io.dynamo_db.shutdown(wait=False)
+
+
+class ShardLauncher:
+    """
+    Runs each of the bot's gateway shards in its own process, with all of them handing their rendering off to a single
+    shared pool of render worker processes. Keeps an eye on all of the processes, restarts any that die, and regularly
+    reports on their health and throughput.
+    """
+
+    ## Keys
+    SHARD_COUNT_KEY = "shard_count"
+    SHARD_RENDER_WORKERS_KEY = "shard_render_workers"
+    SHARD_REPORT_INTERVAL_SECONDS_KEY = "shard_report_interval_seconds"
+    SHARD_HEARTBEAT_TIMEOUT_SECONDS_KEY = "shard_heartbeat_timeout_seconds"
+
+    ## Defaults
+    SHARD_COUNT = CONFIG_OPTIONS.get(SHARD_COUNT_KEY, 1)
+    SHARD_RENDER_WORKERS = CONFIG_OPTIONS.get(SHARD_RENDER_WORKERS_KEY, 2)
+    SHARD_REPORT_INTERVAL_SECONDS = CONFIG_OPTIONS.get(SHARD_REPORT_INTERVAL_SECONDS_KEY, 30)
+    SHARD_HEARTBEAT_TIMEOUT_SECONDS = CONFIG_OPTIONS.get(SHARD_HEARTBEAT_TIMEOUT_SECONDS_KEY, 10)
+
+
+    def __init__(self, fake_gateway=None, **kwargs):
+        self.shard_count = kwargs.get(self.SHARD_COUNT_KEY, self.SHARD_COUNT)
+        self.worker_count = kwargs.get(self.SHARD_RENDER_WORKERS_KEY, self.SHARD_RENDER_WORKERS)
+        self.report_interval = kwargs.get(self.SHARD_REPORT_INTERVAL_SECONDS_KEY, self.SHARD_REPORT_INTERVAL_SECONDS)
+        self.heartbeat_timeout = kwargs.get(self.SHARD_HEARTBEAT_TIMEOUT_SECONDS_KEY, self.SHARD_HEARTBEAT_TIMEOUT_SECONDS)
+        ## (queries per second, seconds) for each shard, when running against a fake gateway rather than Discord
+        self.fake_gateway = fake_gateway
+
+        self.shared_base_maps = build_shared_base_maps()
+        self.stats = ShardStats(self.shard_count, self.worker_count)
+        self.request_queue = multiprocessing.Queue()
+        self.response_queues = [multiprocessing.Queue() for _ in range(self.shard_count)]
+
+        self.shards = [None] * self.shard_count
+        self.workers = [None] * self.worker_count
+        self.last_snapshot = None
+        self.metrics = metrics.get_shared_metrics()
+
+    ## Methods
+
+    def get_shared_memory_size(self):
+        return sum(len(shared_base_map.buffer) for shared_base_map in self.shared_base_maps)
+
+
+    def _start_worker(self, worker_id):
+        worker = multiprocessing.Process(
+            target=_run_render_worker,
+            args=(worker_id, self.shared_base_maps, self.request_queue, self.response_queues, self.stats),
+            name="RenderWorker-{}".format(worker_id),
+            daemon=True
+        )
+        worker.start()
+        self.workers[worker_id] = worker
+
+
+    def _start_shard(self, shard_id):
+        shard = multiprocessing.Process(
+            target=_run_shard,
+            args=(shard_id, self.shard_count, self.shared_base_maps, self.request_queue, self.response_queues[shard_id], self.stats, self.fake_gateway),
+            name="Shard-{}".format(shard_id)
+        )
+        shard.start()
+        self.shards[shard_id] = shard
+
+
+    def start(self):
+        for worker_id in range(self.worker_count):
+            self._start_worker(worker_id)
+        for shard_id in range(self.shard_count):
+            self._start_shard(shard_id)
+
+        self.last_snapshot = (time.time(), self.stats.get_snapshot())
+
+
+    def check_processes(self):
+        ## Bring back any render workers that have died. Shards are only restarted when they're meant to run forever.
+        for worker_id, worker in enumerate(self.workers):
+            if(not worker.is_alive()):
+                utilities.debug_print("Render worker {} exited ({}), restarting it.".format(worker_id, worker.exitcode), debug_level=0)
+                self._start_worker(worker_id)
+
+        if(not self.fake_gateway):
+            for shard_id, shard in enumerate(self.shards):
+                if(not shard.is_alive()):
+                    utilities.debug_print("Shard {} exited ({}), restarting it.".format(shard_id, shard.exitcode), debug_level=0)
+                    self._start_shard(shard_id)
+
+
+    def get_report_lines(self):
+        now = time.time()
+        snapshot = self.stats.get_snapshot()
+        last_time, last_snapshot = self.last_snapshot
+        elapsed = max(now - last_time, 1e-6)
+        self.last_snapshot = (now, snapshot)
+
+        lines = ["Shared base maps: {:.1f}MB".format(self.get_shared_memory_size() / (1024 * 1024))]
+        for shard_id, (heartbeat, renders, failures) in enumerate(snapshot["shards"]):
+            healthy = self.shards[shard_id].is_alive() and now - heartbeat < self.heartbeat_timeout
+            throughput = (renders - last_snapshot["shards"][shard_id][1]) / elapsed
+            lines.append("Shard {}: {}, {} renders ({} failed), {:.1f}/s".format(shard_id, "healthy" if healthy else "unhealthy", renders, failures, throughput))
+            self.metrics.set_gauge("shard_healthy", int(healthy), {"shard": shard_id})
+            self.metrics.set_gauge("shard_renders_per_second", throughput, {"shard": shard_id})
+
+        for worker_id, (heartbeat, renders, busy_seconds) in enumerate(snapshot["workers"]):
+            healthy = self.workers[worker_id].is_alive() and now - heartbeat < self.heartbeat_timeout
+            throughput = (renders - last_snapshot["workers"][worker_id][1]) / elapsed
+            utilization = (busy_seconds - last_snapshot["workers"][worker_id][2]) / elapsed
+            lines.append("Render worker {}: {}, {} renders, {:.1f}/s, {:.0%} busy".format(worker_id, "healthy" if healthy else "unhealthy", renders, throughput, utilization))
+            self.metrics.set_gauge("render_worker_healthy", int(healthy), {"worker": worker_id})
+            self.metrics.set_gauge("render_worker_renders_per_second", throughput, {"worker": worker_id})
+            self.metrics.set_gauge("render_worker_utilization", utilization, {"worker": worker_id})
+
+        return lines
+
+
+    def stop(self):
+        for shard in self.shards:
+            if(shard is not None and shard.is_alive()):
+                shard.terminate()
+        for _ in self.workers:
+            self.request_queue.put(None)
+        for worker in self.workers:
+            if(worker is not None):
+                worker.join(timeout=5)
+
+
+    def run(self):
+        self.start()
+        try:
+            while(True):
+                time.sleep(self.report_interval)
+                print("\n".join(self.get_report_lines()))
+
+                ## Fake gateways only run for a set amount of time
+                if(self.fake_gateway and not any(shard.is_alive() for shard in self.shards)):
+                    break
+
+                self.check_processes()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Plane Pal as multiple shards sharing a pool of render workers.")
+    parser.add_argument("--shards", type=int, default=ShardLauncher.SHARD_COUNT, help="Number of gateway shard processes")
+    parser.add_argument("--workers", type=int, default=ShardLauncher.SHARD_RENDER_WORKERS, help="Number of render worker processes")
+    parser.add_argument("--report-interval", type=float, default=ShardLauncher.SHARD_REPORT_INTERVAL_SECONDS, help="Seconds between health reports")
+    parser.add_argument("--fake-gateway", action="store_true", help="Drive each shard with generated queries rather than connecting to Discord")
+    parser.add_argument("--rate", type=float, default=10, help="Queries per second for each fake shard")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds that each fake shard runs for")
+    args = parser.parse_args()
+
+    ShardLauncher(
+        fake_gateway=(args.rate, args.duration) if args.fake_gateway else None,
+        shard_count=args.shards,
+        shard_render_workers=args.workers,
+        shard_report_interval_seconds=args.report_interval
+    ).run()
+
+
+if(__name__ == '__main__'):
+    ## Go through the importable module, so the shards' render client is visible to the modules that import it
+    import sharding
+    sharding.main()
@@ -0,0 +1,61 @@
+import time
+import importlib
+
+import utilities
+import metrics
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+## Roughly when the process started, since this is one of the first modules that gets imported
+PROCESS_START = time.perf_counter()
+
+
+class StartupProfile:
+    """
+    Records how long each part of starting up took (imports, loading cogs and their assets, connecting to Discord), so
+    slow starts can be tracked down.
+    """
+
+    def __init__(self, start=PROCESS_START):
+        self.start = start
+        ## List of (stage, seconds) pairs, in the order that they happened
+        self.stages = []
+        self.metrics = metrics.get_shared_metrics()
+
+    ## Methods
+
+    def record(self, stage, seconds):
+        self.stages.append((stage, seconds))
+        self.metrics.set_gauge("startup_seconds", seconds, {"stage": stage})
+
+
+    def timed_import(self, module_name):
+        ## Modules that were already imported elsewhere are (correctly) reported as taking next to no time
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        self.record("import {}".format(module_name), time.perf_counter() - start)
+
+        return module
+
+
+    def mark(self, stage):
+        ## Record the time since the process started
+        self.record(stage, time.perf_counter() - self.start)
+
+
+    def get_summary_lines(self):
+        return ["{}: {:.1f}ms".format(stage, seconds * 1000) for stage, seconds in self.stages]
+
+
+## The shared profile lives outside of the cog modules, so it isn't reset when the cogs get reloaded
+_shared_startup_profile = None
+
+
+def get_shared_startup_profile():
+    global _shared_startup_profile
+
+    if(_shared_startup_profile is None):
+        _shared_startup_profile = StartupProfile()
+
+    return _shared_startup_profile
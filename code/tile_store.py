@@ -0,0 +1,202 @@
+import os
+import mmap
+import struct
+import threading
+from PIL import Image
+
+import utilities
+import output_store
+
+## Config
+CONFIG_OPTIONS = utilities.load_config()
+
+
+class TiledMap:
+    """
+    A base map that's been split up into square tiles of raw RGB pixels, and memory mapped read-only from disk. Only the
+    tiles that a render actually overlaps get read (and paged in), and the pages are shared with every other process
+    that maps the same file.
+
+    It stands in for the decoded Pillow image of the base map, so copying or cropping it hands back a regular image.
+    """
+
+    ## Magic, width, height, and tile size
+    HEADER = struct.Struct("<4sIII")
+    MAGIC = b"PPTM"
+    MODE = "RGB"
+    BYTES_PER_PIXEL = 3
+
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+        with open(file_path, "rb") as fd:
+            self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, width, height, self.tile_size = self.HEADER.unpack_from(self._mmap)
+        if(magic != self.MAGIC):
+            raise RuntimeError("'{}' isn't a tiled map".format(file_path))
+
+        self.size = (width, height)
+        self.mode = self.MODE
+        self.columns = -(-width // self.tile_size)
+        self.rows = -(-height // self.tile_size)
+        ## Edge tiles are padded out to the full tile size, so every tile can be found with a single multiplication
+        self.tile_bytes = self.tile_size * self.tile_size * self.BYTES_PER_PIXEL
+
+        expected_size = self.HEADER.size + self.columns * self.rows * self.tile_bytes
+        if(len(self._mmap) != expected_size):
+            raise RuntimeError("'{}' is {} bytes, rather than {}".format(file_path, len(self._mmap), expected_size))
+
+    ## Properties
+
+    @property
+    def width(self):
+        return self.size[0]
+
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    ## Methods
+
+    @classmethod
+    def write(cls, file_path, image, tile_size):
+        image = image.convert(cls.MODE)
+        width, height = image.size
+
+        chunks = [cls.HEADER.pack(cls.MAGIC, width, height, tile_size)]
+        for top in range(0, height, tile_size):
+            for left in range(0, width, tile_size):
+                ## Cropping past the image's edge pads the tile out with black
+                chunks.append(image.crop((left, top, left + tile_size, top + tile_size)).tobytes())
+
+        output_store.write_atomically(file_path, b"".join(chunks))
+
+
+    def crop(self, box=None):
+        """
+        Assemble a new image of the given box, out of only the tiles that overlap it. Each tile's part of the box is
+        read straight out of the memory map (Pillow raises if it's cut short), and pasted into its spot in the new image.
+        """
+
+        left, top, right, bottom = box if box else (0, 0, self.size[0], self.size[1])
+        image = Image.new(self.MODE, (right - left, bottom - top))
+        tile_view = memoryview(self._mmap)
+        tile_stride = self.tile_size * self.BYTES_PER_PIXEL
+
+        for row in range(max(0, top // self.tile_size), min(self.rows, -(-bottom // self.tile_size))):
+            for column in range(max(0, left // self.tile_size), min(self.columns, -(-right // self.tile_size))):
+                ## The part of the tile that's inside of both the box and the map, in the map's coordinates
+                tile_left = column * self.tile_size
+                tile_top = row * self.tile_size
+                region_left = max(left, tile_left)
+                region_top = max(top, tile_top)
+                region_right = min(right, tile_left + self.tile_size, self.size[0])
+                region_bottom = min(bottom, tile_top + self.tile_size, self.size[1])
+
+                start = self.HEADER.size + (row * self.columns + column) * self.tile_bytes
+                start += (region_top - tile_top) * tile_stride + (region_left - tile_left) * self.BYTES_PER_PIXEL
+                end = start + (region_bottom - region_top - 1) * tile_stride + (region_right - region_left) * self.BYTES_PER_PIXEL
+
+                ## Step over the whole width of the tile between each row
+                region_size = (region_right - region_left, region_bottom - region_top)
+                region = Image.frombytes(self.MODE, region_size, tile_view[start:end], "raw", self.MODE, tile_stride, 1)
+                image.paste(region, (region_left - left, region_top - top))
+
+        return image
+
+
+    def copy(self):
+        return self.crop()
+
+
+    def convert(self, mode):
+        return self.crop().convert(mode)
+
+
+    def getbands(self):
+        return tuple(self.MODE)
+
+
+    def close(self):
+        self._mmap.close()
+
+
+class TileStore:
+    """
+    Converts each base map (at each width) into a TiledMap file once, and memory maps it from then on, so the maps don't
+    need to be decoded at startup, or held in every process' own memory.
+    """
+
+    ## Keys
+    TILE_STORE_ENABLE_KEY = "tile_store_enable"
+    TILE_STORE_FOLDER_KEY = "tile_store_folder"
+    TILE_STORE_FOLDER_PATH_KEY = "tile_store_folder_path"
+    TILE_STORE_TILE_SIZE_KEY = "tile_store_tile_size"
+
+    ## Defaults
+    TILE_STORE_ENABLE = CONFIG_OPTIONS.get(TILE_STORE_ENABLE_KEY, False)
+    TILE_STORE_FOLDER = CONFIG_OPTIONS.get(TILE_STORE_FOLDER_KEY, "tiles")
+    TILE_STORE_FOLDER_PATH = CONFIG_OPTIONS.get(TILE_STORE_FOLDER_PATH_KEY, os.sep.join([utilities.get_root_path(), TILE_STORE_FOLDER]))
+    TILE_STORE_TILE_SIZE = CONFIG_OPTIONS.get(TILE_STORE_TILE_SIZE_KEY, 256)
+    FILE_EXTENSION = "tiles"
+
+
+    def __init__(self, **kwargs):
+        self.enabled = kwargs.get(self.TILE_STORE_ENABLE_KEY, self.TILE_STORE_ENABLE)
+        self.folder_path = kwargs.get(self.TILE_STORE_FOLDER_PATH_KEY, self.TILE_STORE_FOLDER_PATH)
+        self.tile_size = kwargs.get(self.TILE_STORE_TILE_SIZE_KEY, self.TILE_STORE_TILE_SIZE)
+
+        self.conversions = 0
+        self._lock = threading.Lock()
+
+    ## Methods
+
+    def _build_file_prefix(self, map_path, width):
+        map_name = os.path.splitext(os.path.basename(map_path))[0]
+        return "{}-{}-{}-".format(map_name, width if width else "native", self.tile_size)
+
+
+    def _remove_stale_files(self, file_prefix, current_file_name):
+        ## Older conversions of the same map are left behind whenever the map itself changes
+        for file_name in os.listdir(self.folder_path):
+            if(file_name.startswith(file_prefix) and file_name != current_file_name):
+                try:
+                    os.remove(os.sep.join([self.folder_path, file_name]))
+                except OSError as e:
+                    utilities.debug_print("Error removing stale tiled map: {}.".format(file_name), e, debug_level=2)
+
+
+    def get_tiled_map(self, map_path, width, digest, load_image):
+        """
+        Memory map the tiled copy of the base map, converting the image returned by load_image() into one first if the
+        map's contents (identified by its digest) haven't been tiled yet.
+        """
+
+        file_prefix = self._build_file_prefix(map_path, width)
+        file_name = "{}{}.{}".format(file_prefix, digest, self.FILE_EXTENSION)
+        file_path = os.sep.join([self.folder_path, file_name])
+
+        with self._lock:
+            if(not os.path.isfile(file_path)):
+                os.makedirs(self.folder_path, exist_ok=True)
+                TiledMap.write(file_path, load_image(), self.tile_size)
+                self.conversions += 1
+                self._remove_stale_files(file_prefix, file_name)
+
+        return TiledMap(file_path)
+
+
+## The shared store lives outside of the cog modules, just like the map asset registry that uses it
+_shared_tile_store = None
+
+
+def get_shared_tile_store():
+    global _shared_tile_store
+
+    if(_shared_tile_store is None):
+        _shared_tile_store = TileStore()
+
+    return _shared_tile_store
@@ -20,8 +20,20 @@ def load_json(path):
         return json.load(fd)
 
 
+## The parsed config, and the modification time of the file that it was parsed from
+_config_cache = None
+
+
 def load_config():
-    return load_json(os.sep.join([get_root_path(), CONFIG_NAME]))
+    ## Every module loads the config on import, so only parse it again when the file has actually changed
+    global _config_cache
+
+    config_path = os.sep.join([get_root_path(), CONFIG_NAME])
+    mtime = os.path.getmtime(config_path)
+    if(_config_cache is None or _config_cache[0] != mtime):
+        _config_cache = (mtime, load_json(config_path))
+
+    return _config_cache[1]
 
 
 def debug_print(*args, **kwargs):